@@ -29,8 +29,8 @@ class TestTypeAdmin(admin.ModelAdmin):
 
 @admin.register(SubTest)
 class SubTestAdmin(admin.ModelAdmin):
-    list_display = ('name', 'test_type', 'os_type', 'ami_id', 'time_limit', 'script', 'pass_fail')
+    list_display = ('name', 'test_type', 'os_type', 'ami_id', 'time_limit', 'warm_pool_size', 'script', 'pass_fail')
     search_fields = ('name', 'ami_id')
     list_filter = ('os_type', 'test_type')
-    fields = ('name', 'test_type', 'ami_id', 'details', 'instructions', 'time_limit', 'os_type', 'script')
+    fields = ('name', 'test_type', 'ami_id', 'details', 'instructions', 'time_limit', 'warm_pool_size', 'os_type', 'script')
 
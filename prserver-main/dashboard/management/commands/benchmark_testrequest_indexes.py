@@ -0,0 +1,128 @@
+import statistics
+import time
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from accounts.models import Company, CustomUser
+from dashboard.models import TestRequest, TestType, Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large number of TestRequests and check via EXPLAIN that the public_id and "
+        "dashboard/room queries are served by their indexes. PostgreSQL only; seeded rows are removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="TestRequests to seed")
+        parser.add_argument("--companies", type=int, default=100, help="Companies to spread the rows over")
+        parser.add_argument("--rooms", type=int, default=1000, help="Rooms to spread the rows over")
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+        parser.add_argument("--keep", action="store_true", help="Leave the seeded rows in place")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("This benchmark reads PostgreSQL EXPLAIN output; run it against the PostgreSQL database.")
+
+        run = uuid.uuid4().hex[:8]
+        user = CustomUser.objects.create(username=f"benchmark-{run}", email=f"benchmark-{run}@example.invalid")
+        test_type = TestType.objects.create(name=f"benchmark-{run}")
+        companies = Company.objects.bulk_create(
+            [Company(name=f"benchmark-{run}-{i}") for i in range(options["companies"])]
+        )
+        rooms = Room.objects.bulk_create(
+            [Room(name=f"benchmark-{run}-{i}", created_by=user) for i in range(options["rooms"])]
+        )
+
+        try:
+            self.seed(options["rows"], options["batch_size"], companies, rooms, test_type, user)
+            failures = self.check_plans(companies[0], rooms[0], options["repeat"])
+        finally:
+            if not options["keep"]:
+                self.cleanup(companies, rooms, test_type, user)
+
+        if failures:
+            raise CommandError(f"{failures} query plan check(s) failed.")
+        self.stdout.write(self.style.SUCCESS("All queries are served by their indexes."))
+
+    def seed(self, rows, batch_size, companies, rooms, test_type, user):
+        self.stdout.write(f"Seeding {rows} TestRequests...")
+        started = time.monotonic()
+        for start in range(0, rows, batch_size):
+            with transaction.atomic():
+                TestRequest.objects.bulk_create([
+                    TestRequest(
+                        title="benchmark",
+                        password="benchmark",
+                        test_type=test_type,
+                        company=companies[i % len(companies)],
+                        room=rooms[i % len(rooms)],
+                        created_by=user,
+                        is_accessed=i % 2 == 0,
+                    )
+                    for i in range(start, min(start + batch_size, rows))
+                ], batch_size=batch_size)
+        # VACUUM sets the visibility map, without which the planner won't pick index-only scans
+        with connection.cursor() as cursor:
+            cursor.execute(f"VACUUM ANALYZE {TestRequest._meta.db_table}")
+        self.stdout.write(f"Seeded in {time.monotonic() - started:.1f}s")
+
+    def check_plans(self, company, room, repeat):
+        probe = TestRequest.objects.filter(room=room).values_list("public_id", flat=True).first()
+        checks = [
+            # (label, queryset, plan node that must appear, index name that must appear)
+            ("test room lookup by public_id",
+             TestRequest.objects.filter(public_id=probe), "Index Scan", "public_id"),
+            ("public_id existence check",
+             TestRequest.objects.filter(public_id=probe).values_list("public_id"), "Index Only Scan", "public_id"),
+            ("room page, open requests newest first",
+             TestRequest.objects.filter(room=room, is_accessed=False).order_by("-date_created"),
+             "Index Scan", "testreq_room_accessed_idx"),
+            ("room page, finished requests (covered columns)",
+             TestRequest.objects.filter(room=room, is_accessed=True).values_list("date_created"),
+             "Index Only Scan", "testreq_room_accessed_idx"),
+            ("dashboard, open requests (covered columns)",
+             TestRequest.objects.filter(company=company, is_accessed=False).values_list("is_accessed"),
+             "Index Only Scan", "testreq_company_accessed_idx"),
+        ]
+
+        failures = 0
+        for label, queryset, node, index_name in checks:
+            plan = queryset.explain()
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset)
+                timings.append((time.perf_counter() - started) * 1000)
+
+            problems = []
+            if node not in plan:
+                problems.append(f"expected {node}")
+            if index_name not in plan:
+                problems.append(f"expected index {index_name}")
+            if "Seq Scan" in plan:
+                problems.append("sequential scan")
+            if "Sort" in plan:
+                problems.append("explicit sort")
+
+            summary = f"{label}: median {statistics.median(timings):.2f}ms over {repeat} runs"
+            if problems:
+                failures += 1
+                self.stdout.write(self.style.ERROR(f"FAIL {summary} ({', '.join(problems)})\n{plan}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"ok   {summary}"))
+        return failures
+
+    def cleanup(self, companies, rooms, test_type, user):
+        self.stdout.write("Removing seeded rows...")
+        # A raw delete; the ORM's cascade collector would load every seeded row first
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {TestRequest._meta.db_table} WHERE company_id = ANY(%s)",
+                [[company.id for company in companies]],
+            )
+        Room.objects.filter(id__in=[room.id for room in rooms]).delete()
+        Company.objects.filter(id__in=[company.id for company in companies]).delete()
+        test_type.delete()
+        user.delete()
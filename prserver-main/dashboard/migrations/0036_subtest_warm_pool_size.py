@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0035_subtest_created_by_subtest_is_public_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subtest',
+            name='warm_pool_size',
+            field=models.PositiveIntegerField(default=0, help_text='Number of pre-booted instances kept ready for this test'),
+        ),
+    ]
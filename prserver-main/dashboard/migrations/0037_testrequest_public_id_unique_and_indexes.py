@@ -0,0 +1,44 @@
+# Generated by Django 5.1.8 on 2026-10-18 10:51
+
+import uuid
+from django.db import migrations, models
+
+
+def dedupe_public_ids(apps, schema_editor):
+    # 0035 added public_id with a single default, so every pre-existing row shares one UUID.
+    # Keep it on the oldest row and give the rest fresh ones before the unique constraint goes on.
+    TestRequest = apps.get_model('dashboard', 'TestRequest')
+    duplicated = (
+        TestRequest.objects.values('public_id')
+        .annotate(rows=models.Count('id'))
+        .filter(rows__gt=1)
+        .values_list('public_id', flat=True)
+    )
+    for public_id in list(duplicated):
+        for test_request in TestRequest.objects.filter(public_id=public_id).order_by('id')[1:]:
+            test_request.public_id = uuid.uuid4()
+            test_request.save(update_fields=['public_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0036_subtest_warm_pool_size'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_public_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='testrequest',
+            name='public_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['room', 'is_accessed', '-date_created'], name='testreq_room_accessed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='testrequest',
+            index=models.Index(fields=['company', 'is_accessed'], name='testreq_company_accessed_idx'),
+        ),
+    ]
@@ -32,6 +32,7 @@ class SubTest(models.Model):
     details = models.TextField(blank=True, null=True)  # Description of the test process
     instructions = models.TextField(blank=True, null=True)  # Step-by-step instructions for the test
     time_limit = models.PositiveIntegerField(default=30)  # Time allotted in minutes
+    warm_pool_size = models.PositiveIntegerField(default=0, help_text="Number of pre-booted instances kept ready for this test")
     rdp_password = models.CharField(max_length=255, blank=True, null=True)
     os_type = models.CharField(
         max_length=10,
@@ -61,7 +62,7 @@ class Room(models.Model):
 
 
 class TestRequest(models.Model):
-    public_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    public_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="test_requests", null=True, blank=True)
     instance_id = models.CharField(max_length=100, null=True)
     title = models.CharField(max_length=100)
@@ -79,5 +80,13 @@ class TestRequest(models.Model):
     public_ip = models.CharField(max_length=15, blank=True, null=True)
     status = models.CharField(max_length=20, default='pending')
 
+    class Meta:
+        indexes = [
+            # Room page: open/finished requests newest first
+            models.Index(fields=['room', 'is_accessed', '-date_created'], name='testreq_room_accessed_idx'),
+            # Dashboard: open/finished requests per company
+            models.Index(fields=['company', 'is_accessed'], name='testreq_company_accessed_idx'),
+        ]
+
     def __str__(self):
         return self.title
\ No newline at end of file
@@ -10,3 +10,9 @@ class LinuxTestInstance(models.Model):
     status = models.CharField(max_length=50, default='pending')
     guacamole_connection_id = models.IntegerField(null=True, blank=True)  # Add this field
     sub_tests = models.ManyToManyField(SubTest, blank=True)  
+
+    class Meta:
+        indexes = [
+            # The expiry sweeper looks up live instances past their end_time
+            models.Index(fields=['status', 'end_time'], name='linuxinst_status_end_idx'),
+        ]
@@ -10,11 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+import re
 from pathlib import Path
 from dotenv import load_dotenv
 import psycopg
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin import AdminSite
+from django.core.exceptions import ImproperlyConfigured
 import logging
 from csp.constants import SELF
 
@@ -37,6 +39,85 @@ DB_HOST = get_secret("DB_HOST")
 DB_USER = get_secret("DB_USER")
 DATABASE_PASSWORD = get_secret("DATABASE_PASSWORD")
 
+# Fernet keys for stored credentials (see provisioning.vault), comma-separated and newest first.
+# To rotate: prepend a new key, deploy, run manage.py rotate_credential_keys, then drop the old key.
+RDP_ENCRYPTION_KEYS = [key for key in get_secret("RDP_ENCRYPTION_KEYS", os.environ.get("RDP_ENCRYPTION_KEY", "")).split(",") if key]
+
+# Warm pool of pre-booted test instances
+WARM_POOL_GLOBAL_CAP = int(get_secret("WARM_POOL_GLOBAL_CAP", "10"))  # Max live warm instances across all SubTests
+WARM_POOL_REFILL_INTERVAL = int(get_secret("WARM_POOL_REFILL_INTERVAL", "60"))  # Seconds between refills
+INSTANCE_POLL_INTERVAL = int(get_secret("INSTANCE_POLL_INTERVAL", "10"))  # Seconds between batched EC2 state polls
+INSTANCE_BOOT_TIMEOUT = int(get_secret("INSTANCE_BOOT_TIMEOUT", "300"))  # Seconds before a booting instance is given up on
+# How Windows rooms get their Administrator password: "ec2" waits for get_password_data, "seeded"
+# generates one per room and sets it through launch user-data, so it is known at launch time
+WINDOWS_PASSWORD_MODE = get_secret("WINDOWS_PASSWORD_MODE", "ec2")
+CREDENTIALS_RETRY_DELAY = int(get_secret("CREDENTIALS_RETRY_DELAY", "10"))  # Seconds between checks for a Windows password
+CREDENTIALS_TIMEOUT = int(get_secret("CREDENTIALS_TIMEOUT", "900"))  # Seconds after boot before waiting for credentials is given up on
+# Base URL instances call back on once RDP/SSH is up, e.g. https://truetohire.com; empty disables boot callbacks
+PROVISIONING_CALLBACK_BASE_URL = get_secret("PROVISIONING_CALLBACK_BASE_URL", "")
+GUEST_READY_TIMEOUT = int(get_secret("GUEST_READY_TIMEOUT", "300"))  # Seconds after boot to wait for the callback before opening the room anyway
+GUEST_PORT_PROBE = get_secret("GUEST_PORT_PROBE", "0") == "1"  # Also wait until the room's RDP/SSH port answers; workers must reach instance IPs
+GUEST_PROBE_WINDOW = int(get_secret("GUEST_PROBE_WINDOW", "30"))  # Seconds each probe run watches booting guests before handing over to the next
+EXPIRY_SWEEP_INTERVAL = int(get_secret("EXPIRY_SWEEP_INTERVAL", "60"))  # Seconds between expired test room sweeps
+INSTANCE_EXPIRY_GRACE = int(get_secret("INSTANCE_EXPIRY_GRACE", "300"))  # Seconds a test room may run past its end_time
+
+# AWS API clients (per process, see provisioning.aws)
+AWS_MAX_ATTEMPTS = int(get_secret("AWS_MAX_ATTEMPTS", "8"))  # Attempts per call, the first one included
+AWS_MAX_POOL_CONNECTIONS = int(get_secret("AWS_MAX_POOL_CONNECTIONS", "32"))  # Keep at or above TASK_WORKER_THREADS
+AWS_CONNECT_TIMEOUT = int(get_secret("AWS_CONNECT_TIMEOUT", "5"))  # Seconds
+AWS_READ_TIMEOUT = int(get_secret("AWS_READ_TIMEOUT", "30"))  # Seconds
+AWS_API_RATE = float(get_secret("AWS_API_RATE", "10"))  # Requests per second per service, shared by all threads
+AWS_API_BURST = int(get_secret("AWS_API_BURST", "40"))  # Requests that may go out back to back before the rate applies
+
+# Session recordings (see provisioning.recordings)
+RECORDINGS_DIR = get_secret("RECORDINGS_DIR", "/prserver/recordings")  # guacd's recording volume, mounted into web
+RECORDINGS_BUCKET = get_secret("RECORDINGS_BUCKET", "prservervideobackup")
+RECORDING_UPLOAD_PART_SIZE = int(get_secret("RECORDING_UPLOAD_PART_SIZE", "16"))  # MB per multipart part, 5 at least
+RECORDING_UPLOAD_CONCURRENCY = int(get_secret("RECORDING_UPLOAD_CONCURRENCY", "4"))  # Parts in flight per upload
+RECORDING_CHUNK_SIZE = int(get_secret("RECORDING_CHUNK_SIZE", "8"))  # MB per chunk copied to S3 while a session is live
+RECORDING_SHIP_INTERVAL = int(get_secret("RECORDING_SHIP_INTERVAL", "60"))  # Seconds between live chunk shipping runs
+HLS_SEGMENT_SECONDS = int(get_secret("HLS_SEGMENT_SECONDS", "6"))  # Length of each HLS segment, and the keyframe interval
+HLS_SEGMENT_URL_EXPIRES = int(get_secret("HLS_SEGMENT_URL_EXPIRES", "60"))  # Seconds a signed segment URL stays valid
+RECORDING_VIDEO_URL_EXPIRES = int(get_secret("RECORDING_VIDEO_URL_EXPIRES", "3600"))  # Seconds a signed MP4 URL stays valid
+THUMBNAIL_INTERVAL = int(get_secret("THUMBNAIL_INTERVAL", "10"))  # Seconds of recording between timeline thumbnails
+THUMBNAIL_REFRESH_INTERVAL = int(get_secret("THUMBNAIL_REFRESH_INTERVAL", "120"))  # Seconds between live thumbnail runs
+RECORDING_VIDEO_SIZE = get_secret("RECORDING_VIDEO_SIZE", "1280x720")  # guacenc output resolution
+RECORDING_VIDEO_BITRATE = int(get_secret("RECORDING_VIDEO_BITRATE", "2000000"))  # Bits per second
+TRANSCODE_SEGMENT_SECONDS = int(get_secret("TRANSCODE_SEGMENT_SECONDS", "300"))  # Recording time encoded per guacenc process
+TRANSCODE_WORKERS = int(get_secret("TRANSCODE_WORKERS", "4"))  # guacenc processes per recording; keep at or below the CPU count
+
+# Guacamole database connection pool (per process)
+GUAC_DB_POOL_SIZE = int(get_secret("GUAC_DB_POOL_SIZE", "10"))  # Max open connections
+GUAC_DB_MAX_LIFETIME = int(get_secret("GUAC_DB_MAX_LIFETIME", "1800"))  # Seconds before a connection is recycled
+GUAC_DB_IDLE_CHECK = int(get_secret("GUAC_DB_IDLE_CHECK", "30"))  # Idle seconds after which a connection is pinged before reuse
+GUAC_DB_CHECKOUT_TIMEOUT = int(get_secret("GUAC_DB_CHECKOUT_TIMEOUT", "5"))  # Seconds to wait for a free connection
+
+# Guacamole REST API (per process)
+GUAC_TOKEN_TTL = int(get_secret("GUAC_TOKEN_TTL", "1800"))  # Seconds a service-account token is reused; keep under Guacamole's api-session-timeout
+GUAC_TOKEN_REFRESH_MARGIN = int(get_secret("GUAC_TOKEN_REFRESH_MARGIN", "300"))  # Seconds before expiry to refresh in the background
+GUAC_API_POOL_SIZE = int(get_secret("GUAC_API_POOL_SIZE", "10"))  # Keep-alive connections to the Guacamole API
+
+# How test room connections reach Guacamole: "database" registers them in the Guacamole DB and opens
+# rooms with the cached service-account token, "json" sends an encrypted guacamole-auth-json payload
+# when the room is rendered, giving the browser a token for its room's connection only
+GUAC_CONNECTION_BACKEND = get_secret("GUAC_CONNECTION_BACKEND", "database")
+GUAC_JSON_SECRET_KEY = get_secret("GUAC_JSON_SECRET_KEY")  # 32 hex digits; must match JSON_SECRET_KEY on the guacamole service
+GUAC_JSON_EXPIRES = int(get_secret("GUAC_JSON_EXPIRES", "300"))  # Seconds a JSON auth payload can be redeemed for
+if GUAC_CONNECTION_BACKEND == "json" and not re.fullmatch(r"[0-9a-fA-F]{32}", GUAC_JSON_SECRET_KEY):
+    raise ImproperlyConfigured("GUAC_CONNECTION_BACKEND is json, so GUAC_JSON_SECRET_KEY must be 32 hex digits.")
+
+# Background task workers (manage.py run_task_workers)
+TASK_WORKER_THREADS = int(get_secret("TASK_WORKER_THREADS", "8"))  # Threads per worker process
+TASK_WORKER_PROCESSES = int(get_secret("TASK_WORKER_PROCESSES", "1"))
+TASK_WORKER_SHUTDOWN_TIMEOUT = int(get_secret("TASK_WORKER_SHUTDOWN_TIMEOUT", "8"))  # Keep below the container stop grace period
+# Seconds before a running task counts as lost and is dispatched again. Must exceed the longest task:
+# transcoding a long session's recording can take more than the library's default of an hour
+MAX_RUN_TIME = int(get_secret("MAX_RUN_TIME", "21600"))
+# Task lanes (see provisioning.queues): higher priority runs first
+TASK_QUEUE_PRIORITIES = {"setup": 30, "cleanup": 20, "default": 10, "recording": 5, "ami": 0}
+TASK_QUEUE_LIMITS = {"ami": 2, "recording": 1}  # Max concurrently running tasks per queue and process
+TASK_QUEUE_RESERVED = {"setup": 2}  # Threads per process that only this queue may use
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
@@ -88,6 +169,7 @@ INSTALLED_APPS = [
     'django_otp.plugins.otp_static', 
     'corsheaders',
     'customimage',
+    'provisioning',
 ]
 
 MIDDLEWARE = [
@@ -31,6 +31,7 @@ urlpatterns = [
     path('accounts/', include('allauth.urls')),
     path('accounts/two-factor/', include('allauth_2fa.urls')), 
     path('customimage/', include('customimage.urls')),
+    path('provisioning/', include('provisioning.urls')),
 ]
 
 
@@ -0,0 +1,27 @@
+from django.contrib import admin
+from .models import WarmInstance, ProvisioningJob, LaunchAttempt
+
+@admin.register(WarmInstance)
+class WarmInstanceAdmin(admin.ModelAdmin):
+    list_display = ("instance_id", "sub_test", "ami_id", "status", "created_at", "ready_at", "claimed_at")
+    search_fields = ("instance_id", "ami_id", "test_request__public_id")
+    list_filter = ("status",)
+
+
+@admin.register(ProvisioningJob)
+class ProvisioningJobAdmin(admin.ModelAdmin):
+    list_display = ("get_test_id", "kind", "state", "instance_id", "requested_at", "ready_at", "failed_at")
+    search_fields = ("instance_id", "test_request__public_id")
+    list_filter = ("state", "kind")
+    readonly_fields = ("requested_at", "launching_at", "running_at", "credentials_ready_at", "guac_registered_at", "guest_ready_at", "ready_at", "failed_at")
+
+    @admin.display(description="Test ID")
+    def get_test_id(self, obj):
+        return obj.test_request.public_id
+
+
+@admin.register(LaunchAttempt)
+class LaunchAttemptAdmin(admin.ModelAdmin):
+    list_display = ("client_token", "attempt", "status", "instance_id", "created_at", "launched_at")
+    search_fields = ("client_token", "instance_id")
+    list_filter = ("status",)
@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+import time
+import boto3
+from botocore.config import Config
+from django.conf import settings
+from utils.secrets import get_secret
+
+
+logger = logging.getLogger(__name__)
+
+AWS_REGION = get_secret("AWS_REGION", "us-east-1")
+
+
+class TokenBucket:
+    """
+    Client-side rate limit shared by every thread in the process: `rate` requests per second on
+    average, with bursts of up to `capacity`. acquire() blocks until a token is free, so a burst
+    of setups queues here briefly instead of tripping EC2's RequestLimitExceeded.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0  # Total seconds callers spent waiting, for metrics
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                current = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (current - self._updated) * self.rate)
+                self._updated = current
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+
+_clients = {}  # (service, region) -> client
+_buckets = {}  # service -> TokenBucket
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def client_config(service):
+    config = Config(
+        retries={"mode": "adaptive", "total_max_attempts": settings.AWS_MAX_ATTEMPTS},
+        max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+        connect_timeout=settings.AWS_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_READ_TIMEOUT,
+    )
+    if service == "s3":
+        # Pre-signed URLs otherwise fall back to legacy SigV2
+        config = config.merge(Config(signature_version="s3v4"))
+    return config
+
+
+def client(service, region=None):
+    """
+    The process's shared boto3 client for `service` in `region` (AWS_REGION by default).
+    Clients are thread-safe once built, so every thread reuses the same one and its connection
+    pool; each request, retries included, first takes a token from the service's TokenBucket.
+    """
+    global _clients_pid
+    region = region or AWS_REGION
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Forked worker processes must not share their parent's connections
+            _clients.clear()
+            _buckets.clear()
+            _clients_pid = os.getpid()
+        key = (service, region)
+        if key not in _clients:
+            # Building clients from the default session is not thread-safe, hence the lock
+            new_client = boto3.session.Session().client(service, region_name=region, config=client_config(service))
+            bucket = _buckets.setdefault(service, TokenBucket(settings.AWS_API_RATE, settings.AWS_API_BURST))
+            new_client.meta.events.register("before-send", lambda **kwargs: bucket.acquire())
+            _clients[key] = new_client
+        return _clients[key]
+
+
+def throttle_stats():
+    """Seconds this process has spent waiting on each service's token bucket."""
+    with _clients_lock:
+        return {service: round(bucket.waited, 1) for service, bucket in _buckets.items()}
+
+
+class LazyClient:
+    """
+    Module-level stand-in for client(): looks the shared client up on each use, so modules can
+    keep an `ec2` global without building it at import time, before worker processes fork.
+    """
+
+    def __init__(self, service, region=None):
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, name):
+        return getattr(client(self.service, self.region), name)
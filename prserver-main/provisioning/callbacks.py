@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+
+
+# Signs boot callback URLs; a different salt keeps these signatures useless anywhere else
+GUEST_READY_SALT = "provisioning.guest-ready"
+
+# Launch user-data fragments. The callback waits for the remote desktop / SSH service, then reports in.
+WINDOWS_GUEST_READY = """while ((Get-Service -Name TermService).Status -ne 'Running') {{ Start-Sleep -Seconds 2 }}
+for ($i = 0; $i -lt 30; $i++) {{
+    try {{ Invoke-WebRequest -Method Post -UseBasicParsing -Uri '{url}'; break }} catch {{ Start-Sleep -Seconds 5 }}
+}}
+"""
+
+LINUX_GUEST_READY = """until systemctl is-active --quiet sshd || systemctl is-active --quiet ssh; do sleep 2; done
+curl -fsS -X POST --retry 30 --retry-delay 5 --retry-connrefused '{url}' || true
+"""
+
+WINDOWS_SET_PASSWORD = """net user Administrator '{password}' | Out-Null
+"""
+
+
+def guest_ready_token(client_token):
+    """
+    Signed token for a launch attempt's boot callback. It is deterministic, so a retried
+    run_instances with the same ClientToken sends byte-identical user-data.
+    """
+    return signing.Signer(salt=GUEST_READY_SALT).sign(client_token)
+
+
+def client_token_from(token):
+    """The launch attempt's ClientToken, or None when the signature does not check out."""
+    try:
+        return signing.Signer(salt=GUEST_READY_SALT).unsign(token)
+    except signing.BadSignature:
+        return None
+
+
+def launch_user_data(os_type, client_token, admin_password=None):
+    """
+    User-data for a test room launch, or None when there is nothing to run: sets the seeded
+    Administrator password first, so it is in place before the guest reports ready.
+    """
+    commands = []
+    if admin_password:
+        commands.append(WINDOWS_SET_PASSWORD.format(password=admin_password))
+    if settings.PROVISIONING_CALLBACK_BASE_URL:
+        url = settings.PROVISIONING_CALLBACK_BASE_URL.rstrip("/") + reverse(
+            "guest_ready", kwargs={"token": guest_ready_token(client_token)}
+        )
+        commands.append((WINDOWS_GUEST_READY if os_type == "windows" else LINUX_GUEST_READY).format(url=url))
+    if not commands:
+        return None
+    if os_type == "windows":
+        return "<powershell>\n" + "".join(commands) + "</powershell>\n"
+    return "#!/bin/sh\n" + "".join(commands)
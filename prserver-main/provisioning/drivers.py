@@ -0,0 +1,375 @@
+import base64
+import functools
+import logging
+import secrets
+import string
+import time
+from datetime import datetime, timedelta
+import paramiko
+import winrm
+from botocore.exceptions import WaiterError
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from django.conf import settings
+from django.utils.timezone import now
+from dashboard.models import TestRequest
+from linux_test_rooms.models import LinuxTestInstance
+from utils.secrets import get_secret
+from windows_test_rooms.models import WindowsTestInstance
+from .models import ProvisioningJob
+from .utils import ec2, describe_instance_states, dump_credentials, load_credentials
+
+
+logger = logging.getLogger(__name__)
+
+# Key pair private key: decrypts Windows passwords and opens SSH sessions on Linux instances
+INSTANCE_KEY_PATH = "/run/secrets/windows_key"
+
+
+class CredentialsNotReady(Exception):
+    """EC2 has not produced the instance's credentials yet; try again later."""
+
+
+# Characters for seeded Administrator passwords; no quotes, so they drop into user-data as-is
+PASSWORD_ALPHABET = string.ascii_letters + string.digits + "-_.!@#%^*+="
+
+
+@functools.lru_cache(maxsize=None)
+def instance_private_key():
+    """The key pair's parsed RSA private key, read and parsed once per process."""
+    with open(INSTANCE_KEY_PATH, "rb") as key_file:
+        return serialization.load_pem_private_key(key_file.read(), password=None)
+
+
+@functools.lru_cache(maxsize=None)
+def instance_ssh_key():
+    return paramiko.RSAKey.from_private_key_file(INSTANCE_KEY_PATH)
+
+
+def decrypt_password(encrypted_password, private_key):
+    """Decrypts the base64-encoded Windows password using the key pair's RSA private key."""
+    return private_key.decrypt(base64.b64decode(encrypted_password), padding.PKCS1v15()).decode("utf-8")
+
+
+def generate_password(length=24):
+    """A random password that satisfies Windows' complexity rules (all four character classes)."""
+    classes = (string.ascii_lowercase, string.ascii_uppercase, string.digits, "-_.!@#%^*+=")
+    while True:
+        password = "".join(secrets.choice(PASSWORD_ALPHABET) for _ in range(length))
+        if all(any(c in chars for c in password) for chars in classes):
+            return password
+
+
+def stored_credentials(instance_id, public_ip):
+    """
+    Credentials already recorded for the instance's room (seeded at launch, carried over from a warm
+    instance, or kept for JSON auth), or None.
+    """
+    job = ProvisioningJob.objects.filter(instance_id=instance_id).exclude(connection_credentials="").first()
+    if not job:
+        return None
+    return {**load_credentials(job.connection_credentials), "ip_address": public_ip}
+
+
+def windows_credentials(instance_id, public_ip):
+    """
+    The Administrator password EC2 generated for the instance. Raises CredentialsNotReady until
+    EC2 publishes it (usually a few minutes after boot); callers reschedule rather than sleep.
+    """
+    encrypted_password = ec2.get_password_data(InstanceId=instance_id).get("PasswordData")
+    if not encrypted_password:
+        raise CredentialsNotReady(f"Password for instance {instance_id} is not available yet.")
+    return {
+        "username": "Administrator",
+        "password": decrypt_password(encrypted_password, instance_private_key()),
+        "ip_address": public_ip,
+    }
+
+
+def linux_credentials(instance_id, public_ip):
+    # Guacamole connects with the key pair; the password is only used by custom image grading
+    return {
+        "username": "ec2-user",
+        "password": get_secret("AMI_LINUX_PASS", "default"),
+        "ip_address": public_ip,
+    }
+
+
+CREDENTIALS = {
+    "windows": windows_credentials,
+    "linux": linux_credentials,
+}
+
+
+def fetch_credentials(os_type, instance_id, public_ip):
+    """Connection credentials for an instance by OS type; see CredentialsNotReady."""
+    return CREDENTIALS[os_type](instance_id, public_ip)
+
+
+def run_grading_script(os_type, script, credentials):
+    """Runs a SubTest's grading script on the instance over WinRM or SSH. Returns 'pass' or 'fail'."""
+    host = credentials["ip_address"]
+    try:
+        if os_type == "windows":
+            session = winrm.Session(host, auth=(credentials["username"], credentials["password"]), transport="ntlm")
+            response = session.run_ps(script)
+            logger.info(f"Windows grading script output on {host}: {response.std_out.decode()}")
+            return "pass" if response.status_code == 0 else "fail"
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            # Key pair first; paramiko falls back to the password if the key is refused
+            client.connect(
+                host,
+                username=credentials["username"],
+                pkey=credentials.get("pkey"),
+                password=credentials.get("password") or None,
+                timeout=30,
+            )
+            _, stdout, stderr = client.exec_command(script, timeout=300)
+            output = stdout.read().decode()
+            error = stderr.read().decode()
+        finally:
+            client.close()
+        logger.info(f"Linux grading script output on {host}: {output}")
+        if error:
+            logger.error(f"Linux grading script error on {host}: {error}")
+        return "pass" if not error else "fail"
+    except Exception as e:
+        logger.error(f"Error running grading script on {host}: {e}")
+        return "fail"
+
+
+class RoomDriver:
+    """
+    What differs between kinds of test room. Everything else (launching, polling, Guacamole
+    registration, warm pools, retries and metrics) is shared by the provisioning package.
+    """
+    kind = None
+
+    def os_type(self, sub_test):
+        raise NotImplementedError
+
+    def seed_credentials(self, job, os_type):
+        """
+        The Administrator password to set through launch user-data, or None to let the guest's own
+        (EC2-generated) credentials stand. Seeding stores the credentials on the job up front.
+        """
+        return None
+
+    def credentials(self, os_type, instance_id, public_ip):
+        return stored_credentials(instance_id, public_ip) or fetch_credentials(os_type, instance_id, public_ip)
+
+    def grading_credentials(self, os_type, instance_id, public_ip):
+        """Credentials the grading script logs in with; the room's own connection credentials by default."""
+        credentials = self.credentials(os_type, instance_id, public_ip)
+        if os_type == "linux":
+            credentials["pkey"] = instance_ssh_key()
+        return credentials
+
+    def create_room_record(self, job, sub_test):
+        """Creates whatever record the kind's test room view reads once provisioning is done."""
+        raise NotImplementedError
+
+    def teardown(self, test_request):
+        """Grades, terminates and cleans up a finished room."""
+        raise NotImplementedError
+
+    def grade(self, test_request, sub_test, instance_id, public_ip):
+        """Records the SubTest's pass/fail from its grading script, or NA when it has none."""
+        if not sub_test:
+            return
+        if not (sub_test.script and sub_test.script.strip()):
+            sub_test.pass_fail = "NA"
+        elif not public_ip:
+            logger.warning(f"No IP for instance {instance_id}; cannot grade test_id {test_request.public_id}")
+            return
+        else:
+            os_type = self.os_type(sub_test)
+            try:
+                credentials = self.grading_credentials(os_type, instance_id, public_ip)
+            except Exception as e:
+                logger.error(f"Could not get grading credentials for instance {instance_id}: {e}")
+                return
+            sub_test.pass_fail = run_grading_script(os_type, sub_test.script, credentials)
+        sub_test.save(update_fields=["pass_fail"])
+
+
+def instance_public_ip(test_request, instance_id):
+    """The room instance's IP, as recorded at provisioning time or looked up from EC2."""
+    job = ProvisioningJob.objects.filter(test_request=test_request).only("public_ip").first()
+    if job and job.public_ip:
+        return job.public_ip
+    if test_request.public_ip:
+        return test_request.public_ip
+    _, public_ip = describe_instance_states([instance_id]).get(instance_id, (None, None))
+    return public_ip
+
+
+class InstanceRoomDriver(RoomDriver):
+    """Windows and Linux rooms: a fixed OS, and an instance record with an end_time."""
+    os = None
+    instance_model = None
+
+    def os_type(self, sub_test):
+        return self.os
+
+    def create_room_record(self, job, sub_test):
+        self.instance_model.objects.get_or_create(
+            test_request=job.test_request,
+            defaults={
+                "instance_id": job.instance_id,
+                "status": "pending",
+                "start_time": now(),
+                "end_time": now() + timedelta(minutes=sub_test.time_limit),
+            },
+        )
+        job.test_request.instance_id = job.instance_id
+        job.test_request.save(update_fields=["instance_id"])
+
+    def teardown(self, test_request):
+        from .jobs import release_room_connection
+        from .tasks import process_session_recording
+
+        public_id = test_request.public_id
+        instance = self.instance_model.objects.get(test_request=test_request)
+        self.grade(test_request, test_request.sub_tests.first(), instance.instance_id,
+                   instance_public_ip(test_request, instance.instance_id))
+
+        ec2.terminate_instances(InstanceIds=[instance.instance_id])
+        self.instance_model.objects.filter(id=instance.id).update(status="terminated")
+        logger.info(f"Terminated EC2 instance {instance.instance_id} for test_id {public_id}")
+
+        release_room_connection(test_request, instance.instance_id)
+        # Transcoding and uploading take minutes, so they run in their own lane
+        process_session_recording(str(public_id))
+
+
+class WindowsDriver(InstanceRoomDriver):
+    kind = "windows"
+    os = "windows"
+    instance_model = WindowsTestInstance
+
+    def seed_credentials(self, job, os_type):
+        if settings.WINDOWS_PASSWORD_MODE != "seeded":
+            return None
+        # Only the first caller's password is kept, so every retry of the launch sends the same user-data
+        seeded = dump_credentials({"username": "Administrator", "password": generate_password()})
+        ProvisioningJob.objects.filter(id=job.id, connection_credentials="").update(connection_credentials=seeded)
+        job.connection_credentials = ProvisioningJob.objects.values_list("connection_credentials", flat=True).get(id=job.id)
+        return load_credentials(job.connection_credentials)["password"]
+
+
+class LinuxDriver(InstanceRoomDriver):
+    kind = "linux"
+    os = "linux"
+    instance_model = LinuxTestInstance
+
+
+class CustomImageDriver(RoomDriver):
+    """
+    Rooms built from a user's own AMI: the OS comes from the SubTest, the TestRequest itself is
+    the room record, and teardown images the instance into a new AMI before terminating it.
+    """
+    kind = "custom"
+
+    def os_type(self, sub_test):
+        return sub_test.os_type.lower()
+
+    def grading_credentials(self, os_type, instance_id, public_ip):
+        # Custom images keep the passwords their author baked in
+        if os_type == "windows":
+            return {
+                "username": "Administrator",
+                "password": get_secret("AMI_WIN_PASS", "DefaultWindowsPass"),
+                "ip_address": public_ip,
+            }
+        return {
+            "username": "ec2-user",
+            "password": get_secret("AMI_LINUX_PASS", "DefaultLinuxPass"),
+            "ip_address": public_ip,
+        }
+
+    def create_room_record(self, job, sub_test):
+        test_request = job.test_request
+        test_request.instance_id = job.instance_id
+        test_request.public_ip = job.public_ip
+        test_request.status = "running"
+        test_request.save(update_fields=["instance_id", "public_ip", "status"])
+
+    def teardown(self, test_request):
+        from customimage.tasks import bake_ami
+        from .jobs import release_room_connection
+        from .tasks import process_session_recording
+
+        public_id = str(test_request.public_id)
+        instance_id = test_request.instance_id
+        if not instance_id:
+            logger.warning(f"No instance_id found for test_id {public_id}; nothing to tear down.")
+            return
+        sub_test = test_request.sub_tests.first()
+        self.grade(test_request, sub_test, instance_id, instance_public_ip(test_request, instance_id))
+
+        # Only the image's snapshots have to be taken from the instance; the AMI lane waits for the rest
+        image_id = start_ami(instance_id, public_id)
+
+        ec2.terminate_instances(InstanceIds=[instance_id])
+        logger.info(f"Terminated instance {instance_id} for test_id {public_id}")
+        release_room_connection(test_request, instance_id)
+        TestRequest.objects.filter(id=test_request.id).update(status="terminated", instance_id=None, public_ip=None)
+
+        process_session_recording(public_id)
+        if image_id:
+            bake_ami(public_id, image_id)
+
+
+# How long start_ami waits for an image's snapshots to start: attempts, seconds apart
+AMI_SNAPSHOT_ATTEMPTS = 20
+AMI_SNAPSHOT_DELAY = 3
+
+
+def start_ami(instance_id, name_prefix):
+    """
+    Starts imaging the instance (without rebooting it) and waits until the image's snapshots
+    have started, after which the instance can go. Returns the AMI ID, or None.
+    """
+    try:
+        timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        response = ec2.create_image(
+            InstanceId=instance_id,
+            Name=f"{name_prefix}-ami-{timestamp}",
+            Description=f"AMI created from instance {instance_id} for test {name_prefix}",
+            NoReboot=True,
+        )
+        image_id = response["ImageId"]
+        logger.info(f"AMI creation started for {image_id} from instance {instance_id}")
+        for _ in range(AMI_SNAPSHOT_ATTEMPTS):
+            images = ec2.describe_images(ImageIds=[image_id])["Images"]
+            volumes = [mapping["Ebs"] for image in images for mapping in image.get("BlockDeviceMappings", []) if "Ebs" in mapping]
+            if volumes and all(volume.get("SnapshotId") for volume in volumes):
+                return image_id
+            time.sleep(AMI_SNAPSHOT_DELAY)
+        logger.error(f"Snapshots of AMI {image_id} did not start; the instance {instance_id} is terminated anyway")
+    except Exception as e:
+        logger.exception(f"Error creating AMI from instance {instance_id}: {e}")
+    return None
+
+
+def wait_for_ami(image_id):
+    """Waits for a started AMI to become available. Returns whether it did."""
+    try:
+        ec2.get_waiter("image_available").wait(ImageIds=[image_id], WaiterConfig={"Delay": 15, "MaxAttempts": 40})
+        return True
+    except WaiterError as e:
+        logger.error(f"Timeout waiting for AMI {image_id} to become available: {e}")
+    except Exception as e:
+        logger.exception(f"Error waiting for AMI {image_id}: {e}")
+    return False
+
+
+DRIVERS = {driver.kind: driver for driver in (WindowsDriver(), LinuxDriver(), CustomImageDriver())}
+
+
+def get_driver(kind):
+    return DRIVERS[kind]
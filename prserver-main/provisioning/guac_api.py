@@ -0,0 +1,173 @@
+import base64
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from utils.secrets import get_secret
+
+
+logger = logging.getLogger(__name__)
+
+GUAC_API_URL = "http://guacamole:8080/guacamole"
+GUACAMOLE_USERNAME = get_secret("GUACAMOLE_USERNAME")
+GUACAMOLE_PASSWORD = get_secret("GUACAMOLE_PASSWORD")
+
+
+class GuacamoleAuthError(Exception):
+    """Raised when no Guacamole auth token could be obtained."""
+
+
+class TokenCache:
+    """
+    Process-wide cache of Guacamole REST auth tokens, keyed by service account.
+
+    A token is reused for `ttl` seconds. Once it is within `refresh_margin` of expiring,
+    the next caller starts a background refresh and is still handed the current token.
+    When there is no usable token, only one caller fetches while the rest wait for it.
+    """
+
+    def __init__(self, fetch, ttl, refresh_margin, wait_timeout=15):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._tokens = {}  # username -> (token, fetched_at)
+        self._inflight = {}  # username -> threading.Event set when the fetch finishes
+        self.fetches = 0
+
+    def _valid(self, username):
+        entry = self._tokens.get(username)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            return entry
+        return None
+
+    def get(self, username, password):
+        with self._lock:
+            entry = self._valid(username)
+            if entry:
+                if time.monotonic() - entry[1] >= self.ttl - self.refresh_margin and username not in self._inflight:
+                    self._inflight[username] = threading.Event()
+                    threading.Thread(target=self._refresh, args=(username, password), daemon=True).start()
+                return entry[0]
+
+            event = self._inflight.get(username)
+            leader = event is None
+            if leader:
+                event = self._inflight[username] = threading.Event()
+
+        if leader:
+            return self._refresh(username, password, raise_errors=True)
+
+        event.wait(self.wait_timeout)
+        with self._lock:
+            entry = self._valid(username)
+        if not entry:
+            raise GuacamoleAuthError("Guacamole token refresh did not produce a token.")
+        return entry[0]
+
+    def _refresh(self, username, password, raise_errors=False):
+        try:
+            token = self._fetch(username, password)
+            with self._lock:
+                self._tokens[username] = (token, time.monotonic())
+                self.fetches += 1
+            return token
+        except Exception as e:
+            logger.error(f"Failed to refresh Guacamole token for {username}: {e}")
+            if raise_errors:
+                raise GuacamoleAuthError(str(e)) from e
+        finally:
+            with self._lock:
+                self._inflight.pop(username).set()
+
+    def invalidate(self, username, token=None):
+        """Drops the cached token, or only `token` if given, so a caller can't drop a refreshed one."""
+        with self._lock:
+            entry = self._tokens.get(username)
+            if entry and (token is None or entry[0] == token):
+                del self._tokens[username]
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """A keep-alive requests.Session for the Guacamole API, one per process."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GUAC_API_POOL_SIZE)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def fetch_token(username, password):
+    response = get_session().post(
+        f"{GUAC_API_URL}/api/tokens",
+        data={"username": username, "password": password},
+        timeout=10,
+    )
+    response.raise_for_status()
+    token = response.json().get("authToken")
+    if not token:
+        raise GuacamoleAuthError(f"No token found in response: {response.text}")
+    return token
+
+
+_token_cache = TokenCache(fetch_token, settings.GUAC_TOKEN_TTL, settings.GUAC_TOKEN_REFRESH_MARGIN)
+
+
+def get_token():
+    """Returns a Guacamole auth token for the service account, fetching one only when needed."""
+    return _token_cache.get(GUACAMOLE_USERNAME, GUACAMOLE_PASSWORD)
+
+
+def invalidate_token(token=None):
+    """Drops the cached token (only if it is still `token`, when given), e.g. after Guacamole rejected it."""
+    _token_cache.invalidate(GUACAMOLE_USERNAME, token)
+
+
+def api_request(method, path, **kwargs):
+    """
+    Calls the Guacamole REST API as the service account and returns the decoded JSON. Guacamole can
+    revoke a token before its TTL (a restart, an expired or logged-out session); a 401/403 drops
+    the cached token and the call is retried once with a fresh one.
+    """
+    for attempt in range(2):
+        token = get_token()
+        response = get_session().request(
+            method, f"{GUAC_API_URL}/api/{path}", params={"token": token}, timeout=10, **kwargs
+        )
+        if response.status_code not in (401, 403):
+            break
+        invalidate_token(token)
+        if attempt:
+            raise GuacamoleAuthError(f"Guacamole rejected a fresh service-account token ({response.status_code}).")
+        logger.warning(f"Guacamole rejected the cached service-account token ({response.status_code}); retrying")
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_json_token(data):
+    """Exchanges an encrypted JSON auth payload (see guac_json) for a Guacamole auth token."""
+    response = get_session().post(f"{GUAC_API_URL}/api/tokens", data={"data": data}, timeout=10)
+    if response.status_code != 200:
+        raise GuacamoleAuthError(f"Guacamole rejected the JSON auth payload ({response.status_code}).")
+    token = response.json().get("authToken")
+    if not token:
+        raise GuacamoleAuthError(f"No token found in response: {response.text}")
+    return token
+
+
+def connection_identifier(connection_id, data_source="postgresql"):
+    """The base64 identifier the Guacamole client uses to open a connection from a given data source."""
+    return base64.b64encode(f"{connection_id}\0c\0{data_source}".encode("utf-8")).decode("utf-8")
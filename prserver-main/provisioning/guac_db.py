@@ -0,0 +1,351 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from django.conf import settings
+from utils.secrets import get_secret
+
+
+logger = logging.getLogger(__name__)
+
+# Guacamole database configuration
+DB_HOST = "db"
+DB_USER = get_secret("DB_USER")
+DB_PASSWORD = get_secret("postgres_password")
+DB_NAME = get_secret("DB_NAME")
+DB_PORT = "5432"
+
+
+class PoolTimeout(Exception):
+    """Raised when no Guacamole DB connection frees up within the checkout timeout."""
+
+
+class GuacamolePool:
+    """
+    A bounded, thread-safe pool of psycopg2 connections to the Guacamole database.
+
+    Connections idle for longer than `idle_check` seconds are pinged before being handed out,
+    and connections older than `max_lifetime` seconds are closed and replaced.
+    """
+
+    def __init__(self, max_size, max_lifetime, idle_check, checkout_timeout, **connect_kwargs):
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.idle_check = idle_check
+        self.checkout_timeout = checkout_timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, created_at, last_used_at), most recently used last
+        self._in_use = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._closed = 0
+
+    def _open(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        with self._cond:
+            self._opened += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._closed += 1
+
+    def _is_healthy(self, conn, created_at, last_used_at):
+        if conn.closed:
+            return False
+        current = time.monotonic()
+        if current - created_at > self.max_lifetime:
+            return False
+        if current - last_used_at > self.idle_check:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def acquire(self):
+        """Checks out a connection, blocking up to checkout_timeout. Returns (connection, created_at)."""
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"No Guacamole DB connection available after {self.checkout_timeout}s.")
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+
+        try:
+            if entry and self._is_healthy(*entry):
+                conn, created_at, _ = entry
+            else:
+                if entry:
+                    self._close(entry[0])
+                conn, created_at = self._open(), time.monotonic()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn, created_at
+
+    def release(self, conn, created_at, discard=False):
+        """Returns a connection to the pool, or closes it when it is broken or `discard` is set."""
+        if not discard and not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            entry = None
+        else:
+            entry = (conn, created_at, time.monotonic())
+
+        with self._cond:
+            self._in_use -= 1
+            if entry:
+                self._idle.append(entry)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the block; commits on success, rolls back on error."""
+        conn, created_at = self.acquire()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            raise
+        finally:
+            self.release(conn, created_at, discard)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "wait_seconds_total": round(self._wait_total, 4),
+                "wait_seconds_max": round(self._wait_max, 4),
+                "wait_seconds_avg": round(self._wait_total / self._checkouts, 4) if self._checkouts else 0.0,
+                "timeouts": self._timeouts,
+                "connections_opened": self._opened,
+                "connections_closed": self._closed,
+            }
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns this process's pool, creating it on first use and again after a fork."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = GuacamolePool(
+                max_size=settings.GUAC_DB_POOL_SIZE,
+                max_lifetime=settings.GUAC_DB_MAX_LIFETIME,
+                idle_check=settings.GUAC_DB_IDLE_CHECK,
+                checkout_timeout=settings.GUAC_DB_CHECKOUT_TIMEOUT,
+                host=DB_HOST,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                database=DB_NAME,
+                port=DB_PORT,
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def cursor():
+    """A cursor on a pooled Guacamole DB connection; the transaction commits when the block exits cleanly."""
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+def connection_parameters(os_type, credentials, recording_name):
+    """
+    Returns (protocol, [(name, value), ...]) for an RDP (Windows) or SSH (Linux) Guacamole
+    connection with session recording enabled. Shared by both connection backends.
+    """
+    protocol = "rdp" if os_type == "windows" else "ssh"
+    port = 3389 if os_type == "windows" else 22
+
+    params = [
+        ("hostname", credentials["ip_address"]),
+        ("port", str(port)),
+        ("username", credentials["username"]),
+        ("security", "any"),
+        ("ignore-cert", "true"),
+        ("enable-recording", "true"),
+        ("recording-path", "/prserver/recordings"),
+        ("recording-name", recording_name),
+        ("automatically-create-recording-path", "true"),
+    ]
+    if os_type == "windows":
+        params.append(("password", credentials["password"]))
+    else:
+        with open("/run/secrets/windows_key", "r") as key_file:
+            params.append(("private-key", key_file.read().strip()))
+    return protocol, params
+
+
+def add_connection(instance_id, os_type, credentials, recording_name):
+    """
+    Registers an RDP (Windows) or SSH (Linux) Guacamole connection with session recording enabled.
+    """
+    protocol, params = connection_parameters(os_type, credentials, recording_name)
+
+    with cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO guacamole_connection (connection_name, protocol)
+            VALUES (%s, %s)
+            RETURNING connection_id
+            """,
+            (f"Instance {instance_id}", protocol)
+        )
+        connection_id = cur.fetchone()[0]
+        cur.executemany(
+            """
+            INSERT INTO guacamole_connection_parameter (connection_id, parameter_name, parameter_value)
+            VALUES (%s, %s, %s)
+            """,
+            [(connection_id, name, value) for name, value in params]
+        )
+
+    logger.info(f"Guacamole {protocol} connection added for instance {instance_id} with ID {connection_id}.")
+    return connection_id
+
+
+def get_connection_id(instance_id):
+    """
+    Looks up the Guacamole connection ID registered under an instance's name, or None.
+    Prefer the ID recorded on the provisioning job; this is the fallback for older rooms. The
+    stock schema's UNIQUE (connection_name, parent_id) constraint already indexes the name.
+    """
+    try:
+        with cursor() as cur:
+            cur.execute(
+                "SELECT connection_id FROM guacamole_connection WHERE connection_name = %s",
+                (f"Instance {instance_id}",)
+            )
+            result = cur.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        logger.error(f"Error retrieving Guacamole connection ID for instance {instance_id}: {e}")
+        return None
+
+
+def set_recording_name(connection_id, recording_name):
+    """Points an existing Guacamole connection's session recording at a new file name."""
+    with cursor() as cur:
+        cur.execute(
+            """
+            UPDATE guacamole_connection_parameter SET parameter_value = %s
+            WHERE connection_id = %s AND parameter_name = 'recording-name'
+            """,
+            (recording_name, connection_id)
+        )
+
+
+def remove_connection(connection_id):
+    try:
+        with cursor() as cur:
+            cur.execute("DELETE FROM guacamole_connection_parameter WHERE connection_id = %s", (connection_id,))
+            cur.execute("DELETE FROM guacamole_connection WHERE connection_id = %s", (connection_id,))
+        logger.info(f"Guacamole connection {connection_id} removed.")
+    except Exception as e:
+        logger.error(f"Error removing Guacamole connection {connection_id}: {e}")
+
+
+def remove_instance_connections(instance_id):
+    """Removes every Guacamole connection registered under an instance's name."""
+    try:
+        with cursor() as cur:
+            cur.execute(
+                "SELECT connection_id FROM guacamole_connection WHERE connection_name = %s",
+                (f"Instance {instance_id}",)
+            )
+            connection_ids = [row[0] for row in cur.fetchall()]
+            if connection_ids:
+                cur.execute(
+                    "DELETE FROM guacamole_connection_parameter WHERE connection_id = ANY(%s)", (connection_ids,)
+                )
+                cur.execute("DELETE FROM guacamole_connection WHERE connection_id = ANY(%s)", (connection_ids,))
+        logger.info(f"Guacamole connection removed for instance {instance_id}.")
+    except Exception as e:
+        logger.error(f"Error removing Guacamole connection for instance {instance_id}: {e}")
+
+
+def remove_connections(connection_ids=(), instance_ids=()):
+    """
+    Removes many Guacamole connections in one transaction with set-based DELETEs: those with the
+    given IDs, plus any registered under the given instances' names (rooms that predate recorded IDs).
+    """
+    connection_ids = list(connection_ids)
+    names = [f"Instance {instance_id}" for instance_id in instance_ids]
+    if not connection_ids and not names:
+        return 0
+    with cursor() as cur:
+        cur.execute(
+            """
+            DELETE FROM guacamole_connection_parameter WHERE connection_id IN (
+                SELECT connection_id FROM guacamole_connection
+                WHERE connection_id = ANY(%s) OR connection_name = ANY(%s)
+            )
+            """,
+            (connection_ids, names)
+        )
+        cur.execute(
+            "DELETE FROM guacamole_connection WHERE connection_id = ANY(%s) OR connection_name = ANY(%s)",
+            (connection_ids, names)
+        )
+        removed = cur.rowcount
+    logger.info(f"Removed {removed} Guacamole connection(s).")
+    return removed
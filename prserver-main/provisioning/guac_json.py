@@ -0,0 +1,69 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.conf import settings
+from . import guac_api
+from .guac_db import connection_parameters
+from .utils import load_credentials
+
+
+# guacamole-auth-json exposes its connections under this data source
+DATA_SOURCE = "json"
+
+
+def build_payload(username, connections, expires_in):
+    """
+    The JSON document guacamole-auth-json expects: a username, an expiry in milliseconds
+    since the epoch, and connections keyed by name, each with a protocol and string parameters.
+    """
+    return {
+        "username": username,
+        "expires": int((time.time() + expires_in) * 1000),
+        "connections": {
+            name: {
+                "protocol": connection["protocol"],
+                "parameters": {key: str(value) for key, value in connection["parameters"].items()},
+            }
+            for name, connection in connections.items()
+        },
+    }
+
+
+def encrypt_payload(payload, secret_key):
+    """
+    Signs the payload with HMAC-SHA256 and prepends the signature, then encrypts the result with
+    AES-128-CBC under a zero IV, as guacamole-auth-json requires. `secret_key` is the same 32 hex
+    digit key configured as json-secret-key on the Guacamole side. Returns base64 text.
+    """
+    key = bytes.fromhex(secret_key)
+    data = json.dumps(payload).encode("utf-8")
+    signed = hmac.new(key, data, hashlib.sha256).digest() + data
+
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    padded = padder.update(signed) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(bytes(16))).encryptor()
+    return base64.b64encode(encryptor.update(padded) + encryptor.finalize()).decode("ascii")
+
+
+def room_session(job, os_type):
+    """
+    Builds the test room's connection from the provisioning job and exchanges it for a Guacamole
+    token that can open only that connection. Nothing is written to the Guacamole database.
+    Returns (token, client identifier).
+    """
+    public_id = job.test_request.public_id
+    name = f"testid-{public_id}"
+    credentials = {**load_credentials(job.connection_credentials), "ip_address": job.public_ip}
+    protocol, params = connection_parameters(os_type, credentials, name)
+
+    payload = build_payload(
+        f"candidate-{public_id}",
+        {name: {"protocol": protocol, "parameters": dict(params)}},
+        settings.GUAC_JSON_EXPIRES,
+    )
+    token = guac_api.fetch_json_token(encrypt_payload(payload, settings.GUAC_JSON_SECRET_KEY))
+    return token, guac_api.connection_identifier(name, DATA_SOURCE)
@@ -0,0 +1,263 @@
+import logging
+from datetime import timedelta
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+from dashboard.models import TestRequest
+from . import guac_api, guac_db, guac_json
+from .callbacks import launch_user_data
+from .drivers import get_driver
+from .models import ProvisioningJob, LaunchAttempt
+from .utils import (
+    ec2, INSTANCE_TYPE, KEY_NAME, SECURITY_GROUP,
+    claim_warm_instance, dump_credentials, instances_for_client_tokens,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def job_os_type(job, sub_test):
+    return get_driver(job.kind).os_type(sub_test)
+
+
+def start_provisioning(test_request, sub_test, kind):
+    """
+    Returns the test request's provisioning job, creating it on first call.
+
+    Creating the job is the room's launch reservation: one short INSERT guarded by the unique
+    test_request column, so concurrent page loads for the same room get the same job back and
+    wait on its status. Nothing slow runs inside a transaction or holds a row lock.
+
+    A new job is satisfied straight from the warm pool when possible; otherwise
+    it is queued for the background workers and the caller shows a preparing page.
+    """
+    from .tasks import run_provisioning_job
+
+    job = ProvisioningJob.objects.filter(test_request=test_request).first()
+    if job:
+        return job
+    try:
+        with transaction.atomic():
+            job = ProvisioningJob.objects.create(test_request=test_request, kind=kind)
+    except IntegrityError:
+        logger.info(f"Provisioning for test_id {test_request.public_id} was already reserved by another request")
+        return ProvisioningJob.objects.get(test_request=test_request)
+
+    warm_instance = claim_warm_instance(test_request, sub_test)
+    if warm_instance:
+        adopt_warm_instance(job, warm_instance, sub_test)
+    else:
+        logger.info(f"Queued provisioning job {job.id} for test_id {test_request.public_id}")
+        # Workers must not look the job up before the caller's transaction (if any) commits it
+        transaction.on_commit(lambda: run_provisioning_job(job.id))
+    return job
+
+
+def adopt_warm_instance(job, warm_instance, sub_test):
+    """Fast-forwards a fresh job through every phase using an already prepared warm instance."""
+    job.transition(
+        "guac_registered",
+        instance_id=warm_instance.instance_id,
+        public_ip=warm_instance.public_ip,
+        guacamole_connection_id=warm_instance.guacamole_connection_id,
+        connection_credentials=warm_instance.connection_credentials,
+    )
+    finalize_job(job, sub_test)
+
+
+def client_token(public_id, attempt):
+    """The EC2 ClientToken for a test room's nth launch attempt (EC2 allows up to 64 ASCII characters)."""
+    return f"{public_id}-{attempt}"
+
+
+def reserve_launch_attempt(job):
+    """
+    Returns the launch attempt run_instances should be (re)issued for. A pending or launched attempt
+    is reused, so retries and concurrent workers send the same ClientToken and EC2 hands back the
+    one instance; only an attempt EC2 definitively rejected moves on to the next number.
+    """
+    latest = job.launch_attempts.order_by("-attempt").first()
+    if latest and latest.status != "failed":
+        return latest
+
+    number = latest.attempt + 1 if latest else 1
+    try:
+        with transaction.atomic():
+            return LaunchAttempt.objects.create(
+                job=job, attempt=number, client_token=client_token(job.test_request.public_id, number)
+            )
+    except IntegrityError:
+        return LaunchAttempt.objects.get(job=job, attempt=number)
+
+
+def launch_job_instance(job, sub_test):
+    public_id = str(job.test_request.public_id)
+    attempt = reserve_launch_attempt(job)
+    if attempt.status == "launched":
+        instance_id = attempt.instance_id
+    else:
+        launch_options = {}
+        os_type = job_os_type(job, sub_test)
+        admin_password = get_driver(job.kind).seed_credentials(job, os_type)
+        user_data = launch_user_data(os_type, attempt.client_token, admin_password)
+        if user_data:
+            launch_options["UserData"] = user_data
+        try:
+            response = ec2.run_instances(
+                ImageId=sub_test.ami_id,
+                InstanceType=INSTANCE_TYPE,
+                KeyName=KEY_NAME,
+                SecurityGroupIds=[SECURITY_GROUP],
+                MinCount=1,
+                MaxCount=1,
+                ClientToken=attempt.client_token,
+                TagSpecifications=[{
+                    "ResourceType": "instance",
+                    "Tags": [
+                        {"Key": "TestID", "Value": public_id},
+                        {"Key": "Name", "Value": sub_test.name},
+                    ],
+                }],
+                **launch_options,
+            )
+        except ClientError as e:
+            # A mismatch means this token already launched something (with other parameters)
+            if e.response.get("Error", {}).get("Code") != "IdempotentParameterMismatch":
+                LaunchAttempt.objects.filter(id=attempt.id, status="pending").update(status="failed", error=str(e))
+            raise
+        instance_id = response["Instances"][0]["InstanceId"]
+        LaunchAttempt.objects.filter(id=attempt.id).update(status="launched", instance_id=instance_id, launched_at=now())
+
+    logger.info(f"Started instance {instance_id} for test_id {public_id} (launch attempt {attempt.attempt})")
+    job.transition("launching", instance_id=instance_id)
+
+
+def fetch_job_credentials(job, os_type):
+    """The instance's connection credentials; raises CredentialsNotReady until EC2 has them."""
+    credentials = get_driver(job.kind).credentials(os_type, job.instance_id, job.public_ip)
+    if job.state == "running":
+        job.transition("credentials_ready")
+    return credentials
+
+
+def register_job_connection(job, os_type, credentials):
+    if settings.GUAC_CONNECTION_BACKEND == "json":
+        # Nothing to write to Guacamole; room_session builds the connection at render time
+        job.transition("guac_registered", connection_credentials=dump_credentials(credentials))
+        return
+    connection_id = guac_db.add_connection(
+        job.instance_id, os_type, credentials, f"testid-{job.test_request.public_id}"
+    )
+    job.transition("guac_registered", guacamole_connection_id=connection_id)
+
+
+def guest_ready_deadline(job):
+    """
+    When a job stops waiting for its guest to report in (by boot callback or port probe), or None
+    if it isn't waiting: both are off, the guest already reported in, or the instance isn't running yet.
+    """
+    waits = settings.PROVISIONING_CALLBACK_BASE_URL or settings.GUEST_PORT_PROBE
+    if not waits or job.guest_ready_at or not job.running_at:
+        return None
+    deadline = job.running_at + timedelta(seconds=settings.GUEST_READY_TIMEOUT)
+    return deadline if deadline > now() else None
+
+
+def mark_guest_ready(job_id):
+    """
+    Records that the job's guest is reachable and re-queues the job. Only the first report for an
+    unfinished job counts; returns whether this one did.
+    """
+    from .tasks import run_provisioning_job
+
+    reported = (
+        ProvisioningJob.objects.filter(id=job_id, guest_ready_at__isnull=True)
+        .exclude(state__in=("ready", "failed"))
+        .update(guest_ready_at=now())
+    )
+    if reported:
+        run_provisioning_job(job_id)
+    return bool(reported)
+
+
+def finalize_job(job, sub_test):
+    """Creates the room record the kind's test room views read, then marks the job ready."""
+    get_driver(job.kind).create_room_record(job, sub_test)
+    job.transition("ready")
+    logger.info(f"Test room for test_id {job.test_request.public_id} is ready: {job.phase_timings()}")
+
+
+def fail_job(job, error):
+    """Marks the job failed and releases whatever it had already acquired."""
+    logger.error(f"Provisioning job {job.id} failed in state {job.state}: {error}")
+    if job.guacamole_connection_id:
+        guac_db.remove_connection(job.guacamole_connection_id)
+    instance_ids = [job.instance_id] if job.instance_id else []
+    try:
+        # A launch whose response never arrived may still have started an instance under its token
+        pending_tokens = job.launch_attempts.filter(status="pending").values_list("client_token", flat=True)
+        instance_ids += [i for i in instances_for_client_tokens(pending_tokens) if i not in instance_ids]
+    except Exception as e:
+        logger.error(f"Failed to look up instances launched for failed job {job.id}: {e}")
+    if instance_ids:
+        try:
+            ec2.terminate_instances(InstanceIds=instance_ids)
+        except Exception as e:
+            logger.error(f"Failed to terminate instance(s) {instance_ids} for failed job {job.id}: {e}")
+    job.transition("failed", error=str(error))
+
+
+def room_connection_id(test_request, instance_id):
+    """
+    The Guacamole connection ID for a test room, as recorded by its provisioning job.
+    Rooms provisioned before jobs recorded it fall back to a lookup by connection name.
+    """
+    job = ProvisioningJob.objects.filter(test_request=test_request).only("guacamole_connection_id").first()
+    if job and job.guacamole_connection_id:
+        return job.guacamole_connection_id
+    return guac_db.get_connection_id(instance_id)
+
+
+def release_room_connection(test_request, instance_id):
+    """Removes a test room's Guacamole connection once the room is torn down."""
+    connection_id = room_connection_id(test_request, instance_id)
+    if connection_id:
+        guac_db.remove_connection(connection_id)
+
+
+def uses_json_auth(job):
+    """Whether the job's room is opened through guacamole-auth-json rather than the Guacamole database."""
+    return settings.GUAC_CONNECTION_BACKEND == "json" and bool(job and job.connection_credentials)
+
+
+def room_session(test_request, instance_id):
+    """
+    Returns (auth token, client connection identifier) for opening a test room in Guacamole.
+    The json backend exchanges the room's connection for a token that grants only that
+    connection; the database backend uses the cached service-account token and the connection
+    registered for the room, with no Guacamole round trip.
+    """
+    job = ProvisioningJob.objects.filter(test_request=test_request).select_related("test_request").first()
+    if uses_json_auth(job):
+        sub_test = test_request.sub_tests.first() if job.kind == "custom" else None
+        return guac_json.room_session(job, job_os_type(job, sub_test))
+
+    connection_id = room_connection_id(test_request, instance_id)
+    if not connection_id:
+        raise guac_api.GuacamoleAuthError(f"No Guacamole connection registered for test_id {test_request.public_id}.")
+    return guac_api.get_token(), guac_api.connection_identifier(connection_id)
+
+
+def teardown_room(public_id, kind):
+    """Grades, terminates and cleans up a finished test room of the given kind."""
+    try:
+        test_request = TestRequest.objects.get(public_id=public_id)
+    except TestRequest.DoesNotExist:
+        logger.error(f"TestRequest with test_id {public_id} not found. Nothing to tear down.")
+        return
+    try:
+        get_driver(kind).teardown(test_request)
+    except Exception as e:
+        logger.exception(f"Error tearing down {kind} test room for test_id {public_id}: {e}")
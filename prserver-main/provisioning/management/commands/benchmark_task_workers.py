@@ -0,0 +1,96 @@
+import statistics
+import threading
+import time
+import uuid
+from background_task import background
+from background_task.models import Task
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from provisioning.queues import SETUP_QUEUE, AMI_QUEUE
+from provisioning.workers import TaskWorkerPool
+
+BENCHMARK_TASK = "provisioning.benchmark_task"
+
+_started = {}  # run -> [queue latency in seconds, ...]
+_started_lock = threading.Lock()
+
+
+@background(name=BENCHMARK_TASK)
+def benchmark_task(run, enqueued_at, seconds):
+    """Stands in for a setup or AMI task: records how long it waited in the queue, then holds its thread."""
+    with _started_lock:
+        _started.setdefault(run, []).append(time.time() - enqueued_at)
+    time.sleep(seconds)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure queue latency (enqueue to start) of concurrent instance setups behind a slow AMI task, "
+        "first with a single serial worker like process_tasks, then with the threaded worker pool."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--setups", type=int, default=50, help="Setup tasks to enqueue")
+        parser.add_argument("--setup-seconds", type=float, default=1.0, help="How long each setup task runs")
+        parser.add_argument("--ami-seconds", type=float, default=10.0, help="How long the AMI task enqueued first runs")
+        parser.add_argument("--threads", type=int, default=16, help="Threads for the pooled run")
+        parser.add_argument("--skip-serial", action="store_true", help="Only run the pooled worker")
+        parser.add_argument("--lanes", action="store_true", help="Enqueue with the TASK_QUEUE_PRIORITIES lane priorities")
+
+    def handle(self, *args, **options):
+        if Task.objects.exclude(task_name=BENCHMARK_TASK).filter(locked_by__isnull=True).exists():
+            raise CommandError("Other background tasks are queued; run the benchmark against an idle task queue.")
+
+        runs = [("pooled", options["threads"], settings.TASK_QUEUE_LIMITS, settings.TASK_QUEUE_RESERVED)]
+        if not options["skip_serial"]:
+            runs.insert(0, ("serial", 1, {}, {}))
+
+        results = {}
+        for label, threads, queue_limits, queue_reserved in runs:
+            self.stdout.write(f"Running {label} worker ({threads} thread(s))...")
+            results[label] = self.run_once(threads, queue_limits, queue_reserved, options)
+
+        for label, (latencies, elapsed) in results.items():
+            ordered = sorted(latencies)
+            self.stdout.write(
+                f"{label:>7}: {len(ordered)} tasks in {elapsed:.1f}s | queue latency "
+                f"p50 {statistics.median(ordered):.2f}s, "
+                f"p95 {ordered[int(len(ordered) * 0.95) - 1]:.2f}s, "
+                f"max {ordered[-1]:.2f}s"
+            )
+
+    def run_once(self, threads, queue_limits, queue_reserved, options):
+        run = uuid.uuid4().hex[:8]
+        total = options["setups"] + 1
+        if options["lanes"]:
+            lanes = {queue: settings.TASK_QUEUE_PRIORITIES[queue] for queue in (AMI_QUEUE, SETUP_QUEUE)}
+        else:
+            lanes = {AMI_QUEUE: 0, SETUP_QUEUE: 0}
+        benchmark_task(run, time.time(), options["ami_seconds"], queue=AMI_QUEUE, priority=lanes[AMI_QUEUE])
+        for _ in range(options["setups"]):
+            benchmark_task(run, time.time(), options["setup_seconds"], queue=SETUP_QUEUE, priority=lanes[SETUP_QUEUE])
+
+        pool = TaskWorkerPool(threads, queue_limits, sleep=0.1, queue_reserved=queue_reserved)
+
+        def stop_when_done():
+            while not pool.stop_event.is_set():
+                with _started_lock:
+                    if len(_started.get(run, [])) >= total:
+                        break
+                time.sleep(0.05)
+            # Let the last tasks finish before the pool drains
+            time.sleep(max(options["setup_seconds"], 0) + 0.5)
+            pool.stop()
+
+        watcher = threading.Thread(target=stop_when_done, daemon=True)
+        started = time.monotonic()
+        watcher.start()
+        pool.run(shutdown_timeout=options["ami_seconds"] + options["setup_seconds"] + 5)
+        elapsed = time.monotonic() - started
+
+        Task.objects.filter(task_name=BENCHMARK_TASK).delete()
+        with _started_lock:
+            latencies = _started.pop(run, [])
+        if len(latencies) < total:
+            raise CommandError(f"Only {len(latencies)} of {total} benchmark tasks ran.")
+        return latencies, elapsed
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from provisioning.reconcile import find_orphans, terminate_orphans
+
+
+class Command(BaseCommand):
+    help = (
+        "Find running EC2 instances tagged with a TestID that no test room, provisioning job or warm pool "
+        "record points to, and terminate them. Use --dry-run to only report them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report orphans without terminating them")
+        parser.add_argument(
+            "--min-age", type=int, default=900,
+            help="Ignore instances launched less than this many seconds ago (their launch may still be recording them)",
+        )
+
+    def handle(self, *args, **options):
+        orphans = find_orphans(options["min_age"])
+        for orphan in orphans:
+            self.stdout.write(
+                f"{orphan['instance_id']}  {orphan['state']:<9}  launched {orphan['launch_time']:%Y-%m-%d %H:%M}  "
+                f"TestID {orphan['test_id']}  ({orphan['reason']})"
+            )
+
+        if not orphans:
+            self.stdout.write(self.style.SUCCESS("No orphaned instances found."))
+        elif options["dry_run"]:
+            self.stdout.write(self.style.WARNING(f"{len(orphans)} orphaned instance(s) found; dry run, nothing terminated."))
+        else:
+            terminated = terminate_orphans(orphans)
+            self.stdout.write(self.style.SUCCESS(f"Terminated {terminated} of {len(orphans)} orphaned instance(s)."))
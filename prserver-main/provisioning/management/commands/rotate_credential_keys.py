@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from provisioning.vault import encrypted_fields, rotate
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt every stored credential under the first key in RDP_ENCRYPTION_KEYS. "
+        "Run after prepending a new key; the old key can be removed once this completes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Rows re-encrypted per transaction")
+
+    def handle(self, *args, **options):
+        for model, field_name in encrypted_fields():
+            rotated = rotate(model, field_name, options["batch_size"])
+            self.stdout.write(f"{model._meta.label}.{field_name}: re-encrypted {rotated} row(s)")
+        self.stdout.write(self.style.SUCCESS("All stored credentials use the current key."))
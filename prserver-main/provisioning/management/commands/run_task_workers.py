@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import signal
+from background_task.tasks import autodiscover
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from provisioning.workers import TaskWorkerPool, parse_queue_limits
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background tasks concurrently on a pool of worker threads, optionally in several processes, "
+        "with per-queue concurrency limits and graceful shutdown on SIGTERM/SIGINT. Replaces process_tasks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=settings.TASK_WORKER_THREADS, help="Worker threads per process")
+        parser.add_argument("--processes", type=int, default=settings.TASK_WORKER_PROCESSES, help="Worker processes")
+        parser.add_argument(
+            "--queue-limit", action="append", default=[], metavar="QUEUE=N",
+            help="Max tasks of QUEUE running at once in each process; overrides TASK_QUEUE_LIMITS. Repeatable.",
+        )
+        parser.add_argument(
+            "--queue-reserve", action="append", default=[], metavar="QUEUE=N",
+            help="Threads in each process kept free for QUEUE; overrides TASK_QUEUE_RESERVED. Repeatable.",
+        )
+        parser.add_argument("--sleep", type=float, default=1.0, help="Seconds to wait when no task is due")
+        parser.add_argument("--duration", type=int, default=0, help="Stop after this many seconds (0 runs forever)")
+        parser.add_argument(
+            "--shutdown-timeout", type=float, default=settings.TASK_WORKER_SHUTDOWN_TIMEOUT,
+            help="Seconds to let running tasks finish after a stop signal",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            queue_limits = {**settings.TASK_QUEUE_LIMITS, **parse_queue_limits(options["queue_limit"])}
+            queue_reserved = {**settings.TASK_QUEUE_RESERVED, **parse_queue_limits(options["queue_reserve"])}
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options["threads"] < 1 or options["processes"] < 1:
+            raise CommandError("--threads and --processes must be at least 1.")
+        if sum(queue_reserved.values()) >= options["threads"]:
+            raise CommandError(f"Reserved threads {queue_reserved} leave none for other queues; raise --threads.")
+
+        autodiscover()
+        worker_args = (
+            options["threads"], queue_limits, queue_reserved,
+            options["sleep"], options["duration"], options["shutdown_timeout"],
+        )
+        if options["processes"] == 1:
+            run_worker(*worker_args)
+            return
+
+        # Children must not inherit the parent's open database connections
+        connections.close_all()
+        children = [
+            multiprocessing.Process(target=run_worker, args=worker_args, name=f"task-worker-{i}")
+            for i in range(options["processes"])
+        ]
+        for child in children:
+            child.start()
+
+        def forward(signum, frame):
+            for child in children:
+                if child.is_alive():
+                    os.kill(child.pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for child in children:
+            child.join()
+
+
+def run_worker(threads, queue_limits, queue_reserved, sleep, duration, shutdown_timeout):
+    pool = TaskWorkerPool(threads, queue_limits, sleep, queue_reserved)
+    signal.signal(signal.SIGTERM, lambda signum, frame: pool.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: pool.stop())
+    if not pool.run(duration, shutdown_timeout):
+        # Unfinished tasks were released for another worker; don't wait for their threads
+        os._exit(1)
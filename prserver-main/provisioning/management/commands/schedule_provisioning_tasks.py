@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from provisioning.tasks import (
+    refill_warm_pools, poll_instance_states, probe_guest_ports, sweep_expired_instances, ship_recording_chunks,
+    render_live_thumbnails,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Schedule the repeating provisioning tasks (warm pool refill, EC2 state polling, expired room sweep, "
+        "live recording shipping and thumbnails). "
+        "Safe to run on every start."
+    )
+
+    def handle(self, *args, **options):
+        refill_warm_pools(repeat=settings.WARM_POOL_REFILL_INTERVAL, remove_existing_tasks=True)
+        poll_instance_states(repeat=settings.INSTANCE_POLL_INTERVAL, remove_existing_tasks=True)
+        sweep_expired_instances(repeat=settings.EXPIRY_SWEEP_INTERVAL, remove_existing_tasks=True)
+        ship_recording_chunks(repeat=settings.RECORDING_SHIP_INTERVAL, remove_existing_tasks=True)
+        render_live_thumbnails(repeat=settings.THUMBNAIL_REFRESH_INTERVAL, remove_existing_tasks=True)
+        if settings.GUEST_PORT_PROBE:
+            probe_guest_ports(repeat=settings.INSTANCE_POLL_INTERVAL, remove_existing_tasks=True)
+        self.stdout.write(self.style.SUCCESS("Scheduled warm pool refill, instance state polling, expiry sweep, recording shipping and thumbnails."))
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.8 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('dashboard', '0036_subtest_warm_pool_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarmInstance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ami_id', models.CharField(max_length=255)),
+                ('instance_id', models.CharField(max_length=100, unique=True)),
+                ('public_ip', models.CharField(blank=True, max_length=15, null=True)),
+                ('guacamole_connection_id', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('booting', 'Booting'), ('ready', 'Ready'), ('claimed', 'Claimed'), ('failed', 'Failed'), ('retired', 'Retired')], default='booting', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ready_at', models.DateTimeField(blank=True, null=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('sub_test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='warm_instances', to='dashboard.subtest')),
+                ('test_request', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='warm_instance', to='dashboard.testrequest')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ami_id', 'status', 'created_at'], name='provisionin_ami_id_7c6ebb_idx')],
+            },
+        ),
+    ]
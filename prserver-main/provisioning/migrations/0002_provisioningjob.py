@@ -0,0 +1,35 @@
+# Generated by Django 5.1.8 on 2026-10-18 10:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0036_subtest_warm_pool_size'),
+        ('provisioning', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisioningJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('windows', 'Windows test room'), ('linux', 'Linux test room'), ('custom', 'Custom image')], max_length=10)),
+                ('state', models.CharField(choices=[('requested', 'Requested'), ('launching', 'Launching'), ('running', 'Running'), ('credentials_ready', 'Credentials ready'), ('guac_registered', 'Guacamole registered'), ('ready', 'Ready'), ('failed', 'Failed')], default='requested', max_length=20)),
+                ('instance_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('public_ip', models.CharField(blank=True, max_length=15, null=True)),
+                ('guacamole_connection_id', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+                ('launching_at', models.DateTimeField(blank=True, null=True)),
+                ('running_at', models.DateTimeField(blank=True, null=True)),
+                ('credentials_ready_at', models.DateTimeField(blank=True, null=True)),
+                ('guac_registered_at', models.DateTimeField(blank=True, null=True)),
+                ('ready_at', models.DateTimeField(blank=True, null=True)),
+                ('failed_at', models.DateTimeField(blank=True, null=True)),
+                ('test_request', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='provisioning_job', to='dashboard.testrequest')),
+            ],
+        ),
+    ]
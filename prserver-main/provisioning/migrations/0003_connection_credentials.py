@@ -0,0 +1,23 @@
+# Generated by Django 5.1.8 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('provisioning', '0002_provisioningjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provisioningjob',
+            name='connection_credentials',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='warminstance',
+            name='connection_credentials',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.8 on 2026-10-18 11:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('provisioning', '0003_connection_credentials'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LaunchAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempt', models.PositiveSmallIntegerField()),
+                ('client_token', models.CharField(max_length=64, unique=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('launched', 'Launched'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('instance_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('launched_at', models.DateTimeField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='launch_attempts', to='provisioning.provisioningjob')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('job', 'attempt'), name='launchattempt_job_attempt_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('provisioning', '0004_launchattempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provisioningjob',
+            name='guest_ready_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
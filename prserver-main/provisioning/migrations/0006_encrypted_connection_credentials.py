@@ -0,0 +1,26 @@
+# Generated by Django 5.1.8 on 2026-10-18 16:05
+
+import provisioning.vault
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('provisioning', '0005_provisioningjob_guest_ready_at'),
+    ]
+
+    # Stored values were already Fernet tokens under RDP_ENCRYPTION_KEY, which stays readable
+    # as the only (or last) key in RDP_ENCRYPTION_KEYS, so no data migration is needed.
+    operations = [
+        migrations.AlterField(
+            model_name='provisioningjob',
+            name='connection_credentials',
+            field=provisioning.vault.EncryptedTextField(blank=True, default=''),
+        ),
+        migrations.AlterField(
+            model_name='warminstance',
+            name='connection_credentials',
+            field=provisioning.vault.EncryptedTextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,137 @@
+from django.db import models
+from django.utils.timezone import now
+from dashboard.models import TestRequest, SubTest
+from .vault import EncryptedTextField
+
+
+class WarmInstance(models.Model):
+    STATUS_CHOICES = [
+        ('booting', 'Booting'),
+        ('ready', 'Ready'),
+        ('claimed', 'Claimed'),
+        ('failed', 'Failed'),
+        ('retired', 'Retired'),
+    ]
+    # Instances that still count against the pool size and the global cap
+    LIVE_STATUSES = ('booting', 'ready')
+
+    sub_test = models.ForeignKey(SubTest, on_delete=models.CASCADE, related_name='warm_instances')
+    ami_id = models.CharField(max_length=255)
+    instance_id = models.CharField(max_length=100, unique=True)
+    public_ip = models.CharField(max_length=15, blank=True, null=True)
+    guacamole_connection_id = models.IntegerField(null=True, blank=True)
+    # Username/password as JSON, encrypted at rest (see provisioning.vault)
+    connection_credentials = EncryptedTextField(blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='booting')
+    test_request = models.OneToOneField(TestRequest, on_delete=models.SET_NULL, null=True, blank=True, related_name='warm_instance')
+    created_at = models.DateTimeField(auto_now_add=True)
+    ready_at = models.DateTimeField(null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ami_id', 'status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.instance_id} ({self.status})"
+
+
+class ProvisioningJob(models.Model):
+    STATE_CHOICES = [
+        ('requested', 'Requested'),
+        ('launching', 'Launching'),
+        ('running', 'Running'),
+        ('credentials_ready', 'Credentials ready'),
+        ('guac_registered', 'Guacamole registered'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+    # Happy-path order; each state has a matching <state>_at timestamp
+    PHASES = ('requested', 'launching', 'running', 'credentials_ready', 'guac_registered', 'ready')
+    KIND_CHOICES = [
+        ('windows', 'Windows test room'),
+        ('linux', 'Linux test room'),
+        ('custom', 'Custom image'),
+    ]
+    ROOM_URL_NAMES = {
+        'windows': 'windows_test_room',
+        'linux': 'test_room',
+        'custom': 'view_test_room',
+    }
+
+    test_request = models.OneToOneField(TestRequest, on_delete=models.CASCADE, related_name='provisioning_job')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='requested')
+    instance_id = models.CharField(max_length=100, blank=True, null=True)
+    public_ip = models.CharField(max_length=15, blank=True, null=True)
+    guacamole_connection_id = models.IntegerField(null=True, blank=True)
+    # Username/password as JSON, encrypted at rest (see provisioning.vault)
+    connection_credentials = EncryptedTextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    requested_at = models.DateTimeField(auto_now_add=True)
+    launching_at = models.DateTimeField(null=True, blank=True)
+    running_at = models.DateTimeField(null=True, blank=True)
+    credentials_ready_at = models.DateTimeField(null=True, blank=True)
+    guac_registered_at = models.DateTimeField(null=True, blank=True)
+    ready_at = models.DateTimeField(null=True, blank=True)
+    failed_at = models.DateTimeField(null=True, blank=True)
+    # When the instance's boot callback reported RDP/SSH up (see provisioning.callbacks)
+    guest_ready_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.test_request.public_id} ({self.state})"
+
+    @property
+    def is_finished(self):
+        return self.state in ('ready', 'failed')
+
+    def transition(self, state, **fields):
+        """Moves the job to `state`, stamping <state>_at, and saves it along with any extra fields."""
+        stamp = f"{state}_at"
+        setattr(self, stamp, now())
+        self.state = state
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.save(update_fields=['state', stamp, *fields])
+
+    def phase_timings(self):
+        """Seconds spent reaching each phase from the previous one, for the phases reached so far."""
+        timings = {}
+        previous = None
+        for phase in self.PHASES:
+            stamp = getattr(self, f"{phase}_at")
+            if stamp is None:
+                break
+            timings[phase] = round((stamp - previous).total_seconds(), 1) if previous else 0.0
+            previous = stamp
+        return timings
+
+
+class LaunchAttempt(models.Model):
+    """
+    Ledger of run_instances calls made for a provisioning job. Each attempt has a deterministic
+    EC2 ClientToken, so retrying it (or racing on it) returns the instance it already launched.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('launched', 'Launched'),
+        ('failed', 'Failed'),
+    ]
+
+    job = models.ForeignKey(ProvisioningJob, on_delete=models.CASCADE, related_name='launch_attempts')
+    attempt = models.PositiveSmallIntegerField()
+    client_token = models.CharField(max_length=64, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    instance_id = models.CharField(max_length=100, blank=True, null=True)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    launched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'attempt'], name='launchattempt_job_attempt_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.client_token} ({self.status})"
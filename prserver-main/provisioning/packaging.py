@@ -0,0 +1,69 @@
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .transcode import FFMPEG, TranscodeError
+from .uploader import upload_bytes
+
+
+logger = logging.getLogger(__name__)
+
+# Quality ladder reviewers switch between: (name, output height, video bitrate)
+HLS_RENDITIONS = (
+    ("720p", 720, "1500k"),
+    ("360p", 360, "400k"),
+)
+MASTER_PLAYLIST = "master.m3u8"
+CONTENT_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+
+
+def hls_prefix(public_id):
+    return f"recordings/hls/testid-{public_id}/"
+
+
+def package_hls(source, output_dir, segment_seconds=None):
+    """
+    Encodes an MP4 to H.264 HLS at every HLS_RENDITIONS height, cut into `segment_seconds`
+    segments that each start on a keyframe, so a player can start or seek anywhere by fetching
+    one small segment. Writes master.m3u8, <rendition>.m3u8 and <rendition>-NNNNN.ts to output_dir.
+    """
+    segment_seconds = segment_seconds or settings.HLS_SEGMENT_SECONDS
+    count = len(HLS_RENDITIONS)
+    graph = f"[0:v]split={count}" + "".join(f"[s{index}]" for index in range(count)) + ";" + ";".join(
+        f"[s{index}]scale=-2:{height}[v{index}]" for index, (_, height, _) in enumerate(HLS_RENDITIONS)
+    )
+    command = [FFMPEG, "-y", "-v", "error", "-i", source, "-filter_complex", graph]
+    for index, (_, _, bitrate) in enumerate(HLS_RENDITIONS):
+        command += ["-map", f"[v{index}]", f"-b:v:{index}", bitrate]
+    command += [
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})",
+        "-f", "hls", "-hls_time", str(segment_seconds), "-hls_playlist_type", "vod",
+        "-hls_segment_filename", os.path.join(output_dir, "%v-%05d.ts"),
+        "-master_pl_name", MASTER_PLAYLIST,
+        "-var_stream_map", " ".join(f"v:{index},name:{name}" for index, (name, _, _) in enumerate(HLS_RENDITIONS)),
+        os.path.join(output_dir, "%v.m3u8"),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise TranscodeError(f"ffmpeg could not package {source} as HLS: {result.stderr.strip()}")
+
+
+def upload_hls(output_dir, prefix, s3=None):
+    """
+    Uploads everything package_hls wrote under `prefix`, RECORDING_UPLOAD_CONCURRENCY files at
+    a time. Returns the playlists as {file name: text}, to be served without a trip to S3.
+    """
+    names = sorted(os.listdir(output_dir))
+
+    def send(name):
+        with open(os.path.join(output_dir, name), "rb") as f:
+            data = f.read()
+        upload_bytes(data, settings.RECORDINGS_BUCKET, f"{prefix}{name}", s3,
+                     ContentType=CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream"))
+        return name, data
+
+    with ThreadPoolExecutor(max_workers=settings.RECORDING_UPLOAD_CONCURRENCY) as pool:
+        uploaded = list(pool.map(send, names))
+    return {name: data.decode() for name, data in uploaded if name.endswith(".m3u8")}
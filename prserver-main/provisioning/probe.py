@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# What each OS's test room connects with
+PORTS = {
+    "windows": ("rdp", 3389),
+    "linux": ("ssh", 22),
+}
+
+# X.224 Connection Request carrying an RDP Negotiation Request for TLS/CredSSP, wrapped in TPKT
+RDP_CONNECTION_REQUEST = bytes.fromhex("030000130ee000000000000100080003000000")
+
+
+async def handshake(host, port, protocol, timeout):
+    """
+    One connect attempt. True once the service answers like RDP or SSH would, which a port
+    that merely accepts connections (or a half-started service) does not.
+    """
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        if protocol == "ssh":
+            banner = await asyncio.wait_for(reader.readline(), timeout)
+            return banner.startswith(b"SSH-")
+        writer.write(RDP_CONNECTION_REQUEST)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.readexactly(6), timeout)
+        # TPKT version 3, then an X.224 Connection Confirm
+        return response[0] == 3 and response[5] & 0xF0 == 0xD0
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        if writer:
+            writer.close()
+
+
+async def wait_until_ready(host, port, protocol, deadline, initial_delay=1.0, max_delay=15.0, timeout=3.0, semaphore=None):
+    """
+    Retries the handshake with exponential backoff until it succeeds or the monotonic `deadline`
+    passes. Returns whether the service came up in time. `semaphore` caps connects in flight.
+    """
+    delay = initial_delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if semaphore:
+            async with semaphore:
+                ready = await handshake(host, port, protocol, min(timeout, remaining))
+        else:
+            ready = await handshake(host, port, protocol, min(timeout, remaining))
+        if ready:
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+async def watch(targets, on_ready=None, concurrency=200, **backoff):
+    """
+    Probes every target concurrently on one event loop, with at most `concurrency` connects in
+    flight. `targets` maps a key to (host, port, protocol, deadline); `on_ready(key)` is run in a
+    worker thread as each one comes up. Returns {key: ready}.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(key, host, port, protocol, deadline):
+        ready = await wait_until_ready(host, port, protocol, deadline, semaphore=semaphore, **backoff)
+        if ready and on_ready:
+            await asyncio.to_thread(on_ready, key)
+        return key, ready
+
+    results = await asyncio.gather(*(probe(key, *target) for key, target in targets.items()))
+    return dict(results)
+
+
+def probe_targets(targets, on_ready=None, **options):
+    """Blocking entry point for watch(), for use from background tasks."""
+    if not targets:
+        return {}
+    return asyncio.run(watch(targets, on_ready, **options))
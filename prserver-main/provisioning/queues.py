@@ -0,0 +1,54 @@
+from background_task.models import Task
+from django.conf import settings
+from django.db.models import Count, Min
+from django.utils.timezone import now
+
+
+# Background task lanes. Workers pick due tasks by priority, so candidate-facing setup goes first,
+# then cleanup of instances that are still billing, then everything else, then session recording
+# processing, and AMI baking last.
+SETUP_QUEUE = "setup"
+CLEANUP_QUEUE = "cleanup"
+RECORDING_QUEUE = "recording"
+AMI_QUEUE = "ami"
+DEFAULT_QUEUE = "default"  # Also what tasks scheduled without a queue count as
+
+QUEUES = (SETUP_QUEUE, CLEANUP_QUEUE, DEFAULT_QUEUE, RECORDING_QUEUE, AMI_QUEUE)
+
+
+def lane(queue, schedule=0):
+    """
+    @background() arguments that put a task in `queue` with that queue's priority, e.g.
+    @background(**lane(SETUP_QUEUE)).
+    """
+    return {
+        "schedule": {"run_at": schedule, "priority": settings.TASK_QUEUE_PRIORITIES[queue]},
+        "queue": queue,
+    }
+
+
+def queue_metrics():
+    """
+    Per-queue depth and wait time, read from the task table so it covers every worker process:
+    tasks due and waiting, how long the oldest of them has waited, tasks scheduled for later
+    (including retries), and tasks currently locked by a worker.
+    """
+    current = now()
+    metrics = {}
+
+    def entry(queue):
+        return metrics.setdefault(queue or DEFAULT_QUEUE, {"waiting": 0, "oldest_wait_seconds": 0.0, "scheduled": 0, "running": 0})
+
+    for queue in QUEUES:
+        entry(queue)
+
+    unlocked = Task.objects.unlocked(current)
+    for row in unlocked.filter(run_at__lte=current).values("queue").annotate(count=Count("id"), oldest=Min("run_at")):
+        queue = entry(row["queue"])
+        queue["waiting"] += row["count"]
+        queue["oldest_wait_seconds"] = max(queue["oldest_wait_seconds"], round((current - row["oldest"]).total_seconds(), 1))
+    for row in unlocked.filter(run_at__gt=current).values("queue").annotate(count=Count("id")):
+        entry(row["queue"])["scheduled"] += row["count"]
+    for row in Task.objects.locked(current).values("queue").annotate(count=Count("id")):
+        entry(row["queue"])["running"] += row["count"]
+    return metrics
@@ -0,0 +1,109 @@
+import logging
+import uuid
+from datetime import timedelta
+from django.utils.timezone import now
+from dashboard.models import TestRequest
+from linux_test_rooms.models import LinuxTestInstance
+from windows_test_rooms.models import WindowsTestInstance
+from .models import ProvisioningJob, WarmInstance
+from .tasks import LIVE_INSTANCE_STATUSES
+from .utils import ec2, terminate_instance_batch, TERMINATE_BATCH_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+# describe_instances returns at most 1000 instances per page
+DESCRIBE_PAGE_SIZE = 1000
+
+# States in which a leaked instance is still (or may again be) billing
+BILLABLE_STATES = ["pending", "running", "stopping", "stopped"]
+
+
+def tagged_instances():
+    """
+    Every billable instance carrying a TestID tag, as {instance_id: (test_id, state, launch_time)}.
+    Pages of DESCRIBE_PAGE_SIZE, so a few thousand instances take only a handful of calls.
+    """
+    instances = {}
+    paginator = ec2.get_paginator("describe_instances")
+    pages = paginator.paginate(
+        Filters=[
+            {"Name": "tag-key", "Values": ["TestID"]},
+            {"Name": "instance-state-name", "Values": BILLABLE_STATES},
+        ],
+        PaginationConfig={"PageSize": DESCRIBE_PAGE_SIZE},
+    )
+    for page in pages:
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+                instances[instance["InstanceId"]] = (tags.get("TestID"), instance["State"]["Name"], instance["LaunchTime"])
+    return instances
+
+
+def owned_instance_ids(instance_ids):
+    """The subset of instance_ids that some database row still considers in use."""
+    instance_ids = list(instance_ids)
+    owned = set()
+    for start in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+        chunk = instance_ids[start:start + TERMINATE_BATCH_SIZE]
+        for queryset in (
+            WindowsTestInstance.objects.filter(instance_id__in=chunk, status__in=LIVE_INSTANCE_STATUSES),
+            LinuxTestInstance.objects.filter(instance_id__in=chunk, status__in=LIVE_INSTANCE_STATUSES),
+            # Custom image rooms only have the TestRequest, marked running while in use
+            TestRequest.objects.filter(instance_id__in=chunk, status="running"),
+            # Rooms still being provisioned have no room record yet
+            ProvisioningJob.objects.filter(instance_id__in=chunk).exclude(state__in=("ready", "failed")),
+            WarmInstance.objects.filter(instance_id__in=chunk, status__in=WarmInstance.LIVE_STATUSES),
+        ):
+            owned.update(queryset.values_list("instance_id", flat=True))
+    return owned
+
+
+def find_orphans(min_age):
+    """
+    Tagged instances no database row points to, launched more than `min_age` seconds ago
+    (younger ones may belong to a launch that hasn't recorded its instance yet).
+    Returns a list of dicts describing each orphan.
+    """
+    instances = tagged_instances()
+    owned = owned_instance_ids(instances)
+    test_ids = {parse_test_id(test_id) for test_id, _, _ in instances.values()} - {None}
+    known_test_ids = set(TestRequest.objects.filter(public_id__in=test_ids).values_list("public_id", flat=True))
+
+    cutoff = now() - timedelta(seconds=min_age)
+    orphans = []
+    for instance_id, (test_id, state, launch_time) in sorted(instances.items(), key=lambda item: item[1][2]):
+        if instance_id in owned or launch_time > cutoff:
+            continue
+        orphans.append({
+            "instance_id": instance_id,
+            "test_id": test_id,
+            "state": state,
+            "launch_time": launch_time,
+            "reason": "room no longer in use" if parse_test_id(test_id) in known_test_ids else "no matching TestRequest",
+        })
+    return orphans
+
+
+def terminate_orphans(orphans):
+    """Terminates the given orphans, TERMINATE_BATCH_SIZE per call. Returns how many were terminated."""
+    instance_ids = [orphan["instance_id"] for orphan in orphans]
+    terminated = 0
+    for start in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+        batch = instance_ids[start:start + TERMINATE_BATCH_SIZE]
+        try:
+            terminate_instance_batch(batch)
+            terminated += len(batch)
+        except Exception as e:
+            logger.error(f"Failed to terminate {len(batch)} orphaned instance(s): {e}")
+    if terminated:
+        logger.warning(f"Terminated {terminated} orphaned TestID-tagged instance(s).")
+    return terminated
+
+
+def parse_test_id(value):
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import tempfile
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.utils.timezone import now
+from dashboard.models import TestRequest
+from video_playback.models import RecordedSession
+from .packaging import hls_prefix, package_hls, upload_hls
+from .scrubbing import discard_states, keyframe_index, keyframes_key, render_sheets, sheet_key, sheet_seconds
+from .shipping import ship_chunks
+from .transcode import EmptyRecordingError, TranscodeError, transcode
+from .uploader import UploadVerificationError, upload_bytes, upload_file
+
+
+logger = logging.getLogger(__name__)
+
+
+def recording_path(public_id):
+    """Where guacd writes the room's raw session recording."""
+    return os.path.join(settings.RECORDINGS_DIR, f"testid-{public_id}")
+
+
+def recording_key(public_id):
+    return f"recordings/testid-{public_id}.mp4"
+
+
+def set_session_status(public_id, status, **fields):
+    RecordedSession.objects.update_or_create(
+        test_id=str(public_id), defaults={"status": status, **fields}, create_defaults={"status": status, "video_path": "", **fields}
+    )
+
+
+def transcode_recording(public_id):
+    """
+    Converts the room's Guacamole recording to testid-<public_id>.mp4 next to it, recording
+    per-segment progress on its RecordedSession. Returns whether it succeeded.
+    """
+    source = recording_path(public_id)
+    if not os.path.exists(source):
+        logger.error(f"No recording found at {source} for test_id {public_id}")
+        return False
+
+    def on_progress(done, total):
+        RecordedSession.objects.filter(test_id=str(public_id)).update(segments_done=done, segments_total=total)
+
+    set_session_status(public_id, "transcoding", segments_done=0, segments_total=0)
+    try:
+        segments = transcode(source, f"{source}.mp4", on_progress=on_progress)
+    except EmptyRecordingError as e:
+        # Nothing to transcode or retry: the session was opened but nothing was drawn
+        logger.warning(f"Not transcoding the recording of test_id {public_id}: {e}")
+        set_session_status(public_id, "empty")
+        return False
+    except (OSError, TranscodeError) as e:
+        logger.error(f"Transcoding failed for test_id {public_id}: {e}")
+        set_session_status(public_id, "failed")
+        return False
+    logger.info(f"Transcoded recording for test_id {public_id} in {segments} segment(s)")
+    return True
+
+
+def upload_recording_to_s3(public_id):
+    """
+    Uploads the room's transcoded session recording from the shared recordings volume and records
+    its path on the TestRequest. Safe to retry: a failed upload resumes where it stopped.
+    """
+    path = f"{recording_path(public_id)}.mp4"
+    if not os.path.exists(path):
+        logger.error(f"No transcoded recording found at {path} for test_id {public_id}")
+        return False
+
+    key = recording_key(public_id)
+    set_session_status(public_id, "uploading")
+    try:
+        upload_file(path, settings.RECORDINGS_BUCKET, key)
+    except (BotoCoreError, ClientError, OSError, UploadVerificationError) as e:
+        logger.error(f"Recording upload failed for test_id {public_id}: {e}")
+        set_session_status(public_id, "failed")
+        return False
+
+    set_session_status(public_id, "ready", video_path=key)
+    updated = TestRequest.objects.filter(public_id=public_id).update(recorded_session=key)
+    if not updated:
+        logger.error(f"TestRequest with test_id {public_id} not found. Could not update recorded session.")
+    return True
+
+
+def package_recording(public_id):
+    """Packages the room's transcoded recording as HLS, uploads it and stores its playlists on the RecordedSession."""
+    with tempfile.TemporaryDirectory(prefix="hls-") as workdir:
+        try:
+            package_hls(f"{recording_path(public_id)}.mp4", workdir)
+            playlists = upload_hls(workdir, hls_prefix(public_id))
+        except (BotoCoreError, ClientError, OSError, TranscodeError) as e:
+            logger.error(f"HLS packaging failed for test_id {public_id}: {e}")
+            return False
+    RecordedSession.objects.filter(test_id=str(public_id)).update(hls_playlists=playlists)
+    return True
+
+
+def update_thumbnails(public_id, final=False):
+    """
+    Renders and uploads the room's thumbnail sprite sheets not made yet. While the session runs
+    only sheets whose time span has fully passed are made; `final` adds the last, partial one.
+    Each run picks the recording up where the last one stopped. Returns how many sheets were added.
+    """
+    source = recording_path(public_id)
+    if not os.path.exists(source):
+        return 0
+    session, _ = RecordedSession.objects.get_or_create(test_id=str(public_id), defaults={"video_path": ""})
+    first_sheet = max(session.thumbnail_sheets, default=-1) + 1
+    # Skip parsing the recording until enough time has passed for another sheet to be complete
+    if not final and (now() - session.created_at).total_seconds() < (first_sheet + 1) * sheet_seconds():
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix="thumbnails-") as workdir:
+        try:
+            sheets, resume = render_sheets(source, workdir, first_sheet, final, resume=session.thumbnail_resume)
+            for index, path in sorted(sheets.items()):
+                with open(path, "rb") as f:
+                    upload_bytes(f.read(), settings.RECORDINGS_BUCKET, sheet_key(public_id, index), ContentType="image/jpeg")
+        except (BotoCoreError, ClientError, OSError, TranscodeError) as e:
+            logger.error(f"Rendering thumbnails failed for test_id {public_id}: {e}")
+            return 0
+    RecordedSession.objects.filter(id=session.id).update(
+        thumbnail_sheets=sorted(set(session.thumbnail_sheets) | set(sheets)), thumbnail_resume=resume or {}
+    )
+    discard_states(source, keep=resume and resume["offset"])
+    return len(sheets)
+
+
+def index_keyframes(public_id):
+    """Builds the keyframe index of the room's MP4, uploads it next to the MP4 and stores it on the RecordedSession."""
+    try:
+        index = keyframe_index(f"{recording_path(public_id)}.mp4")
+        upload_bytes(json.dumps(index).encode(), settings.RECORDINGS_BUCKET, keyframes_key(public_id),
+                     ContentType="application/json")
+    except (BotoCoreError, ClientError, OSError, TranscodeError) as e:
+        logger.error(f"Indexing keyframes failed for test_id {public_id}: {e}")
+        return False
+    RecordedSession.objects.filter(test_id=str(public_id)).update(keyframes=index)
+    return True
+
+
+def ship_live_recordings(public_ids):
+    """Ships the whole chunks the given rooms' recordings have grown by since the last run."""
+    sent = 0
+    for public_id in public_ids:
+        try:
+            sent += ship_chunks(public_id, recording_path(public_id))
+        except (BotoCoreError, ClientError, OSError) as e:
+            logger.error(f"Shipping recording chunks failed for test_id {public_id}: {e}")
+    return sent
+
+
+def process_recording(public_id):
+    """
+    Ships what is left of a finished room's raw recording (the last chunk and the manifest),
+    then transcodes it and uploads the MP4. The MP4 can be played as soon as it is up; its
+    keyframe index and the last thumbnails follow, then the HLS renditions, which replace it in
+    the player once they are ready.
+    """
+    try:
+        ship_chunks(public_id, recording_path(public_id), final=True)
+    except (BotoCoreError, ClientError, OSError) as e:
+        # The raw copy is a backup; the MP4 can still be made from the local file
+        logger.error(f"Shipping the last recording chunk failed for test_id {public_id}: {e}")
+    if not transcode_recording(public_id):
+        return False
+    if not upload_recording_to_s3(public_id):
+        logger.warning(f"Recording upload for test_id {public_id} failed.")
+        return False
+    logger.info(f"Recording for test_id {public_id} uploaded successfully.")
+    index_keyframes(public_id)
+    update_thumbnails(public_id, final=True)
+    package_recording(public_id)
+    return True
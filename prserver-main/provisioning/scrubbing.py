@@ -0,0 +1,170 @@
+import glob
+import logging
+import mmap
+import os
+import re
+import shutil
+import subprocess
+from django.conf import settings
+from .transcode import FFMPEG, SegmentWriter, TranscodeError, encode_segment, plan_segments
+
+
+logger = logging.getLogger(__name__)
+
+FFPROBE = "ffprobe"
+
+# Sprite sheet layout: each sheet covers THUMBNAIL_INTERVAL * SHEET_COLUMNS * SHEET_ROWS seconds
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_HEIGHT = 90
+SHEET_COLUMNS = 10
+SHEET_ROWS = 10
+SHEET_NAME = re.compile(r"^sheet-(\d{4})\.jpg$")
+
+# Keyframes closer together than this are left out of the index
+KEYFRAME_INDEX_SPACING = 1.0
+
+
+def thumbnail_prefix(public_id):
+    return f"recordings/thumbnails/testid-{public_id}/"
+
+
+def sheet_key(public_id, index):
+    return f"{thumbnail_prefix(public_id)}sheet-{index:04d}.jpg"
+
+
+def keyframes_key(public_id):
+    """The keyframe index sits next to the MP4 it indexes."""
+    return f"recordings/testid-{public_id}.keyframes.json"
+
+
+def sheet_seconds(interval=None):
+    return (interval or settings.THUMBNAIL_INTERVAL) * SHEET_COLUMNS * SHEET_ROWS
+
+
+def state_path(source, offset):
+    """Where a thumbnail run saves the recording's display state as it stands at byte `offset`."""
+    return f"{source}.thumbnails-{offset}"
+
+
+def discard_states(source, keep=None):
+    """Deletes the display states saved for `source` other than the one at offset `keep`."""
+    for path in glob.glob(f"{glob.escape(source)}.thumbnails-*"):
+        if path != state_path(source, keep):
+            os.unlink(path)
+
+
+def render_sheets(source, workdir, first_sheet=0, final=False, interval=None, resume=None):
+    """
+    Renders the thumbnail sprite sheets of a Guacamole recording from sheet `first_sheet` on:
+    one frame every `interval` seconds, SHEET_COLUMNS x SHEET_ROWS to a sheet. Only sheets whose
+    time span the recording has fully passed are rendered unless `final`, so a recording that is
+    still growing can be processed again later without redoing or changing any sheet.
+
+    Each sheet's time span is cut out of the recording with the transcoder's segmenting and
+    rendered by guacenc at thumbnail size. A run that stops short of the end saves the display
+    state at the first sheet it left out (see state_path) and returns where that is as `resume`,
+    {"offset": recording byte offset, "origin": first sync timestamp}; passing it to the next run
+    makes that run parse the saved state and the bytes from the offset on, not the whole
+    recording. Returns ({sheet index: path}, resume), resume being None once `final`.
+    """
+    interval = interval or settings.THUMBNAIL_INTERVAL
+    span = sheet_seconds(interval)
+    if not resume or (resume["offset"] and not os.path.exists(state_path(source, resume["offset"]))):
+        resume = {"offset": 0, "origin": None}
+
+    # What this run parses: the display state saved at the resume offset, then the recording from there on
+    parsed = os.path.join(workdir, "recording.guac")
+    with open(parsed, "wb") as out:
+        if resume["offset"]:
+            with open(state_path(source, resume["offset"]), "rb") as f:
+                shutil.copyfileobj(f, out)
+        prefix = out.tell()
+        with open(source, "rb") as f:
+            f.seek(resume["offset"])
+            shutil.copyfileobj(f, out)
+        if not out.tell():
+            return {}, resume
+
+    next_resume = None
+    with open(parsed, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        boundaries, syncs = plan_segments(data, span, resume["origin"])
+        if not boundaries:
+            return {}, resume
+        timestamps = {offset: timestamp for offset, _, timestamp in syncs}
+        first = syncs[0][2] if resume["origin"] is None else resume["origin"]
+        writer = SegmentWriter(data, boundaries, syncs)
+
+        for index, start in enumerate(boundaries):
+            sheet = (timestamps[start] - first) // (span * 1000)
+            if index + 1 < len(boundaries):
+                # Every sheet up to the span the next segment starts in is complete
+                count = (timestamps[boundaries[index + 1]] - first) // (span * 1000) - sheet
+            elif final:
+                count = None
+            else:
+                # Saved states never hold a sync, so every boundary lies in the recording's own bytes
+                next_resume = {"offset": resume["offset"] + start - prefix, "origin": first}
+                writer.advance(start)
+                with open(state_path(source, next_resume["offset"]), "wb") as state:
+                    writer.state.write_to(state)
+                break
+            if count is not None and sheet + count <= first_sheet:
+                continue
+
+            path = os.path.join(workdir, f"thumbnails-{sheet:04d}.guac")
+            writer.write(path, index)
+            video = encode_segment(path, f"{THUMBNAIL_WIDTH * 2}x{THUMBNAIL_HEIGHT * 2}", 500000)
+            # The segment starts at its first frame, which may come after the sheet's start time
+            lead = (timestamps[start] - first - sheet * span * 1000) / 1000
+            tile(video, workdir, sheet, count, lead, interval)
+            os.unlink(path)
+            os.unlink(video)
+
+    sheets = {}
+    for name in os.listdir(workdir):
+        match = SHEET_NAME.match(name)
+        if match and int(match.group(1)) >= first_sheet:
+            sheets[int(match.group(1))] = os.path.join(workdir, name)
+    return sheets, next_resume
+
+
+def tile(video, workdir, first_sheet, count, lead, interval):
+    """Samples `video` every `interval` seconds into sheet-NNNN.jpg sprite sheets numbered from `first_sheet`."""
+    filters = (
+        f"tpad=start_duration={lead:.3f}:start_mode=clone,fps=1/{interval},"
+        f"scale={THUMBNAIL_WIDTH}:{THUMBNAIL_HEIGHT},tile={SHEET_COLUMNS}x{SHEET_ROWS}"
+    )
+    command = [FFMPEG, "-y", "-v", "error", "-i", video, "-vf", filters, "-q:v", "5", "-start_number", str(first_sheet)]
+    if count is not None:
+        command += ["-frames:v", str(count)]
+    command.append(os.path.join(workdir, "sheet-%04d.jpg"))
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise TranscodeError(f"ffmpeg could not render thumbnails from {video}: {result.stderr.strip()}")
+
+
+def keyframe_index(video):
+    """
+    Maps time to byte offset in an MP4: the position of each video keyframe at least
+    KEYFRAME_INDEX_SPACING apart, so a player can fetch the byte range from the keyframe before
+    any point in time. Delta-encoded to keep it small: {"times": [ms, ...], "offsets": [bytes, ...]}.
+    """
+    command = [FFPROBE, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,pos,flags",
+               "-of", "csv=p=0", video]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise TranscodeError(f"ffprobe could not read keyframes from {video}: {result.stderr.strip()}")
+
+    times, offsets = [], []
+    last_time = last_offset = 0
+    for line in result.stdout.splitlines():
+        pts_time, pos, flags = line.split(",")[:3]
+        if "K" not in flags or pts_time == "N/A" or pos == "N/A":
+            continue
+        time_ms, offset = round(float(pts_time) * 1000), int(pos)
+        if times and time_ms - last_time < KEYFRAME_INDEX_SPACING * 1000:
+            continue
+        times.append(time_ms - last_time)
+        offsets.append(offset - last_offset)
+        last_time, last_offset = time_ms, offset
+    return {"times": times, "offsets": offsets}
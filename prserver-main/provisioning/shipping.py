@@ -0,0 +1,62 @@
+import json
+import logging
+import os
+from django.conf import settings
+from video_playback.models import RecordedSession
+from .uploader import MB, upload_bytes
+
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_prefix(public_id):
+    return f"recordings/live/testid-{public_id}/"
+
+
+def chunk_key(public_id, index):
+    return f"{chunk_prefix(public_id)}chunk-{index:06d}"
+
+
+def manifest_key(public_id):
+    return f"{chunk_prefix(public_id)}manifest.json"
+
+
+def ship_chunks(public_id, path, final=False, chunk_size=None, s3=None):
+    """
+    Copies the part of a room's raw recording that isn't in S3 yet, in chunks of
+    RECORDING_CHUNK_SIZE MB. guacd only ever appends, so a whole chunk never changes once
+    written; while the session runs only whole chunks are sent. With `final`, the partial
+    last chunk follows, then a manifest listing every chunk. Returns how many chunks were sent.
+    """
+    if not os.path.exists(path):
+        return 0
+    chunk_size = chunk_size or settings.RECORDING_CHUNK_SIZE * MB
+    session, _ = RecordedSession.objects.get_or_create(test_id=str(public_id), defaults={"video_path": ""})
+    shipped, chunks = session.shipped_bytes, list(session.chunks)
+    size = os.path.getsize(path)
+
+    sent = 0
+    with open(path, "rb") as f:
+        f.seek(shipped)
+        while size - shipped >= chunk_size or (final and shipped < size):
+            data = f.read(min(chunk_size, size - shipped))
+            checksum = upload_bytes(data, settings.RECORDINGS_BUCKET, chunk_key(public_id, len(chunks)), s3)
+            chunks.append({"size": len(data), "sha256": checksum})
+            # Conditional on the offset this run started from, so two runs never record a chunk twice
+            updated = RecordedSession.objects.filter(id=session.id, shipped_bytes=shipped).update(
+                shipped_bytes=shipped + len(data), chunks=chunks
+            )
+            if not updated:
+                logger.info(f"Recording for test_id {public_id} is being shipped by another worker")
+                return sent
+            shipped += len(data)
+            sent += 1
+
+    if final:
+        manifest = {
+            "test_id": str(public_id),
+            "size": shipped,
+            "chunks": [{"key": chunk_key(public_id, index), **chunk} for index, chunk in enumerate(chunks)],
+        }
+        upload_bytes(json.dumps(manifest).encode(), settings.RECORDINGS_BUCKET, manifest_key(public_id), s3)
+    return sent
@@ -0,0 +1,34 @@
+document.addEventListener("DOMContentLoaded", () => {
+    const statusUrl = document.body.dataset.statusUrl;
+    const roomUrl = document.body.dataset.roomUrl;
+    const stateElement = document.getElementById("provisioning-state");
+    const errorElement = document.getElementById("provisioning-error");
+    const stateLabels = {
+        requested: "Queued",
+        launching: "Starting machine",
+        running: "Machine is up, preparing access",
+        credentials_ready: "Connecting",
+        guac_registered: "Almost ready",
+        ready: "Ready",
+    };
+
+    function poll() {
+        fetch(statusUrl, { credentials: "same-origin" })
+            .then((response) => response.json())
+            .then((status) => {
+                if (status.ready) {
+                    window.location.href = roomUrl;
+                    return;
+                }
+                if (status.failed) {
+                    stateElement.style.display = "none";
+                    errorElement.style.display = "block";
+                    return;
+                }
+                stateElement.innerText = stateLabels[status.state] || status.state;
+                setTimeout(poll, 3000);
+            })
+            .catch(() => setTimeout(poll, 5000));
+    }
+    poll();
+});
@@ -0,0 +1,443 @@
+import logging
+import time
+from datetime import timedelta
+from background_task import background
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from dashboard.models import SubTest, TestRequest
+from linux_test_rooms.models import LinuxTestInstance
+from windows_test_rooms.models import WindowsTestInstance
+from .drivers import CredentialsNotReady, fetch_credentials, get_driver, instance_public_ip
+from .jobs import (
+    job_os_type, launch_job_instance, fetch_job_credentials,
+    register_job_connection, guest_ready_deadline, mark_guest_ready, finalize_job, fail_job,
+)
+from . import guac_db, probe
+from .models import WarmInstance, ProvisioningJob
+from .queues import lane, SETUP_QUEUE, CLEANUP_QUEUE, DEFAULT_QUEUE, RECORDING_QUEUE
+from .recordings import process_recording, ship_live_recordings, update_thumbnails
+from .utils import (
+    ec2, launch_warm_instances, describe_instance_states, dump_credentials,
+    terminate_instance_batch, TERMINATE_BATCH_SIZE,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# EC2 states an instance never comes back from
+DEAD_STATES = ("shutting-down", "terminated", "stopping", "stopped")
+
+# Test room instance records in use by a candidate
+ACTIVE_INSTANCE_STATUSES = ("pending", "running")
+# Test room instance records that may still have a running EC2 instance behind them, including
+# expired ones the sweeper has queued for grading ("grading") or is about to terminate ("graded")
+LIVE_INSTANCE_STATUSES = (*ACTIVE_INSTANCE_STATUSES, "grading", "graded")
+
+
+@background(**lane(SETUP_QUEUE))
+def run_provisioning_job(job_id):
+    """
+    Drives a provisioning job from its current state through to ready (or failed).
+    Each phase is resumable, so a re-run after a worker restart picks up where it stopped.
+    """
+    try:
+        job = ProvisioningJob.objects.select_related("test_request").get(id=job_id)
+    except ProvisioningJob.DoesNotExist:
+        logger.error(f"Provisioning job {job_id} not found. Skipping.")
+        return
+    if job.is_finished:
+        return
+
+    try:
+        sub_test = job.test_request.sub_tests.first()
+        if not sub_test or not sub_test.ami_id:
+            raise Exception("No valid AMI ID found for the selected SubTest.")
+        os_type = job_os_type(job, sub_test)
+
+        if job.state == "requested":
+            launch_job_instance(job, sub_test)
+        if job.state == "launching":
+            # poll_instance_states moves the job on and re-queues it once EC2 reports it running
+            return
+        if job.state in ("running", "credentials_ready"):
+            credentials = fetch_job_credentials(job, os_type)
+            register_job_connection(job, os_type, credentials)
+        if job.state == "guac_registered":
+            deadline = guest_ready_deadline(job)
+            if deadline:
+                # The guest_ready callback re-queues the job; this run is the fallback if it never comes
+                run_provisioning_job(job.id, schedule=deadline)
+                return
+            finalize_job(job, sub_test)
+    except CredentialsNotReady as e:
+        if credentials_overdue(job.running_at):
+            fail_job(job, e)
+        else:
+            # Free the worker thread instead of sleeping; the job resumes from the same state
+            run_provisioning_job(job.id, schedule=settings.CREDENTIALS_RETRY_DELAY)
+    except Exception as e:
+        fail_job(job, e)
+
+
+def credentials_overdue(since):
+    return since is None or since < now() - timedelta(seconds=settings.CREDENTIALS_TIMEOUT)
+
+
+@background(**lane(SETUP_QUEUE))
+def poll_instance_states():
+    """
+    Checks every instance that is still booting with one batched describe_instances pass,
+    records the public IP of those now running and re-queues their setup.
+    Instances that died or overran INSTANCE_BOOT_TIMEOUT are failed and cleaned up.
+    """
+    jobs = {
+        job.instance_id: job
+        for job in ProvisioningJob.objects.select_related("test_request").filter(state="launching", instance_id__isnull=False)
+    }
+    warm_instances = {
+        warm_instance.instance_id: warm_instance
+        for warm_instance in WarmInstance.objects.filter(status="booting", public_ip__isnull=True)
+    }
+    if not jobs and not warm_instances:
+        return
+
+    try:
+        states = describe_instance_states([*jobs, *warm_instances])
+    except Exception as e:
+        logger.error(f"Failed to describe {len(jobs) + len(warm_instances)} pending instance(s): {e}")
+        return
+
+    deadline = now() - timedelta(seconds=settings.INSTANCE_BOOT_TIMEOUT)
+
+    for instance_id, job in jobs.items():
+        state, public_ip = states.get(instance_id, (None, None))
+        if state == "running" and public_ip:
+            advanced = ProvisioningJob.objects.filter(id=job.id, state="launching").update(
+                state="running", running_at=now(), public_ip=public_ip
+            )
+            if advanced:
+                logger.info(f"Instance {instance_id} is running with IP {public_ip}")
+                run_provisioning_job(job.id)
+        elif state in DEAD_STATES or job.launching_at < deadline:
+            fail_job(job, f"Instance {instance_id} did not become ready (state: {state}).")
+
+    for instance_id, warm_instance in warm_instances.items():
+        state, public_ip = states.get(instance_id, (None, None))
+        if state == "running" and public_ip:
+            advanced = WarmInstance.objects.filter(id=warm_instance.id, status="booting", public_ip__isnull=True).update(
+                public_ip=public_ip
+            )
+            if advanced:
+                prepare_warm_instance(warm_instance.id)
+        elif state in DEAD_STATES or warm_instance.created_at < deadline:
+            logger.error(f"Warm instance {instance_id} did not become ready (state: {state}). Terminating.")
+            WarmInstance.objects.filter(id=warm_instance.id, status="booting").update(status="failed")
+            try:
+                ec2.terminate_instances(InstanceIds=[instance_id])
+            except Exception as e:
+                logger.error(f"Failed to terminate warm instance {instance_id}: {e}")
+
+
+@background(**lane(SETUP_QUEUE))
+def probe_guest_ports():
+    """
+    Watches the RDP or SSH port of every running job whose guest hasn't reported ready, all on one
+    event loop, for up to GUEST_PROBE_WINDOW seconds. Jobs whose service answers are marked ready
+    as soon as it does; the rest are picked up again by the next run.
+    """
+    jobs = (
+        ProvisioningJob.objects.select_related("test_request")
+        .filter(state__in=("running", "credentials_ready", "guac_registered"), guest_ready_at__isnull=True)
+        .exclude(public_ip__isnull=True)
+    )
+    targets = {}
+    window_end = time.monotonic() + settings.GUEST_PROBE_WINDOW
+    for job in jobs:
+        try:
+            deadline = guest_ready_deadline(job)
+            if not deadline:
+                continue
+            sub_test = job.test_request.sub_tests.first()
+            if sub_test is None:
+                logger.warning(f"Provisioning job {job.id} has no sub-test; not probing its guest")
+                continue
+            protocol, port = probe.PORTS[job_os_type(job, sub_test)]
+        except Exception as e:
+            # One bad row must not stop every other guest from being probed
+            logger.error(f"Could not work out which port to probe for provisioning job {job.id}: {e}")
+            continue
+        targets[job.id] = (job.public_ip, port, protocol, min(window_end, time.monotonic() + (deadline - now()).total_seconds()))
+    if not targets:
+        return
+
+    def on_ready(job_id):
+        try:
+            if mark_guest_ready(job_id):
+                logger.info(f"Guest port of provisioning job {job_id} is answering")
+        finally:
+            connection.close()
+
+    results = probe.probe_targets(targets, on_ready)
+    logger.info(f"Probed {len(results)} booting guest(s); {sum(results.values())} answered")
+
+
+@background(**lane(DEFAULT_QUEUE))
+def refill_warm_pools():
+    """
+    Tops every SubTest's warm pool back up to its warm_pool_size,
+    never letting the number of live warm instances exceed WARM_POOL_GLOBAL_CAP.
+    """
+    retire_stale_warm_instances()
+
+    live = WarmInstance.objects.filter(status__in=WarmInstance.LIVE_STATUSES)
+    total_live = live.count()
+    sub_tests = SubTest.objects.filter(warm_pool_size__gt=0).exclude(ami_id__isnull=True).exclude(ami_id="")
+
+    for sub_test in sub_tests:
+        deficit = sub_test.warm_pool_size - live.filter(sub_test=sub_test).count()
+        headroom = settings.WARM_POOL_GLOBAL_CAP - total_live
+        to_launch = min(deficit, headroom)
+        if headroom <= 0:
+            logger.warning(f"Warm pool global cap of {settings.WARM_POOL_GLOBAL_CAP} reached; not refilling further.")
+            break
+        if to_launch <= 0:
+            continue
+
+        try:
+            warm_instances = launch_warm_instances(sub_test, to_launch)
+        except Exception as e:
+            logger.error(f"Failed to launch warm instances for SubTest {sub_test.id}: {e}")
+            continue
+
+        total_live += len(warm_instances)
+
+
+@background(**lane(DEFAULT_QUEUE))
+def prepare_warm_instance(warm_instance_id):
+    """Fetches credentials for a warm instance that has come up and registers it with Guacamole (or keeps them, for JSON auth)."""
+    try:
+        warm_instance = WarmInstance.objects.select_related("sub_test").get(id=warm_instance_id, status="booting")
+    except WarmInstance.DoesNotExist:
+        logger.warning(f"Warm instance {warm_instance_id} is no longer booting. Skipping setup.")
+        return
+
+    instance_id = warm_instance.instance_id
+    public_ip = warm_instance.public_ip
+    os_type = warm_instance.sub_test.os_type.lower()
+    try:
+        try:
+            credentials = fetch_credentials(os_type, instance_id, public_ip)
+        except CredentialsNotReady:
+            if credentials_overdue(warm_instance.created_at):
+                raise
+            prepare_warm_instance(warm_instance_id, schedule=settings.CREDENTIALS_RETRY_DELAY)
+            return
+
+        if settings.GUAC_CONNECTION_BACKEND == "json":
+            connection = {"connection_credentials": dump_credentials(credentials)}
+        else:
+            connection_id = guac_db.add_connection(instance_id, os_type, credentials, f"warm-{warm_instance_id}")
+            connection = {"guacamole_connection_id": connection_id}
+
+        WarmInstance.objects.filter(id=warm_instance_id, status="booting").update(
+            status="ready",
+            ready_at=now(),
+            **connection,
+        )
+        logger.info(f"Warm instance {instance_id} is ready for SubTest {warm_instance.sub_test_id}")
+    except Exception as e:
+        logger.error(f"Warm instance {instance_id} failed setup: {e}. Terminating.")
+        WarmInstance.objects.filter(id=warm_instance_id).update(status="failed")
+        try:
+            ec2.terminate_instances(InstanceIds=[instance_id])
+        except Exception as terminate_error:
+            logger.error(f"Failed to terminate warm instance {instance_id}: {terminate_error}")
+
+
+def retire_stale_warm_instances():
+    """
+    Terminates ready warm instances that can no longer be handed out: their SubTest
+    moved to a new AMI, or the pool was shrunk below what is currently held.
+    """
+    stale = []
+    for sub_test in SubTest.objects.filter(warm_instances__status="ready").distinct():
+        ready = list(sub_test.warm_instances.filter(status="ready").order_by("-created_at"))
+        outdated = [w for w in ready if w.ami_id != sub_test.ami_id]
+        current = [w for w in ready if w.ami_id == sub_test.ami_id]
+        stale.extend(outdated)
+        stale.extend(current[sub_test.warm_pool_size:])
+
+    if not stale:
+        return
+
+    # Only terminate what this pass actually flipped; a candidate may have claimed one meanwhile.
+    stale_ids = [w.id for w in stale]
+    WarmInstance.objects.filter(id__in=stale_ids, status="ready").update(status="retired")
+    retired = list(WarmInstance.objects.filter(id__in=stale_ids, status="retired"))
+    if not retired:
+        return
+
+    logger.info(f"Retiring {len(retired)} stale warm instance(s).")
+    try:
+        ec2.terminate_instances(InstanceIds=[w.instance_id for w in retired])
+    except Exception as e:
+        logger.error(f"Failed to terminate stale warm instances: {e}")
+    for warm_instance in retired:
+        if warm_instance.guacamole_connection_id:
+            guac_db.remove_connection(warm_instance.guacamole_connection_id)
+
+
+@background(**lane(CLEANUP_QUEUE))
+def sweep_expired_instances():
+    """
+    Finishes Windows and Linux test rooms still running INSTANCE_EXPIRY_GRACE seconds past their
+    end_time the way their own teardown would. Each such room is queued to be graded on its own
+    while its instance still runs; rooms whose grading is done, or has been stuck for another
+    grace period, are terminated in batches with one terminate_instances call and one Guacamole
+    cleanup, and each room's recording is handed to the recording lane.
+    """
+    cutoff = now() - timedelta(seconds=settings.INSTANCE_EXPIRY_GRACE)
+    queued, terminated, overrun_minutes = 0, 0, 0.0
+    for kind in ("windows", "linux"):
+        driver = get_driver(kind)
+        queued += queue_expired_grading(driver, cutoff)
+        count, minutes = terminate_expired_instances(driver, cutoff - timedelta(seconds=settings.INSTANCE_EXPIRY_GRACE))
+        terminated += count
+        overrun_minutes += minutes
+    if queued or terminated:
+        logger.info(
+            f"Expiry sweep queued {queued} expired test room(s) for grading and terminated {terminated} "
+            f"instance(s), reclaiming {overrun_minutes:.0f} instance-minutes already past end_time"
+        )
+    return {"queued": queued, "terminated": terminated, "overrun_minutes": round(overrun_minutes, 1)}
+
+
+def queue_expired_grading(driver, cutoff):
+    """Claims one kind's expired rooms for grading and queues a grading task for each. Returns how many."""
+    model = driver.instance_model
+    queued = 0
+    while True:
+        # Skipping locked rows lets overlapping sweeps claim disjoint rooms
+        with transaction.atomic():
+            ids = list(
+                model.objects.select_for_update(skip_locked=True)
+                .filter(status__in=ACTIVE_INSTANCE_STATUSES, end_time__lt=cutoff)
+                .order_by("end_time")
+                .values_list("id", flat=True)[:TERMINATE_BATCH_SIZE]
+            )
+            model.objects.filter(id__in=ids).update(status="grading")
+        for room_id in ids:
+            grade_expired_room(driver.kind, room_id)
+        queued += len(ids)
+        if len(ids) < TERMINATE_BATCH_SIZE:
+            return queued
+
+
+def terminate_expired_instances(driver, stuck_cutoff):
+    """
+    Terminates one kind's graded rooms in batches, along with rooms whose grading has not finished
+    though their end_time is before `stuck_cutoff`. Returns (instances terminated, instance-minutes past end_time).
+    """
+    model = driver.instance_model
+    terminated, overrun_minutes = 0, 0.0
+    while True:
+        batch = list(
+            model.objects.filter(Q(status="graded") | Q(status="grading", end_time__lt=stuck_cutoff))
+            .order_by("end_time")
+            .values("id", "instance_id", "end_time", "test_request_id")[:TERMINATE_BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        instance_ids = [row["instance_id"] for row in batch]
+        try:
+            terminate_instance_batch(instance_ids)
+        except Exception as e:
+            logger.error(f"Expiry sweep failed to terminate {len(instance_ids)} {model.__name__} instance(s): {e}")
+            break
+
+        swept_at = now()
+        model.objects.filter(id__in=[row["id"] for row in batch]).update(status="terminated")
+        terminated += len(batch)
+        overrun_minutes += sum((swept_at - row["end_time"]).total_seconds() / 60 for row in batch)
+
+        connection_ids = set(
+            ProvisioningJob.objects.filter(
+                test_request_id__in=[row["test_request_id"] for row in batch], guacamole_connection_id__isnull=False
+            ).values_list("guacamole_connection_id", flat=True)
+        )
+        try:
+            guac_db.remove_connections(connection_ids, instance_ids)
+        except Exception as e:
+            logger.error(f"Expiry sweep failed to remove Guacamole connections for {len(batch)} instance(s): {e}")
+
+        # With the instances gone guacd ends their sessions, which closes the recordings
+        public_ids = TestRequest.objects.filter(id__in=[row["test_request_id"] for row in batch]).values_list(
+            "public_id", flat=True
+        )
+        for public_id in public_ids:
+            process_session_recording(str(public_id))
+
+        if len(batch) < TERMINATE_BATCH_SIZE:
+            break
+    return terminated, overrun_minutes
+
+
+@background(**lane(CLEANUP_QUEUE))
+def grade_expired_room(kind, room_id):
+    """
+    Grades an expired room the sweeper claimed, as its teardown would have, then leaves it for the
+    next sweep to terminate. Grading errors are logged, not raised, so the room is terminated either way.
+    """
+    driver = get_driver(kind)
+    room = driver.instance_model.objects.select_related("test_request").filter(id=room_id, status="grading").first()
+    if not room:
+        return
+    test_request = room.test_request
+    if test_request:
+        try:
+            driver.grade(test_request, test_request.sub_tests.first(), room.instance_id,
+                         instance_public_ip(test_request, room.instance_id))
+        except Exception as e:
+            logger.exception(f"Expiry sweep could not grade test_id {test_request.public_id}: {e}")
+    driver.instance_model.objects.filter(id=room_id, status="grading").update(status="graded")
+
+
+@background(**lane(RECORDING_QUEUE))
+def process_session_recording(public_id):
+    """Transcodes a finished room's Guacamole recording to MP4 and HLS and uploads them to S3."""
+    process_recording(public_id)
+
+
+def live_room_ids():
+    """Public IDs of the rooms whose session may still be recording."""
+    public_ids = set()
+    for model in (WindowsTestInstance, LinuxTestInstance):
+        public_ids.update(
+            model.objects.filter(status__in=LIVE_INSTANCE_STATUSES).values_list("test_request__public_id", flat=True)
+        )
+    # Custom image rooms only have the TestRequest, marked running while in use
+    public_ids.update(TestRequest.objects.filter(status="running").values_list("public_id", flat=True))
+    return sorted(str(public_id) for public_id in public_ids if public_id)
+
+
+@background(**lane(DEFAULT_QUEUE))
+def ship_recording_chunks():
+    """
+    Copies the newly written, whole chunks of every live room's session recording to S3, so
+    little is left to ship when the session ends and a lost host loses only the last few minutes.
+    """
+    public_ids = live_room_ids()
+    sent = ship_live_recordings(public_ids)
+    if sent:
+        logger.info(f"Shipped {sent} recording chunk(s) from {len(public_ids)} live room(s)")
+
+
+@background(**lane(RECORDING_QUEUE))
+def render_live_thumbnails():
+    """Renders the thumbnail sprite sheets live rooms' recordings have completed since the last run."""
+    rendered = sum(update_thumbnails(public_id) for public_id in live_room_ids())
+    if rendered:
+        logger.info(f"Rendered {rendered} thumbnail sheet(s) for live rooms")
@@ -0,0 +1,1048 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from accounts.models import Company, CustomUser
+from dashboard.models import TestRequest, TestType, SubTest
+from . import guac_api, guac_json, jobs, probe, recordings, scrubbing, shipping, tasks, transcode, uploader
+from .guac_db import connection_parameters
+from .models import ProvisioningJob, LaunchAttempt
+from video_playback.models import RecordedSession
+from linux_test_rooms.models import LinuxTestInstance
+from windows_test_rooms.models import WindowsTestInstance
+
+
+SECRET_KEY = "4c0b569e4c96df157eee1b65dd0e4d41"
+
+
+def decode_json_auth(data, secret_key):
+    """Reverses what guacamole-auth-json does on receipt: base64, AES-128-CBC (zero IV), HMAC-SHA256 check."""
+    key = bytes.fromhex(secret_key)
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(bytes(16))).decryptor()
+    padded = decryptor.update(base64.b64decode(data)) + decryptor.finalize()
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    signed = unpadder.update(padded) + unpadder.finalize()
+
+    signature, payload = signed[:32], signed[32:]
+    if not hmac.compare_digest(signature, hmac.new(key, payload, hashlib.sha256).digest()):
+        raise ValueError("Signature does not match payload.")
+    return json.loads(payload)
+
+
+class JsonAuthPayloadTests(SimpleTestCase):
+    def build(self, os_type, credentials):
+        protocol, params = connection_parameters(os_type, credentials, "testid-abc")
+        payload = guac_json.build_payload(
+            "candidate-abc", {"testid-abc": {"protocol": protocol, "parameters": dict(params)}}, 300
+        )
+        return decode_json_auth(guac_json.encrypt_payload(payload, SECRET_KEY), SECRET_KEY)
+
+    def test_rdp_payload_matches_json_auth_format(self):
+        before = int(time.time() * 1000)
+        decoded = self.build("windows", {"username": "Administrator", "password": "s3cret", "ip_address": "10.0.0.5"})
+
+        self.assertEqual(set(decoded), {"username", "expires", "connections"})
+        self.assertEqual(decoded["username"], "candidate-abc")
+        self.assertIsInstance(decoded["expires"], int)
+        self.assertGreaterEqual(decoded["expires"], before + 300 * 1000)
+
+        connection = decoded["connections"]["testid-abc"]
+        self.assertEqual(set(connection), {"protocol", "parameters"})
+        self.assertEqual(connection["protocol"], "rdp")
+        parameters = connection["parameters"]
+        self.assertTrue(all(isinstance(value, str) for value in parameters.values()))
+        self.assertEqual(parameters["hostname"], "10.0.0.5")
+        self.assertEqual(parameters["port"], "3389")
+        self.assertEqual(parameters["username"], "Administrator")
+        self.assertEqual(parameters["password"], "s3cret")
+        self.assertEqual(parameters["enable-recording"], "true")
+        self.assertEqual(parameters["recording-name"], "testid-abc")
+
+    def test_ssh_payload_uses_private_key(self):
+        with mock.patch("builtins.open", mock.mock_open(read_data="-----BEGIN KEY-----\n")):
+            decoded = self.build("linux", {"username": "ec2-user", "password": "", "ip_address": "10.0.0.6"})
+
+        connection = decoded["connections"]["testid-abc"]
+        self.assertEqual(connection["protocol"], "ssh")
+        self.assertEqual(connection["parameters"]["port"], "22")
+        self.assertEqual(connection["parameters"]["private-key"], "-----BEGIN KEY-----")
+        self.assertNotIn("password", connection["parameters"])
+
+    def test_tampered_payload_fails_signature(self):
+        data = guac_json.encrypt_payload(guac_json.build_payload("candidate-abc", {}, 300), SECRET_KEY)
+        with self.assertRaises(ValueError):
+            decode_json_auth(data, "0" * 32)
+
+    def test_client_identifier_uses_json_data_source(self):
+        identifier = guac_api.connection_identifier("testid-abc", guac_json.DATA_SOURCE)
+        self.assertEqual(base64.b64decode(identifier), b"testid-abc\x00c\x00json")
+
+
+class FakeGuacamoleApi:
+    """Answers REST calls with `body`, rejecting any token listed in `revoked` the way Guacamole does."""
+
+    def __init__(self, body, revoked=()):
+        self.body = body
+        self.revoked = set(revoked)
+        self.tokens = []
+
+    def request(self, method, url, params, **kwargs):
+        self.tokens.append(params["token"])
+        response = mock.Mock(status_code=403 if params["token"] in self.revoked else 200)
+        response.json.return_value = self.body
+        return response
+
+
+class GuacamoleTokenTests(TestCase):
+    def setUp(self):
+        self.issued = iter(["token-1", "token-2", "token-3"])
+        cache = guac_api.TokenCache(lambda username, password: next(self.issued), ttl=1800, refresh_margin=300)
+        patcher = mock.patch.object(guac_api, "_token_cache", cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_revoked_token_is_dropped_and_call_retried_once(self):
+        self.assertEqual(guac_api.get_token(), "token-1")
+        api = FakeGuacamoleApi({"protocol": "rdp"}, revoked={"token-1"})
+        with mock.patch.object(guac_api, "get_session", return_value=api):
+            self.assertEqual(guac_api.api_request("GET", "session/data/postgresql/connections/7"), {"protocol": "rdp"})
+        self.assertEqual(api.tokens, ["token-1", "token-2"])
+        self.assertEqual(guac_api.get_token(), "token-2")
+
+    def test_second_rejection_raises(self):
+        api = FakeGuacamoleApi({}, revoked={"token-1", "token-2"})
+        with mock.patch.object(guac_api, "get_session", return_value=api):
+            with self.assertRaises(guac_api.GuacamoleAuthError):
+                guac_api.api_request("GET", "session/data/postgresql/connections/7")
+        self.assertEqual(len(api.tokens), 2)
+
+
+class DatabaseBackendRoomTests(TestCase):
+    @override_settings(GUAC_CONNECTION_BACKEND="database", GUAC_JSON_SECRET_KEY="")
+    def test_room_renders_without_json_auth_configured(self):
+        test_type = TestType.objects.create(name="Linux admin")
+        sub_test = SubTest.objects.create(test_type=test_type, name="Shell", ami_id="ami-123", os_type="linux", time_limit=30)
+        test_request = TestRequest.objects.create(
+            title="Shell test", test_type=test_type, password="x", company=Company.objects.create(name="Acme")
+        )
+        test_request.sub_tests.add(sub_test)
+        ProvisioningJob.objects.create(
+            test_request=test_request, kind="linux", state="ready", instance_id="i-123", guacamole_connection_id=7
+        )
+        LinuxTestInstance.objects.create(
+            test_request=test_request, instance_id="i-123", status="running", end_time=timezone.now() + timedelta(hours=1)
+        )
+        session = self.client.session
+        session["authenticated_test_id"] = str(test_request.public_id)
+        session.save()
+
+        with mock.patch.object(guac_api, "get_token", return_value="service-token"), \
+                mock.patch.object(guac_api, "fetch_json_token", side_effect=AssertionError("JSON auth used")):
+            response = self.client.get(reverse("test_room", kwargs={"public_id": test_request.public_id}))
+
+        self.assertTemplateUsed(response, "linux_test_rooms/test_room.html")
+        self.assertEqual(response.context["guacamole_token"], "service-token")
+        self.assertEqual(base64.b64decode(response.context["guacamole_connection_id"]), b"7\x00c\x00postgresql")
+
+
+class GuacamoleTunnelTests(TestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.test_request = TestRequest.objects.create(
+            title="AD test", test_type=TestType.objects.create(name="Windows admin"), password="x", company=company
+        )
+        self.job = ProvisioningJob.objects.create(
+            test_request=self.test_request, kind="windows", state="ready", instance_id="i-123"
+        )
+        self.url = reverse("guacamole_tunnel", kwargs={"public_id": self.test_request.public_id})
+
+    def open_tunnel(self, token="room-token"):
+        api = mock.Mock()
+        api.post.return_value.json.return_value = {"identifier": "tunnel-1"}
+        api.request.return_value = mock.Mock(status_code=200)
+        api.request.return_value.json.return_value = {"identifier": "tunnel-1"}
+        with mock.patch("provisioning.views.room_session", return_value=(token, "conn")) as room_session, \
+                mock.patch.object(guac_api, "get_session", return_value=api), \
+                mock.patch.object(guac_api, "get_token", return_value="service-token"):
+            response = self.client.get(self.url)
+        return response, room_session
+
+    def unlock(self):
+        session = self.client.session
+        session["authenticated_test_id"] = str(self.test_request.public_id)
+        session.save()
+
+    def test_anonymous_request_is_forbidden(self):
+        response, room_session = self.open_tunnel()
+        self.assertEqual(response.status_code, 403)
+        room_session.assert_not_called()
+
+    def test_other_company_is_forbidden(self):
+        other = Company.objects.create(name="Other")
+        self.client.force_login(
+            CustomUser.objects.create_user(username="other", email="o@other.test", password="x", company=other)
+        )
+        response, room_session = self.open_tunnel()
+        self.assertEqual(response.status_code, 403)
+        room_session.assert_not_called()
+
+    @override_settings(GUAC_CONNECTION_BACKEND="json")
+    def test_candidate_gets_room_scoped_token(self):
+        ProvisioningJob.objects.filter(id=self.job.id).update(connection_credentials="sealed")
+        self.unlock()
+        response, room_session = self.open_tunnel()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["guac_token"], "room-token")
+        self.assertEqual(response.json()["guac_tunnel_id"], "tunnel-1")
+        room_session.assert_called_once_with(self.test_request, "i-123")
+
+    @override_settings(GUAC_CONNECTION_BACKEND="database")
+    def test_service_token_stays_on_the_server(self):
+        self.unlock()
+        response, _ = self.open_tunnel(token="service-token")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["guac_tunnel_id"], "tunnel-1")
+        self.assertNotIn("guac_token", response.json())
+        self.assertNotIn(b"service-token", response.content)
+
+
+class ProvisioningStatusTests(TestCase):
+    def setUp(self):
+        # Rooms created from the admin have no created_by, like an anonymous user's id
+        self.test_request = TestRequest.objects.create(
+            title="AD test", test_type=TestType.objects.create(name="Windows admin"), password="x",
+            company=Company.objects.create(name="Acme"),
+        )
+        ProvisioningJob.objects.create(test_request=self.test_request, kind="windows", state="launching")
+        self.url = reverse("provisioning_status", kwargs={"public_id": self.test_request.public_id})
+
+    def test_anonymous_request_for_room_without_creator_is_forbidden(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_candidate_who_unlocked_the_room_sees_its_state(self):
+        session = self.client.session
+        session["authenticated_test_id"] = str(self.test_request.public_id)
+        session.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["state"], "launching")
+
+
+class FakeEC2:
+    """
+    Honours ClientToken the way EC2 does: a repeated token returns the instance it already launched.
+    Given a barrier, each thread's first call waits there, so that many launches are in flight at once.
+    """
+
+    def __init__(self, error=None, barrier=None):
+        self.error = error
+        self.barrier = barrier
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.callers = set()
+        self.launched = {}  # client token -> instance ID
+
+    def run_instances(self, **kwargs):
+        with self.lock:
+            first_call = threading.get_ident() not in self.callers
+            self.callers.add(threading.get_ident())
+        if self.barrier and first_call:
+            self.barrier.wait()
+        with self.lock:
+            self.calls += 1
+            if self.error:
+                raise self.error
+            token = kwargs["ClientToken"]
+            if token not in self.launched:
+                self.launched[token] = f"i-{len(self.launched) + 1:017x}"
+            return {"Instances": [{"InstanceId": self.launched[token]}]}
+
+
+class IdempotentLaunchTests(TransactionTestCase):
+    def setUp(self):
+        test_type = TestType.objects.create(name="Windows admin")
+        self.sub_test = SubTest.objects.create(
+            test_type=test_type, name="AD", ami_id="ami-123", os_type="windows", time_limit=30
+        )
+        test_request = TestRequest.objects.create(
+            title="AD test", test_type=test_type, password="x", company=Company.objects.create(name="Acme")
+        )
+        self.job = ProvisioningJob.objects.create(test_request=test_request, kind="windows")
+
+    def launch(self):
+        job = ProvisioningJob.objects.select_related("test_request").get(id=self.job.id)
+        jobs.launch_job_instance(job, self.sub_test)
+        return job.instance_id
+
+    def test_concurrent_launches_start_one_instance(self):
+        # Every worker reserves its attempt before any of them hears back from EC2
+        ec2 = FakeEC2(barrier=threading.Barrier(20, timeout=30))
+        start = threading.Barrier(20, timeout=30)
+        results, errors = [], []
+
+        def worker():
+            try:
+                start.wait()
+                for _ in range(50):
+                    try:
+                        results.append(self.launch())
+                        break
+                    except OperationalError as e:
+                        # SQLite's shared-cache test database rejects concurrent writers rather than
+                        # waiting for them; launching again is safe, as launches are idempotent
+                        if connection.vendor != "sqlite" or "locked" not in str(e):
+                            raise
+                        time.sleep(0.01)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with mock.patch.object(jobs, "ec2", ec2):
+            threads = [threading.Thread(target=worker) for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(ec2.launched), 1)
+        instance_id = ec2.launched[jobs.client_token(self.job.test_request.public_id, 1)]
+        self.assertEqual(results, [instance_id] * 20)
+        self.assertEqual(LaunchAttempt.objects.get().instance_id, instance_id)
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.state, self.job.instance_id), ("launching", instance_id))
+
+    def test_retry_after_lost_response_reuses_token(self):
+        ec2 = FakeEC2()
+        with mock.patch.object(jobs, "ec2", ec2):
+            # The first call launched but its response was lost, so the attempt is still pending
+            ec2.run_instances(ClientToken=jobs.client_token(self.job.test_request.public_id, 1))
+            LaunchAttempt.objects.create(
+                job=self.job, attempt=1, client_token=jobs.client_token(self.job.test_request.public_id, 1)
+            )
+            self.launch()
+
+        self.assertEqual(len(ec2.launched), 1)
+        self.assertEqual(LaunchAttempt.objects.get().status, "launched")
+
+    def test_rejected_launch_moves_to_next_attempt(self):
+        rejected = ClientError({"Error": {"Code": "InsufficientInstanceCapacity"}}, "RunInstances")
+        with mock.patch.object(jobs, "ec2", FakeEC2(error=rejected)):
+            with self.assertRaises(ClientError):
+                self.launch()
+        with mock.patch.object(jobs, "ec2", FakeEC2()):
+            self.launch()
+
+        attempts = list(LaunchAttempt.objects.order_by("attempt").values_list("attempt", "status"))
+        self.assertEqual(attempts, [(1, "failed"), (2, "launched")])
+
+
+@override_settings(INSTANCE_EXPIRY_GRACE=300)
+class ExpirySweepTests(TestCase):
+    def setUp(self):
+        test_type = TestType.objects.create(name="Windows admin")
+        self.sub_test = SubTest.objects.create(
+            test_type=test_type, name="AD", ami_id="ami-123", os_type="windows", time_limit=30, script="exit 0"
+        )
+        self.test_request = TestRequest.objects.create(
+            title="AD test", test_type=test_type, password="x", company=Company.objects.create(name="Acme")
+        )
+        self.test_request.sub_tests.add(self.sub_test)
+        ProvisioningJob.objects.create(
+            test_request=self.test_request, kind="windows", state="ready", instance_id="i-123", public_ip="10.0.0.5"
+        )
+        self.instance = WindowsTestInstance.objects.create(
+            test_request=self.test_request, instance_id="i-123", status="running",
+            end_time=timezone.now() - timedelta(minutes=7),
+        )
+
+    def sweep(self, calls):
+        with mock.patch("provisioning.tasks.terminate_instance_batch",
+                        side_effect=lambda instance_ids: calls.append(("terminate", instance_ids))), \
+                mock.patch.object(tasks.guac_db, "remove_connections"), \
+                mock.patch("provisioning.tasks.grade_expired_room",
+                           side_effect=lambda kind, room_id: calls.append(("queue", kind, room_id))), \
+                mock.patch("provisioning.tasks.process_session_recording",
+                           side_effect=lambda public_id: calls.append(("recording", public_id))):
+            return tasks.sweep_expired_instances.now()
+
+    def test_expired_room_is_graded_and_its_recording_processed(self):
+        calls = []
+        result = self.sweep(calls)
+        # Grading is queued per room, so no terminate call waits on it
+        self.assertEqual(result["queued"], 1)
+        self.assertEqual(result["terminated"], 0)
+        self.assertEqual(calls, [("queue", "windows", self.instance.id)])
+        self.assertEqual(tasks.grade_expired_room.queue, "cleanup")
+
+        with mock.patch("provisioning.drivers.WindowsDriver.grading_credentials", return_value={"ip_address": "10.0.0.5"}), \
+                mock.patch("provisioning.drivers.run_grading_script", return_value="pass"):
+            tasks.grade_expired_room.now("windows", self.instance.id)
+        self.sub_test.refresh_from_db()
+        self.assertEqual(self.sub_test.pass_fail, "pass")
+
+        calls = []
+        result = self.sweep(calls)
+        self.assertEqual(result["terminated"], 1)
+        self.assertEqual(calls, [("terminate", ["i-123"]), ("recording", str(self.test_request.public_id))])
+        self.instance.refresh_from_db()
+        self.assertEqual(self.instance.status, "terminated")
+
+    def test_room_stuck_in_grading_is_terminated_after_another_grace_period(self):
+        WindowsTestInstance.objects.filter(id=self.instance.id).update(status="grading")
+        calls = []
+        self.assertEqual(self.sweep(calls)["terminated"], 0)
+
+        WindowsTestInstance.objects.filter(id=self.instance.id).update(end_time=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.sweep(calls)["terminated"], 1)
+        self.assertEqual(calls[0], ("terminate", ["i-123"]))
+
+
+@override_settings(GUEST_PORT_PROBE=True)
+class GuestPortProbeTaskTests(TestCase):
+    def add_job(self, title, kind, sub_test=None):
+        test_request = TestRequest.objects.create(
+            title=title, test_type=self.test_type, password="x", company=self.company
+        )
+        if sub_test:
+            test_request.sub_tests.add(sub_test)
+        return ProvisioningJob.objects.create(
+            test_request=test_request, kind=kind, state="running", public_ip="10.0.0.5", running_at=timezone.now()
+        )
+
+    def setUp(self):
+        self.test_type = TestType.objects.create(name="Linux admin")
+        self.company = Company.objects.create(name="Acme")
+        sub_test = SubTest.objects.create(
+            test_type=self.test_type, name="Shell", ami_id="ami-123", os_type="linux", time_limit=30, script=""
+        )
+        self.orphan = self.add_job("No sub-test", "custom")
+        self.unknown = self.add_job("Unknown kind", "bogus", sub_test)
+        self.job = self.add_job("Shell test", "custom", sub_test)
+
+    def test_bad_rows_do_not_stop_the_other_guests_being_probed(self):
+        with mock.patch.object(tasks.probe, "probe_targets", return_value={}) as probe_targets:
+            tasks.probe_guest_ports.now()
+
+        targets = probe_targets.call_args.args[0]
+        self.assertEqual(list(targets), [self.job.id])
+        self.assertEqual(targets[self.job.id][:3], ("10.0.0.5", 22, "ssh"))
+
+
+class CustomImageTeardownTests(TestCase):
+    def setUp(self):
+        test_type = TestType.objects.create(name="Custom")
+        self.sub_test = SubTest.objects.create(
+            test_type=test_type, name="Own image", ami_id="ami-old", os_type="linux", time_limit=30, script=""
+        )
+        self.test_request = TestRequest.objects.create(
+            title="Own image", test_type=test_type, password="x", company=Company.objects.create(name="Acme"),
+            instance_id="i-123", public_ip="10.0.0.5", status="running",
+        )
+        self.test_request.sub_tests.add(self.sub_test)
+
+    def test_ami_is_baked_in_its_own_lane_after_the_room_is_gone(self):
+        from customimage import tasks as customimage_tasks
+
+        calls = []
+        ec2 = mock.Mock()
+        ec2.create_image.side_effect = lambda **kwargs: calls.append("image") or {"ImageId": "ami-new"}
+        ec2.describe_images.return_value = {"Images": [{"BlockDeviceMappings": [{"Ebs": {"SnapshotId": "snap-1"}}]}]}
+        ec2.terminate_instances.side_effect = lambda **kwargs: calls.append("terminate")
+        with mock.patch("provisioning.drivers.ec2", ec2), \
+                mock.patch("provisioning.jobs.release_room_connection"), \
+                mock.patch("provisioning.tasks.process_session_recording",
+                           side_effect=lambda public_id: calls.append("recording")), \
+                mock.patch.object(customimage_tasks, "bake_ami", side_effect=lambda *args: calls.append(("bake", args))):
+            customimage_tasks.cleanup_instance_tasks.now(str(self.test_request.public_id))
+
+        public_id = str(self.test_request.public_id)
+        self.assertEqual(calls, ["image", "terminate", "recording", ("bake", (public_id, "ami-new"))])
+        self.test_request.refresh_from_db()
+        self.assertEqual(self.test_request.status, "terminated")
+        self.assertEqual(customimage_tasks.bake_ami.queue, "ami")
+        self.assertEqual(customimage_tasks.cleanup_instance_tasks.queue, "cleanup")
+
+        with mock.patch("customimage.tasks.wait_for_ami", return_value=True):
+            customimage_tasks.bake_ami.now(public_id, "ami-new")
+        self.sub_test.refresh_from_db()
+        self.assertEqual(self.sub_test.ami_id, "ami-new")
+
+
+SSH_BANNER = b"SSH-2.0-OpenSSH_8.7\r\n"
+# TPKT + X.224 Connection Confirm with an RDP Negotiation Response selecting TLS
+RDP_CONNECTION_CONFIRM = bytes.fromhex("030000130ed000001234000200080001000000")
+
+
+class DelayedListener:
+    """
+    A local port that refuses connections until `delay` seconds have passed, like a guest whose
+    service is still starting, then answers every connection with `reply`.
+    """
+
+    def __init__(self, delay, reply):
+        self.reply = reply
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.timer = threading.Timer(delay, self.listen)
+        self.timer.start()
+
+    def listen(self):
+        self.sock.listen(128)
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            with client:
+                if self.reply == RDP_CONNECTION_CONFIRM:
+                    client.recv(len(probe.RDP_CONNECTION_REQUEST))
+                client.sendall(self.reply)
+
+    def close(self):
+        self.timer.cancel()
+        self.sock.close()
+
+
+class PortProbeTests(SimpleTestCase):
+    def listener(self, delay, reply):
+        listener = DelayedListener(delay, reply)
+        self.addCleanup(listener.close)
+        return listener
+
+    def run_probe(self, targets, **options):
+        started = time.monotonic()
+        results = probe.probe_targets(targets, initial_delay=0.05, max_delay=0.2, timeout=1.0, **options)
+        return results, time.monotonic() - started
+
+    def deadline(self, seconds):
+        return time.monotonic() + seconds
+
+    def test_ssh_port_opening_after_delay_is_detected(self):
+        listener = self.listener(0.5, SSH_BANNER)
+        results, elapsed = self.run_probe({"job": ("127.0.0.1", listener.port, "ssh", self.deadline(5))})
+        self.assertEqual(results, {"job": True})
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertLess(elapsed, 2)
+
+    def test_rdp_connection_confirm_is_detected(self):
+        listener = self.listener(0.3, RDP_CONNECTION_CONFIRM)
+        results, _ = self.run_probe({"job": ("127.0.0.1", listener.port, "rdp", self.deadline(5))})
+        self.assertEqual(results, {"job": True})
+
+    def test_open_port_speaking_another_protocol_is_not_ready(self):
+        listener = self.listener(0, b"HTTP/1.1 400 Bad Request\r\n\r\n")
+        results, _ = self.run_probe({
+            "ssh": ("127.0.0.1", listener.port, "ssh", self.deadline(0.5)),
+            "rdp": ("127.0.0.1", listener.port, "rdp", self.deadline(0.5)),
+        })
+        self.assertEqual(results, {"ssh": False, "rdp": False})
+
+    def test_port_that_never_opens_gives_up_at_deadline(self):
+        listener = self.listener(60, SSH_BANNER)
+        results, elapsed = self.run_probe({"job": ("127.0.0.1", listener.port, "ssh", self.deadline(0.8))})
+        self.assertEqual(results, {"job": False})
+        self.assertLess(elapsed, 1.5)
+
+    def test_many_guests_are_watched_on_one_loop(self):
+        listeners = [self.listener(0.2 + i * 0.02, SSH_BANNER) for i in range(20)]
+        targets = {
+            (i, copy): ("127.0.0.1", listener.port, "ssh", self.deadline(5))
+            for i, listener in enumerate(listeners) for copy in range(10)
+        }
+        ready = []
+        results, elapsed = self.run_probe(targets, on_ready=ready.append, concurrency=50)
+
+        self.assertTrue(all(results.values()))
+        self.assertCountEqual(ready, targets)
+        # 200 guests take about as long as the slowest one, not the sum of their waits
+        self.assertLess(elapsed, 3)
+
+
+class FakeS3:
+    """
+    In-memory stand-in for the S3 calls the uploader makes. Like S3, it checks each part's
+    ChecksumSHA256 on receipt and reports a composite checksum for multipart objects.
+    `fail_after` makes upload_part fail once that many parts have been stored.
+    """
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.lock = threading.Lock()
+        self.objects = {}  # key -> (body, checksum)
+        self.uploads = {}  # upload ID -> (key, {part number: (body, checksum)})
+        self.part_calls = 0
+
+    def put_object(self, Bucket, Key, Body, ChecksumSHA256, ContentType=None):
+        if uploader.sha256_b64(Body) != ChecksumSHA256:
+            raise ClientError({"Error": {"Code": "BadDigest"}}, "PutObject")
+        self.objects[Key] = (Body, ChecksumSHA256)
+
+    def create_multipart_upload(self, Bucket, Key, ChecksumAlgorithm):
+        upload_id = f"upload-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = (Key, {})
+        return {"UploadId": upload_id}
+
+    def list_multipart_uploads(self, Bucket, Prefix):
+        return {"Uploads": [
+            {"Key": key, "UploadId": upload_id, "Initiated": index}
+            for index, (upload_id, (key, _)) in enumerate(self.uploads.items()) if key.startswith(Prefix)
+        ]}
+
+    def list_parts(self, Bucket, Key, UploadId, MaxParts, PartNumberMarker):
+        parts = sorted(self.uploads[UploadId][1].items())
+        parts = [part for part in parts if part[0] > PartNumberMarker]
+        page = parts[:MaxParts]
+        return {
+            "Parts": [{"PartNumber": number, "ETag": f'"{number}"', "ChecksumSHA256": checksum} for number, (_, checksum) in page],
+            "IsTruncated": len(parts) > MaxParts,
+            "NextPartNumberMarker": page[-1][0] if page else PartNumberMarker,
+        }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ChecksumSHA256):
+        with self.lock:
+            if self.fail_after is not None and len(self.uploads[UploadId][1]) >= self.fail_after:
+                raise ClientError({"Error": {"Code": "RequestTimeout"}}, "UploadPart")
+            self.part_calls += 1
+            if uploader.sha256_b64(Body) != ChecksumSHA256:
+                raise ClientError({"Error": {"Code": "BadDigest"}}, "UploadPart")
+            self.uploads[UploadId][1][PartNumber] = (Body, ChecksumSHA256)
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        key, stored = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        body = b"".join(stored[number][0] for number in numbers)
+        checksum = uploader.composite_checksum([stored[number][1] for number in numbers])
+        self.objects[key] = (body, checksum)
+
+    def head_object(self, Bucket, Key, ChecksumMode):
+        body, checksum = self.objects[Key]
+        return {"ContentLength": len(body), "ChecksumSHA256": checksum}
+
+
+class RecordingUploadTests(SimpleTestCase):
+    config = TransferConfig(multipart_threshold=1024, multipart_chunksize=1024, max_concurrency=4)
+
+    def recording(self, size):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(os.urandom(size))
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        with open(f.name, "rb") as f:
+            return f.name, f.read()
+
+    def test_large_file_is_uploaded_in_parts(self):
+        path, data = self.recording(10 * 1024 + 100)
+        s3 = FakeS3()
+        checksum = uploader.upload_file(path, "bucket", "recordings/a.mp4", self.config, s3)
+        self.assertEqual(s3.objects["recordings/a.mp4"], (data, checksum))
+        self.assertEqual(s3.part_calls, 11)
+        self.assertTrue(checksum.endswith("-11"))
+
+    def test_small_file_is_uploaded_in_one_request(self):
+        path, data = self.recording(100)
+        s3 = FakeS3()
+        uploader.upload_file(path, "bucket", "recordings/a.mp4", self.config, s3)
+        self.assertEqual(s3.objects["recordings/a.mp4"][0], data)
+        self.assertEqual(s3.part_calls, 0)
+
+    def test_interrupted_upload_resumes_with_missing_parts_only(self):
+        path, data = self.recording(10 * 1024)
+        s3 = FakeS3(fail_after=6)
+        with self.assertRaises(ClientError):
+            uploader.upload_file(path, "bucket", "recordings/a.mp4", self.config, s3)
+        self.assertNotIn("recordings/a.mp4", s3.objects)
+
+        s3.fail_after = None
+        sent_before = s3.part_calls
+        uploader.upload_file(path, "bucket", "recordings/a.mp4", self.config, s3)
+        self.assertEqual(s3.objects["recordings/a.mp4"][0], data)
+        self.assertEqual(s3.part_calls - sent_before, 10 - sent_before)
+        self.assertEqual(s3.uploads, {})
+
+    def test_part_changed_on_disk_is_sent_again_on_resume(self):
+        path, data = self.recording(4 * 1024)
+        config = TransferConfig(multipart_threshold=1024, multipart_chunksize=1024, max_concurrency=1)
+        s3 = FakeS3(fail_after=3)
+        with self.assertRaises(ClientError):
+            uploader.upload_file(path, "bucket", "recordings/a.mp4", config, s3)
+
+        with open(path, "r+b") as f:
+            f.seek(1024)
+            f.write(b"x" * 1024)
+        s3.fail_after = None
+        s3.part_calls = 0
+        uploader.upload_file(path, "bucket", "recordings/a.mp4", config, s3)
+        # Part 2 no longer matches what S3 holds and part 4 never arrived
+        self.assertEqual(s3.part_calls, 2)
+        self.assertEqual(s3.objects["recordings/a.mp4"][0], data[:1024] + b"x" * 1024 + data[2048:])
+
+    def test_mismatched_object_fails_verification(self):
+        path, _ = self.recording(3 * 1024)
+        s3 = FakeS3()
+        complete = s3.complete_multipart_upload
+
+        def truncate(**kwargs):
+            complete(**kwargs)
+            body, checksum = s3.objects[kwargs["Key"]]
+            s3.objects[kwargs["Key"]] = (body[:-1], checksum)
+
+        s3.complete_multipart_upload = truncate
+        with self.assertRaises(uploader.UploadVerificationError):
+            uploader.upload_file(path, "bucket", "recordings/a.mp4", self.config, s3)
+
+
+def guac_instruction(*elements):
+    return ",".join(f"{len(element)}.{element}" for element in elements).encode() + b";"
+
+
+def guac_recording(seconds):
+    """A recording with one frame per second: a drawing instruction, then its sync."""
+    data = guac_instruction("size", "0", "1024", "768")
+    for second in range(seconds):
+        data += guac_instruction("rect", "0", "0", "0", str(second), "1")
+        data += guac_instruction("sync", str(1700000000000 + second * 1000))
+    return data
+
+
+class EmptyRecordingTests(TestCase):
+    def test_recording_with_nothing_drawn_is_marked_empty(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(RECORDINGS_DIR=directory):
+            open(os.path.join(directory, "testid-abc"), "wb").close()
+            self.assertFalse(recordings.transcode_recording("abc"))
+            with open(os.path.join(directory, "testid-abc"), "wb") as f:
+                f.write(guac_instruction("size", "0", "1024", "768"))
+            with self.assertRaises(transcode.EmptyRecordingError):
+                transcode.transcode(os.path.join(directory, "testid-abc"), os.path.join(directory, "out.mp4"))
+        self.assertEqual(RecordedSession.objects.get(test_id="abc").status, "empty")
+
+
+class TranscodeTests(SimpleTestCase):
+    def test_instruction_lengths_count_characters(self):
+        data = guac_instruction("name", "Zoë ✓") + guac_instruction("sync", "5")
+        parsed = list(transcode.instructions(data))
+        self.assertEqual([(opcode, argument) for _, _, opcode, argument in parsed], [("name", "Zoë ✓".encode()), ("sync", b"5")])
+        self.assertEqual(parsed[-1][1], len(data))
+
+    def test_truncated_instruction_is_ignored(self):
+        data = guac_recording(2)
+        self.assertEqual(len(list(transcode.instructions(data[:-5]))), 4)
+
+    def test_recording_is_split_at_sync_boundaries(self):
+        data = guac_recording(12)
+        boundaries, syncs = transcode.plan_segments(data, segment_seconds=5)
+        self.assertEqual(len(syncs), 12)
+        self.assertEqual(boundaries, [syncs[0][0], syncs[5][0], syncs[10][0]])
+
+    def write_segments(self, data, segment_seconds=5):
+        """Every segment of `data` as written for guacenc, parsed to (opcode, first argument) pairs."""
+        boundaries, syncs = transcode.plan_segments(data, segment_seconds)
+        writer = transcode.SegmentWriter(data, boundaries, syncs)
+        segments = []
+        with tempfile.TemporaryDirectory() as workdir:
+            for index in range(len(boundaries)):
+                path = os.path.join(workdir, "segment.guac")
+                writer.write(path, index)
+                with open(path, "rb") as f:
+                    segments.append([(opcode, argument) for _, _, opcode, argument in transcode.instructions(f.read())])
+        return segments
+
+    def test_segment_replays_earlier_drawing_without_frames(self):
+        segment = self.write_segments(guac_recording(12))[1]
+        # Every drawing instruction up to the sync that starts the next segment, but only the syncs of seconds 5 to 10
+        self.assertEqual(sum(opcode == "rect" for opcode, _ in segment), 11)
+        self.assertEqual([int(argument) - 1700000000000 for opcode, argument in segment if opcode == "sync"],
+                         [5000, 6000, 7000, 8000, 9000, 10000])
+        self.assertEqual(segment[0][0], "size")
+
+    def test_drawing_painted_over_is_not_replayed(self):
+        data = guac_instruction("size", "0", "1024", "768")
+        for second in range(30):
+            if second % 3 == 0:
+                # A full-screen opaque fill, like a desktop repaint
+                data += guac_instruction("rect", "0", "0", "0", "1024", "768")
+                data += guac_instruction("cfill", "14", "0", "0", "0", "0", "255")
+            data += guac_instruction("rect", "0", "0", "0", "10", "10")
+            data += guac_instruction("cfill", "14", "0", str(second), "0", "0", "255")
+            data += guac_instruction("sync", str(1700000000000 + second * 1000))
+        segments = self.write_segments(data)
+
+        # Each segment starts with the last repaint and what was drawn after it, however late it is
+        for segment in segments[1:]:
+            prefix = segment[:next(index for index, (opcode, _) in enumerate(segment) if opcode == "sync")]
+            self.assertLessEqual(sum(opcode == "cfill" for opcode, _ in prefix), 1 + 3)
+            self.assertEqual(prefix[0], ("size", b"0"))
+
+    def test_disposed_buffers_are_dropped_once_nothing_reads_them(self):
+        data = guac_instruction("size", "0", "1024", "768")
+        data += guac_instruction("sync", "1700000000000")
+        # Buffer -1 ends up on layer 0, which is then painted over; buffer -2 ends up on layer 1
+        for layer, target in (("-1", "0"), ("-2", "1")):
+            data += guac_instruction("size", layer, "64", "64")
+            data += guac_instruction("copy", layer, "0", "0", "64", "64", "14", target, "0", "0")
+            data += guac_instruction("dispose", layer)
+        data += guac_instruction("rect", "0", "0", "0", "1024", "768")
+        data += guac_instruction("cfill", "12", "0", "0", "0", "0", "0")
+        data += guac_instruction("sync", "1700000006000")
+        segment = self.write_segments(data)[1]
+
+        layers = [(opcode, argument) for opcode, argument in segment if opcode in ("size", "copy", "dispose")]
+        self.assertEqual(layers, [("size", b"0"), ("size", b"-2"), ("copy", b"-2"), ("dispose", b"-2")])
+
+    def test_full_screen_image_paints_over_earlier_drawing(self):
+        png = b"\x89PNG\r\n\x1a\n" + (13).to_bytes(4, "big") + b"IHDR" + (1024).to_bytes(4, "big") + (768).to_bytes(4, "big") + b"\x08\x02"
+        data = guac_instruction("size", "0", "1024", "768")
+        data += guac_instruction("rect", "0", "0", "0", "10", "10")
+        data += guac_instruction("cfill", "14", "0", "255", "0", "0", "255")
+        data += guac_instruction("sync", "1700000000000")
+        data += guac_instruction("img", "1", "14", "0", "image/png", "0", "0")
+        data += guac_instruction("blob", "1", base64.b64encode(png).decode())
+        data += guac_instruction("end", "1")
+        data += guac_instruction("sync", "1700000006000")
+        segment = self.write_segments(data)[1]
+
+        self.assertEqual([opcode for opcode, _ in segment][:4], ["size", "img", "blob", "end"])
+        self.assertNotIn("cfill", [opcode for opcode, _ in segment])
+
+    def preambles(self, data):
+        """What each segment starts with before its first sync, in bytes."""
+        boundaries, syncs = transcode.plan_segments(data, 5)
+        writer = transcode.SegmentWriter(data, boundaries, syncs)
+        sizes = []
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "segment.guac")
+            for index in range(len(boundaries)):
+                writer.write(path, index)
+                with open(path, "rb") as f:
+                    sizes.append(f.read().index(b"4.sync,"))
+        return sizes
+
+    def test_mouse_cursor_and_compositing_keep_only_the_latest(self):
+        data = guac_instruction("size", "0", "1024", "768")
+        data += guac_instruction("rect", "0", "0", "0", "10", "10")
+        data += guac_instruction("cfill", "14", "0", "255", "0", "0", "255")
+        for second in range(600):
+            for step in range(20):
+                data += guac_instruction("mouse", f"{step:04d}", f"{second % 700:04d}", "0", "1700000000000")
+            data += guac_instruction("key", "65", "1", "1700000000000")
+            data += guac_instruction("size", "-1", "16", "16")
+            data += guac_instruction("cursor", "0", "0", "-1", "0", "0", "16", "16")
+            data += guac_instruction("shade", "1", f"{second % 256:03d}")
+            data += guac_instruction("move", "1", "0", f"{second % 700:04d}", "0", "0")
+            data += guac_instruction("sync", str(1700000000000 + second * 1000))
+        sizes = self.preambles(data)
+
+        # A long session's segments start from as much as its second segment does
+        self.assertEqual(len(sizes), 120)
+        self.assertEqual(max(sizes[1:]), min(sizes[1:]))
+        self.assertLess(sizes[-1], 400)
+
+    def test_disposed_layers_are_forgotten(self):
+        data = guac_instruction("size", "0", "1024", "768")
+        for second in range(60):
+            # A scrollbar-like layer that is drawn, painted over and torn down again
+            data += guac_instruction("size", "1", "16", "768")
+            for _ in range(3):
+                data += guac_instruction("rect", "1", "0", "0", "16", "768")
+                data += guac_instruction("cfill", "12", "1", "0", "0", "0", "255")
+            data += guac_instruction("shade", "1", "128")
+            if second % 2:
+                data += guac_instruction("dispose", "1")
+            data += guac_instruction("sync", str(1700000000000 + second * 1000))
+        segments = self.write_segments(data)
+
+        for segment in segments[1:]:
+            opcodes = [opcode for opcode, _ in segment]
+            prefix = opcodes[:opcodes.index("sync")]
+            self.assertLessEqual(prefix.count("cfill"), 1)
+            self.assertLessEqual(prefix.count("shade"), 1)
+            self.assertNotIn("dispose", prefix)
+
+    def test_segments_are_encoded_in_parallel_and_joined_in_order(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, "testid-abc")
+            with open(source, "wb") as f:
+                f.write(guac_recording(20))
+            running = []
+            peak = []
+            on_disk = []
+            lock = threading.Lock()
+
+            def encode(path):
+                with lock:
+                    running.append(path)
+                    peak.append(len(running))
+                    # Segments are written as workers free up rather than all up front
+                    on_disk.append(len([name for name in os.listdir(os.path.dirname(path)) if name.endswith(".guac")]))
+                time.sleep(0.1)
+                with lock:
+                    running.remove(path)
+                return f"{path}.mp4"
+
+            progress = []
+            with mock.patch.object(transcode, "encode_h264_segment", side_effect=encode), \
+                    mock.patch.object(transcode, "concatenate") as concatenate:
+                segments = transcode.transcode(source, f"{source}.mp4", segment_seconds=5, workers=2,
+                                               on_progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(segments, 4)
+        self.assertEqual(max(peak), 2)
+        self.assertLessEqual(max(on_disk), 2)
+        self.assertEqual(progress, [(0, 4), (1, 4), (2, 4), (3, 4), (4, 4)])
+        videos = concatenate.call_args[0][0]
+        self.assertEqual([os.path.basename(video) for video in videos],
+                         [f"segment-{index:04d}.guac.mp4" for index in range(4)])
+
+
+@override_settings(RECORDINGS_BUCKET="bucket")
+class LiveShippingTests(TestCase):
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.close()
+        self.path = f.name
+        self.addCleanup(os.unlink, self.path)
+        self.s3 = FakeS3()
+
+    def append(self, size):
+        data = os.urandom(size)
+        with open(self.path, "ab") as f:
+            f.write(data)
+        return data
+
+    def ship(self, final=False):
+        return shipping.ship_chunks("abc", self.path, final=final, chunk_size=1024, s3=self.s3)
+
+    def test_only_whole_chunks_leave_while_the_file_grows(self):
+        self.append(2500)
+        self.assertEqual(self.ship(), 2)
+        self.assertEqual(self.ship(), 0)
+        self.append(600)
+        self.assertEqual(self.ship(), 1)
+        self.assertEqual(RecordedSession.objects.get(test_id="abc").shipped_bytes, 3072)
+        self.assertNotIn(shipping.manifest_key("abc"), self.s3.objects)
+
+    def test_session_end_ships_last_chunk_and_manifest(self):
+        data = self.append(2500)
+        self.ship()
+        data += self.append(100)
+        self.assertEqual(self.ship(final=True), 1)
+
+        manifest = json.loads(self.s3.objects[shipping.manifest_key("abc")][0])
+        self.assertEqual(manifest["size"], 2600)
+        self.assertEqual([chunk["size"] for chunk in manifest["chunks"]], [1024, 1024, 552])
+        shipped = b"".join(self.s3.objects[chunk["key"]][0] for chunk in manifest["chunks"])
+        self.assertEqual(shipped, data)
+        for chunk in manifest["chunks"]:
+            self.assertEqual(chunk["sha256"], self.s3.objects[chunk["key"]][1])
+
+    def test_concurrent_run_does_not_record_a_chunk_twice(self):
+        RecordedSession.objects.create(test_id="abc", video_path="")
+        self.append(1024)
+        put_object = self.s3.put_object
+
+        def shipped_meanwhile(**kwargs):
+            # Another worker ships and records the same chunk while this upload is in flight
+            put_object(**kwargs)
+            RecordedSession.objects.filter(test_id="abc").update(
+                shipped_bytes=1024, chunks=[{"size": 1024, "sha256": kwargs["ChecksumSHA256"]}]
+            )
+
+        self.s3.put_object = shipped_meanwhile
+        self.assertEqual(self.ship(), 0)
+        self.assertEqual(len(RecordedSession.objects.get(test_id="abc").chunks), 1)
+
+
+class ScrubbingTests(SimpleTestCase):
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.workdir = workdir.name
+        self.source = os.path.join(self.workdir, "testid-abc")
+        self.tiled = []
+
+    def encode(self, path, size, bitrate):
+        with open(path, "rb") as f:
+            self.segments.append(f.read())
+        open(f"{path}.m4v", "wb").close()
+        return f"{path}.m4v"
+
+    def tile(self, video, workdir, first_sheet, count, lead, interval):
+        self.tiled.append((first_sheet, count))
+        for index in range(first_sheet, first_sheet + (count or 1)):
+            open(os.path.join(workdir, f"sheet-{index:04d}.jpg"), "wb").close()
+
+    def render(self, seconds, first_sheet=0, final=False, resume=None):
+        with open(self.source, "wb") as f:
+            f.write(guac_recording(seconds))
+        self.tiled = []
+        self.segments = []
+        with tempfile.TemporaryDirectory() as workdir, \
+                mock.patch.object(scrubbing, "encode_segment", side_effect=self.encode), \
+                mock.patch.object(scrubbing, "tile", side_effect=self.tile):
+            # One thumbnail a second, so each sheet covers 100 seconds
+            sheets, self.resume = scrubbing.render_sheets(self.source, workdir, first_sheet, final, interval=1, resume=resume)
+            return sorted(sheets)
+
+    def test_growing_recording_only_gets_complete_sheets(self):
+        self.assertEqual(self.render(250), [0, 1])
+        self.assertEqual(self.tiled, [(0, 1), (1, 1)])
+
+    def test_later_runs_only_render_new_sheets(self):
+        self.assertEqual(self.render(250, first_sheet=2), [])
+        self.assertEqual(self.render(350, first_sheet=2), [2])
+        self.assertEqual(self.tiled, [(2, 1)])
+
+    def test_later_runs_only_parse_what_was_added(self):
+        self.render(350, first_sheet=2)
+        from_scratch = self.segments
+        self.render(250)
+        resume = self.resume
+        self.assertEqual(resume["origin"], 1700000000000)
+        saved = os.path.getsize(scrubbing.state_path(self.source, resume["offset"]))
+
+        parsed = []
+
+        def plan_segments(data, *args):
+            parsed.append(len(data))
+            return transcode.plan_segments(data, *args)
+
+        with mock.patch.object(scrubbing, "plan_segments", side_effect=plan_segments):
+            self.assertEqual(self.render(350, first_sheet=2, resume=resume), [2])
+        # The saved state and what was written from the resume offset on, not the whole recording
+        self.assertEqual(parsed, [saved + len(guac_recording(350)) - resume["offset"]])
+        self.assertEqual(self.segments, from_scratch)
+        self.assertGreater(self.resume["offset"], resume["offset"])
+
+    def test_final_run_adds_the_partial_last_sheet(self):
+        self.assertEqual(self.render(250, first_sheet=2, final=True), [2])
+        self.assertEqual(self.tiled, [(2, None)])
+        self.assertIsNone(self.resume)
+
+    def test_keyframe_index_is_thinned_and_delta_encoded(self):
+        probe_output = "0.000000,48,K__\n0.040000,900,___\n0.480000,1500,K__\n1.200000,4000,K__\n2.400000,9000,K__\n"
+        with mock.patch.object(scrubbing.subprocess, "run") as run:
+            run.return_value.returncode = 0
+            run.return_value.stdout = probe_output
+            index = scrubbing.keyframe_index("video.mp4")
+        self.assertEqual(index, {"times": [0, 1200, 1200], "offsets": [48, 3952, 5000]})
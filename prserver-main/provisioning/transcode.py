@@ -0,0 +1,511 @@
+import base64
+import bisect
+import logging
+import math
+import mmap
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+GUACENC = "guacenc"
+FFMPEG = "ffmpeg"
+
+
+class TranscodeError(Exception):
+    """guacenc or ffmpeg failed on a recording."""
+
+
+class EmptyRecordingError(TranscodeError):
+    """The recording has no frames, e.g. a session that was opened but never drew anything."""
+
+
+def skip_codepoints(data, start, count):
+    """Offset `count` UTF-8 characters after `start`. Guacamole element lengths count characters, not bytes."""
+    end = start + count
+    if data[start:end].isascii():
+        return end
+    position = start
+    for _ in range(count):
+        lead = data[position]
+        position += 1 if lead < 0x80 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+    return position
+
+
+def instructions(data, start=0):
+    """
+    Yields (offset, end, opcode, first argument) for each instruction of a Guacamole protocol
+    dump from `start` on, e.g. b"4.sync,13.1700000000000;". Arguments other than the first are
+    skipped unread.
+    """
+    position = start
+    size = len(data)
+    while position < size:
+        offset = position
+        elements = []
+        while True:
+            dot = data.find(b".", position)
+            if dot < 0:
+                return  # Truncated last instruction, e.g. a recording still being written
+            end = skip_codepoints(data, dot + 1, int(data[position:dot]))
+            if len(elements) < 2:
+                elements.append(bytes(data[dot + 1:end]))
+            if end >= size:
+                return
+            terminator = data[end:end + 1]
+            position = end + 1
+            if terminator == b";":
+                break
+        yield offset, position, elements[0].decode(), elements[1] if len(elements) > 1 else b""
+
+
+def plan_segments(data, segment_seconds, origin=None):
+    """
+    Splits a recording at "sync" instructions (the frame boundaries guacenc renders on) into
+    segments of `segment_seconds`, counted from the first sync, or from the `origin` timestamp
+    when `data` is the later part of a recording. Returns (boundaries, syncs): the byte offset of
+    the first sync in each such span that has one, and the (offset, end, timestamp) of every sync
+    instruction.
+    """
+    boundaries = []
+    syncs = []
+    first, span = origin, None
+    for offset, end, opcode, argument in instructions(data):
+        if opcode != "sync":
+            continue
+        timestamp = int(argument)
+        syncs.append((offset, end, timestamp))
+        if first is None:
+            first = timestamp
+        if span is None or (timestamp - first) // (segment_seconds * 1000) > span:
+            boundaries.append(offset)
+            span = (timestamp - first) // (segment_seconds * 1000)
+    return boundaries, syncs
+
+
+# Where the destination layer sits among each drawing instruction's arguments
+DRAW_TARGETS = {
+    "arc": 0, "cfill": 1, "close": 0, "copy": 6, "cstroke": 1, "curve": 0, "jpeg": 1, "lfill": 1,
+    "line": 0, "lstroke": 1, "png": 1, "rect": 0, "start": 0, "transfer": 6,
+}
+# Instructions that read another layer's pixels, and where that layer sits among their arguments
+DRAW_SOURCES = {"copy": 0, "cursor": 2, "lfill": 2, "lstroke": 5, "transfer": 0}
+# Instructions that change a layer's size, clipping or transform rather than its pixels
+LAYER_STATE = {
+    "clip", "dispose", "distort", "identity", "move", "pop", "push", "reset", "set", "shade", "size", "transform",
+}
+# Of those, the ones that only set how a layer is composited, so the latest one of each replaces the rest
+COMPOSITING = {"distort", "move", "set", "shade"}
+PATH_OPS = {"arc", "close", "curve", "line", "rect", "start"}
+PATH_CONSUMERS = {"cfill", "clip", "cstroke", "lfill", "lstroke"}
+# Channel masks: SRC replaces what is under it, OVER only does so where the source is opaque
+MASK_SRC = 0xC
+MASK_OVER = 0xE
+
+
+def instruction_elements(data, offset):
+    """Every element of the instruction at `offset`, opcode first."""
+    elements = []
+    position = offset
+    while True:
+        dot = data.find(b".", position)
+        end = skip_codepoints(data, dot + 1, int(data[position:dot]))
+        elements.append(bytes(data[dot + 1:end]))
+        position = end + 1
+        if data[end:end + 1] == b";":
+            return elements
+
+
+def image_size(image):
+    """(width, height, opaque) from the header of PNG or JPEG data, or None for anything else."""
+    if image.startswith(b"\x89PNG\r\n\x1a\n") and len(image) >= 26:
+        # Colour types 0 (grey) and 2 (RGB) have no alpha channel
+        return int.from_bytes(image[16:20], "big"), int.from_bytes(image[20:24], "big"), image[25] in (0, 2)
+    if image.startswith(b"\xff\xd8"):
+        position = 2
+        while position + 9 <= len(image) and image[position] == 0xFF:
+            marker = image[position + 1]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                # Start of frame: length, precision, then height and width
+                height = int.from_bytes(image[position + 5:position + 7], "big")
+                return int.from_bytes(image[position + 7:position + 9], "big"), height, True
+            position += 2 + int.from_bytes(image[position + 2:position + 4], "big")
+    return None
+
+
+class Layer:
+    """A visible layer, or an off-screen buffer (negative index), and what is kept of the instructions on it."""
+
+    def __init__(self, index):
+        self.index = index
+        self.drawing = []  # (offset, source layer, image) of kept drawing on it, in order
+        self.covers = []  # (start, done) offsets of the drawing that painted over all of it, in order
+        self.reads = []  # offsets of kept instructions that read its pixels, in order
+        self.sizes = []  # offsets of kept size instructions
+        self.compositing = {}  # opcode (and property, for set) -> offset of the latest one
+        self.other = []  # offsets of its other kept instructions: clips, transforms, its disposal
+        self.disposed = False
+        self.width = self.height = 0
+        self.plain = True  # no clip or transform, so a full-size fill or image covers it
+        self.bounded = True  # buffers grow to fit what is drawn; False once that is more than is known
+        self.path = None  # [offset the path started at, whether it holds a full-size rect]
+
+
+class DisplayState:
+    """
+    The instructions of a recording that still matter for what the display looks like at some
+    point, so a segment can start from them rather than from everything before it. Fed
+    instructions in order, it forgets drawing on a layer or buffer once a fill or image covers
+    all of it, unless something kept read it in between; layers and buffers once they are
+    disposed and nothing kept reads them; and all but the latest mouse position, cursor and
+    compositing setting of each layer. What is kept is so bounded by what is on screen and in
+    guacd's caches, not by how long the recording is. Clips and transforms, which guacd's
+    protocol plugins don't send, are kept whenever seen, and so is anything else it can't prove
+    unneeded. Syncs and the data of streams other than images, which guacenc ignores, are never
+    kept; of any other instruction guacenc ignores, only the latest of each opcode is.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.kept = {}  # offset -> end of each instruction still needed, in recording order
+        self.layers = {}  # layer index -> live Layer
+        self.streams = {}  # stream index -> (Layer, image details) of image streams being received
+        self.cursor = None  # (offset, source Layer) of the latest cursor
+        self.latest = {}  # opcode -> offset of the latest mouse position or instruction guacenc ignores
+
+    def write_to(self, f):
+        for offset, end in self.kept.items():
+            f.write(self.data[offset:end])
+
+    def layer(self, index):
+        if index not in self.layers:
+            self.layers[index] = Layer(index)
+        return self.layers[index]
+
+    def keep(self, offset, end, layer, source=None, image=None):
+        """Keeps an instruction that draws on `layer`, reading `source`'s pixels or receiving `image` if given."""
+        self.kept[offset] = end
+        if source is layer:
+            source = None  # A layer reading itself (scrolling) is drawing like any other
+        if source:
+            source.reads.append(offset)
+        layer.drawing.append((offset, source, image))
+
+    def replace(self, previous, offset, end):
+        """Keeps an instruction in place of the one at `previous`, if any."""
+        if previous is not None:
+            del self.kept[previous]
+        self.kept[offset] = end
+
+    def needed(self, layer, offset, image):
+        """Whether drawing on `layer` at `offset` can still show: on the layer, or through something that read it."""
+        if image:
+            if image["open"]:
+                return True
+            offset = image["end"]  # An image is drawn when its stream ends
+        cover = bisect.bisect_right(layer.covers, (offset, math.inf))
+        done = layer.covers[cover][1] if cover < len(layer.covers) else None
+        if done is None and not layer.disposed:
+            return True
+        read = bisect.bisect_right(layer.reads, offset)
+        return read < len(layer.reads) and (done is None or layer.reads[read] < done)
+
+    def prune(self, *layers):
+        """
+        Drops what nothing can show any more from the given layers: drawing painted over before
+        anything kept read it, sizes it no longer starts from, and all of a disposed layer once
+        nothing kept reads it. Layers only the dropped drawing read are pruned in turn.
+        """
+        pending = list(layers)
+        while pending:
+            layer = pending.pop()
+            remaining = []
+            for entry in layer.drawing:
+                offset, source, image = entry
+                if self.needed(layer, offset, image):
+                    remaining.append(entry)
+                    continue
+                del self.kept[offset]
+                if source:
+                    source.reads.remove(offset)
+                    pending.append(source)
+            layer.drawing = remaining
+
+            if layer.disposed and not remaining and not layer.reads:
+                for offset in (*layer.sizes, *layer.compositing.values(), *layer.other):
+                    del self.kept[offset]
+                layer.sizes, layer.compositing, layer.other, layer.covers = [], {}, [], []
+                continue
+            first = remaining[0][0] if remaining else math.inf
+            earlier = sum(offset < first for offset in layer.sizes)
+            for offset in layer.sizes[:earlier - 1]:
+                del self.kept[offset]
+            layer.sizes = layer.sizes[max(earlier - 1, 0):]
+            layer.covers = [cover for cover in layer.covers if cover[0] > first]
+
+    def cover(self, layer, start, done):
+        """Notes that drawing from `start` to `done` painted over all of `layer`, and forgets what that made unneeded."""
+        layer.covers.append((start, done))
+        self.prune(layer)
+
+    def covers(self, layer, x, y, width, height):
+        """Whether drawing at (x, y) of the given size would paint over all of `layer`."""
+        if not (layer.plain and layer.bounded and layer.width and layer.height):
+            return False
+        return x <= 0 and y <= 0 and x + width >= layer.width and y + height >= layer.height
+
+    def extend(self, layer, extent):
+        """Grows a buffer to fit drawing reaching (x, y), or stops trusting its size if that isn't known."""
+        if layer.index >= 0:
+            return
+        if extent is None:
+            layer.bounded = False
+        else:
+            layer.width, layer.height = max(layer.width, extent[0]), max(layer.height, extent[1])
+
+    def add(self, offset, end, opcode, argument):
+        if opcode == "sync":
+            return
+        if opcode in ("blob", "end"):
+            self.add_stream_data(offset, end, opcode, int(argument))
+        elif opcode == "img":
+            self.add_image(offset, end, instruction_elements(self.data, offset))
+        elif opcode in DRAW_TARGETS:
+            self.add_drawing(offset, end, opcode, instruction_elements(self.data, offset))
+        elif opcode in LAYER_STATE:
+            self.add_layer_state(offset, end, opcode, int(argument))
+        elif opcode == "cursor":
+            # The cursor is drawn from a layer's pixels but isn't part of any layer; the latest one replaces the rest
+            source = self.layer(int(instruction_elements(self.data, offset)[DRAW_SOURCES["cursor"] + 1]))
+            source.reads.append(offset)
+            self.kept[offset] = end
+            if self.cursor:
+                previous, previous_source = self.cursor
+                del self.kept[previous]
+                previous_source.reads.remove(previous)
+                self.prune(previous_source)
+            self.cursor = (offset, source)
+        else:
+            # The mouse position, and instructions guacenc ignores such as key presses and the connection name
+            self.replace(self.latest.get(opcode), offset, end)
+            self.latest[opcode] = offset
+
+    def add_drawing(self, offset, end, opcode, elements):
+        layer = self.layer(int(elements[DRAW_TARGETS[opcode] + 1]))
+        source = self.layer(int(elements[DRAW_SOURCES[opcode] + 1])) if opcode in DRAW_SOURCES else None
+        if opcode in PATH_OPS and layer.path is None:
+            layer.path = [offset, False]
+        self.keep(offset, end, layer, source)
+
+        if opcode == "rect":
+            x, y, width, height = (int(value) for value in elements[2:6])
+            self.extend(layer, (x + width, y + height))
+            if self.covers(layer, x, y, width, height):
+                layer.path[1] = True
+        elif opcode in ("copy", "transfer"):
+            width, height, x, y = (int(value) for value in (*elements[4:6], *elements[8:10]))
+            self.extend(layer, (x + width, y + height))
+        elif opcode not in PATH_CONSUMERS and opcode != "close":
+            self.extend(layer, None)  # Arcs, curves and lines, and the deprecated inline png and jpeg
+        if opcode == "cfill":
+            mask, alpha = int(elements[1]), int(elements[6])
+            opaque = mask == MASK_SRC or (mask == MASK_OVER and alpha == 255)
+            if layer.path and layer.path[1] and opaque and layer.plain:
+                self.cover(layer, layer.path[0], offset)
+        if opcode in PATH_CONSUMERS:
+            layer.path = None
+
+    def add_image(self, offset, end, elements):
+        stream, mask, layer = int(elements[1]), int(elements[2]), self.layer(int(elements[3]))
+        # Its size, and so whether it covers the layer, is known once the first blob brings its header
+        image = {"mask": mask, "x": int(elements[5]), "y": int(elements[6]), "open": True, "header": True, "covers": False}
+        self.keep(offset, end, layer, image=image)
+        self.streams[stream] = (layer, image)
+
+    def add_stream_data(self, offset, end, opcode, stream):
+        if stream not in self.streams:
+            return  # Audio, clipboard, file and pipe streams don't show in the video
+        layer, image = self.streams[stream]
+        self.keep(offset, end, layer, image=image)
+        if opcode == "blob" and image["header"]:
+            image["header"] = False
+            size = image_size(base64.b64decode(instruction_elements(self.data, offset)[2]))
+            if size:
+                width, height, opaque = size
+                self.extend(layer, (image["x"] + width, image["y"] + height))
+                replaces = opaque or image["mask"] == MASK_SRC
+                image["covers"] = replaces and image["mask"] in (MASK_SRC, MASK_OVER) and self.covers(
+                    layer, image["x"], image["y"], width, height
+                )
+            else:
+                self.extend(layer, None)
+        elif opcode == "end":
+            image["open"] = False
+            image["end"] = offset
+            del self.streams[stream]
+            # The image is drawn when its stream ends, over everything drawn before that
+            if image["covers"] and layer.plain:
+                self.cover(layer, offset, offset)
+
+    def add_layer_state(self, offset, end, opcode, index):
+        layer = self.layer(index)
+        if opcode in COMPOSITING:
+            key = opcode
+            if opcode == "set":
+                key = (opcode, instruction_elements(self.data, offset)[2])
+            self.replace(layer.compositing.get(key), offset, end)
+            layer.compositing[key] = offset
+            return
+
+        self.kept[offset] = end
+        if opcode == "size":
+            layer.sizes.append(offset)
+            layer.width, layer.height = (int(value) for value in instruction_elements(self.data, offset)[2:4])
+            layer.bounded = True
+            return
+        layer.other.append(offset)
+        if opcode == "dispose" and index != 0:
+            layer.disposed = True
+            del self.layers[index]
+            self.prune(layer)
+        elif opcode == "reset":
+            layer.plain = True
+        elif opcode in ("clip", "pop", "push", "transform"):
+            layer.plain = False
+        if opcode == "clip":
+            layer.path = None
+
+
+class SegmentWriter:
+    """
+    Writes the segments plan_segments found as standalone recordings guacenc can render, in
+    order: the display state as it stands at the segment's start (see DisplayState), then the
+    segment itself up to and including the sync that starts the next one. Each segment's
+    instructions are read once, so writing them all is linear in the recording's length.
+    """
+
+    def __init__(self, data, boundaries, syncs):
+        self.data = data
+        self.boundaries = boundaries
+        self.sync_ends = {offset: end for offset, end, _ in syncs}
+        self.state = DisplayState(data)
+        self.position = 0
+
+    def advance(self, offset):
+        """Feeds the state every instruction before `offset`, which must not go backwards."""
+        for instruction in instructions(self.data, self.position):
+            if instruction[0] >= offset:
+                break
+            self.state.add(*instruction)
+        self.position = offset
+
+    def write(self, path, index):
+        start = self.boundaries[index]
+        if index + 1 < len(self.boundaries):
+            stop = self.sync_ends[self.boundaries[index + 1]]
+        else:
+            stop = len(self.data)
+        self.advance(start)
+        with open(path, "wb") as f:
+            self.state.write_to(f)
+            f.write(self.data[start:stop])
+
+
+def encode_segment(path, size=None, bitrate=None):
+    """Renders one segment to `path`.m4v with guacenc, at RECORDING_VIDEO_SIZE and RECORDING_VIDEO_BITRATE by default."""
+    size = size or settings.RECORDING_VIDEO_SIZE
+    bitrate = bitrate or settings.RECORDING_VIDEO_BITRATE
+    command = [GUACENC, "-s", size, "-r", str(bitrate), "-f", path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise TranscodeError(f"guacenc failed on {path}: {result.stderr.strip()}")
+    return f"{path}.m4v"
+
+
+def encode_h264_segment(path):
+    """
+    Renders one segment with guacenc and re-encodes it to H.264 at RECORDING_VIDEO_BITRATE in
+    `path`.mp4. guacenc only writes MPEG-4 Part 2, which browsers can't play; doing this per segment
+    keeps the re-encode in the parallel step. Returns the output path.
+    """
+    video = encode_segment(path)
+    output = f"{path}.mp4"
+    command = [FFMPEG, "-y", "-v", "error", "-i", video, "-an", "-c:v", "libx264", "-preset", "veryfast",
+               "-pix_fmt", "yuv420p", "-b:v", str(settings.RECORDING_VIDEO_BITRATE), output]
+    result = subprocess.run(command, capture_output=True, text=True)
+    os.unlink(video)
+    if result.returncode != 0:
+        raise TranscodeError(f"ffmpeg could not re-encode {video} to H.264: {result.stderr.strip()}")
+    return output
+
+
+def concatenate(videos, output):
+    """Joins the H.264 segments without re-encoding, with the index up front so playback can start and seek at once."""
+    list_path = f"{output}.txt"
+    with open(list_path, "w") as f:
+        f.writelines(f"file '{video}'\n" for video in videos)
+    partial = f"{output}.part.mp4"
+    command = [FFMPEG, "-y", "-v", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+               "-c", "copy", "-movflags", "+faststart", partial]
+    result = subprocess.run(command, capture_output=True, text=True)
+    os.unlink(list_path)
+    if result.returncode != 0:
+        raise TranscodeError(f"ffmpeg could not join {len(videos)} segment(s) into {output}: {result.stderr.strip()}")
+    os.replace(partial, output)
+
+
+def transcode(source, output, segment_seconds=None, workers=None, on_progress=None):
+    """
+    Converts a Guacamole recording to a browser-playable H.264 faststart MP4 at `output`. Long
+    recordings are cut into segments of `segment_seconds` that are encoded by up to `workers`
+    guacenc and ffmpeg processes at once, then joined losslessly. `on_progress(done, total)` is
+    called as each segment finishes. Returns the number of segments.
+    """
+    segment_seconds = segment_seconds or settings.TRANSCODE_SEGMENT_SECONDS
+    workers = workers or settings.TRANSCODE_WORKERS
+    if os.path.getsize(source) == 0:
+        raise EmptyRecordingError(f"{source} is empty")
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        boundaries, syncs = plan_segments(data, segment_seconds)
+        if not boundaries:
+            raise EmptyRecordingError(f"{source} has no frames to encode")
+
+        with tempfile.TemporaryDirectory(prefix="transcode-") as workdir:
+            total = len(boundaries)
+            if on_progress:
+                on_progress(0, total)
+            writer = SegmentWriter(data, boundaries, syncs)
+            videos = [None] * total
+            running = {}
+
+            def collect(finished):
+                for future in finished:
+                    index = running.pop(future)
+                    videos[index], elapsed = future.result()
+                    os.unlink(os.path.join(workdir, f"segment-{index:04d}.guac"))
+                    done = sum(video is not None for video in videos)
+                    logger.info(f"Encoded segment {index + 1}/{total} of {source} in {elapsed:.1f}s ({done}/{total} done)")
+                    if on_progress:
+                        on_progress(done, total)
+
+            # Segments are written as workers free up, so only `workers` of them are on disk at once
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for index in range(total):
+                    if len(running) >= workers:
+                        collect(wait(running, return_when=FIRST_COMPLETED).done)
+                    path = os.path.join(workdir, f"segment-{index:04d}.guac")
+                    writer.write(path, index)
+                    running[pool.submit(timed, encode_h264_segment, path)] = index
+                collect(as_completed(list(running)))
+            concatenate(videos, output)
+    return total
+
+
+def timed(function, *args):
+    started = time.monotonic()
+    return function(*args), time.monotonic() - started
@@ -0,0 +1,139 @@
+import base64
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from django.conf import settings
+from .aws import client
+
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB  # S3 rejects smaller parts, except the last one
+LIST_PARTS_PAGE_SIZE = 1000
+
+
+class UploadVerificationError(Exception):
+    """The object S3 stored does not match the local file."""
+
+
+def transfer_config():
+    """Part size and parallel part uploads from settings, as a boto3 TransferConfig."""
+    part_size = max(settings.RECORDING_UPLOAD_PART_SIZE * MB, MIN_PART_SIZE)
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=settings.RECORDING_UPLOAD_CONCURRENCY,
+    )
+
+
+def sha256_b64(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def composite_checksum(part_checksums):
+    """The ChecksumSHA256 S3 reports for a multipart object: a checksum of the part checksums, plus the part count."""
+    digests = b"".join(base64.b64decode(checksum) for checksum in part_checksums)
+    return f"{sha256_b64(digests)}-{len(part_checksums)}"
+
+
+def read_part(path, number, part_size):
+    with open(path, "rb") as f:
+        f.seek((number - 1) * part_size)
+        return f.read(part_size)
+
+
+def pending_upload(s3, bucket, key):
+    """The newest multipart upload of `key` an earlier attempt left unfinished, if any."""
+    uploads = s3.list_multipart_uploads(Bucket=bucket, Prefix=key).get("Uploads", [])
+    uploads = [upload for upload in uploads if upload["Key"] == key]
+    if not uploads:
+        return None
+    return max(uploads, key=lambda upload: upload["Initiated"])["UploadId"]
+
+
+def uploaded_parts(s3, bucket, key, upload_id):
+    """{part number: ChecksumSHA256} of the parts S3 already holds for `upload_id`."""
+    parts = {}
+    marker = 0
+    while True:
+        page = s3.list_parts(
+            Bucket=bucket, Key=key, UploadId=upload_id, MaxParts=LIST_PARTS_PAGE_SIZE, PartNumberMarker=marker
+        )
+        for part in page.get("Parts", []):
+            parts[part["PartNumber"]] = {"ETag": part["ETag"], "ChecksumSHA256": part.get("ChecksumSHA256")}
+        if not page.get("IsTruncated"):
+            return parts
+        marker = page["NextPartNumberMarker"]
+
+
+def upload_bytes(data, bucket, key, s3=None, **extra):
+    """
+    Uploads `data` in a single request, sent with its SHA-256 so S3 rejects it if corrupted.
+    `extra` goes to put_object as is, e.g. ContentType. Returns the checksum.
+    """
+    s3 = s3 or client("s3")
+    checksum = sha256_b64(data)
+    s3.put_object(Bucket=bucket, Key=key, Body=data, ChecksumSHA256=checksum, **extra)
+    return checksum
+
+
+def upload_file(path, bucket, key, config=None, s3=None):
+    """
+    Streams `path` to s3://bucket/key in parts of config.multipart_chunksize, up to
+    config.max_concurrency at a time, each sent with its SHA-256 so S3 rejects a corrupted part.
+
+    An interrupted upload is resumed: parts S3 already holds with a matching checksum are kept,
+    so a retry only sends what is missing. Once complete, the object's checksum is compared with
+    the local file's and UploadVerificationError is raised on a mismatch. Returns that checksum.
+    """
+    config = config or transfer_config()
+    s3 = s3 or client("s3")
+    size = os.path.getsize(path)
+    part_size = config.multipart_chunksize
+
+    if size < config.multipart_threshold:
+        with open(path, "rb") as f:
+            expected = upload_bytes(f.read(), bucket, key, s3)
+        verify_upload(s3, bucket, key, size, expected)
+        return expected
+
+    upload_id = pending_upload(s3, bucket, key)
+    existing = {}
+    if upload_id:
+        existing = uploaded_parts(s3, bucket, key, upload_id)
+        logger.info(f"Resuming upload of {key} ({len(existing)} part(s) already in S3)")
+    else:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ChecksumAlgorithm="SHA256")["UploadId"]
+
+    def send(number):
+        data = read_part(path, number, part_size)
+        checksum = sha256_b64(data)
+        previous = existing.get(number)
+        if previous and previous["ChecksumSHA256"] == checksum:
+            etag = previous["ETag"]
+        else:
+            etag = s3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data, ChecksumSHA256=checksum
+            )["ETag"]
+        return {"PartNumber": number, "ETag": etag, "ChecksumSHA256": checksum}
+
+    count = -(-size // part_size)
+    with ThreadPoolExecutor(max_workers=config.max_concurrency) as pool:
+        parts = list(pool.map(send, range(1, count + 1)))
+
+    s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    expected = composite_checksum([part["ChecksumSHA256"] for part in parts])
+    verify_upload(s3, bucket, key, size, expected)
+    return expected
+
+
+def verify_upload(s3, bucket, key, size, expected):
+    head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+    if head["ContentLength"] != size or head.get("ChecksumSHA256") != expected:
+        raise UploadVerificationError(
+            f"s3://{bucket}/{key} is {head['ContentLength']} bytes with checksum {head.get('ChecksumSHA256')}, "
+            f"expected {size} bytes with checksum {expected}"
+        )
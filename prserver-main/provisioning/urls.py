@@ -0,0 +1,11 @@
+from django.urls import path
+from . import views
+
+
+urlpatterns = [
+    path('status/<uuid:public_id>/', views.provisioning_status, name='provisioning_status'),
+    path('guest-ready/<str:token>/', views.guest_ready, name='guest_ready'),
+    path('guacamole-tunnel/<uuid:public_id>/', views.guacamole_tunnel, name='guacamole_tunnel'),
+    path('metrics/guac-db/', views.guac_db_metrics, name='guac_db_metrics'),
+    path('metrics/task-queues/', views.task_queue_metrics, name='task_queue_metrics'),
+]
@@ -0,0 +1,161 @@
+import json
+import logging
+from botocore.exceptions import ClientError
+from django.db.models import Subquery
+from django.utils.timezone import now
+from utils.secrets import get_secret
+from . import guac_db
+from .aws import LazyClient
+from .models import WarmInstance
+
+
+logger = logging.getLogger(__name__)
+
+# AWS Configuration
+INSTANCE_TYPE = get_secret("INSTANCE_TYPE", "t2.micro")
+KEY_NAME = get_secret("KEY_NAME")
+SECURITY_GROUP = get_secret("SECURITY_GROUP")
+
+# describe_instances accepts at most 200 values per filter
+DESCRIBE_CHUNK_SIZE = 200
+
+# Instance IDs per terminate_instances call
+TERMINATE_BATCH_SIZE = 1000
+
+ec2 = LazyClient("ec2")
+
+
+def describe_instance_states(instance_ids):
+    """
+    Looks up many instances at once, one describe_instances call per DESCRIBE_CHUNK_SIZE IDs.
+    Returns {instance_id: (state, public_ip)}; IDs EC2 does not know about yet are simply absent.
+    """
+    states = {}
+    instance_ids = list(instance_ids)
+    paginator = ec2.get_paginator("describe_instances")
+    for start in range(0, len(instance_ids), DESCRIBE_CHUNK_SIZE):
+        chunk = instance_ids[start:start + DESCRIBE_CHUNK_SIZE]
+        # A filter rather than InstanceIds, so one not-yet-visible ID doesn't fail the whole call
+        pages = paginator.paginate(Filters=[{"Name": "instance-id", "Values": chunk}])
+        for page in pages:
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    states[instance["InstanceId"]] = (instance["State"]["Name"], instance.get("PublicIpAddress"))
+    return states
+
+
+def terminate_instance_batch(instance_ids):
+    """
+    Terminates a batch of instances in one call. EC2 rejects the whole call if any ID no longer
+    exists, so in that case only the IDs it still knows about are retried.
+    """
+    try:
+        ec2.terminate_instances(InstanceIds=instance_ids)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "InvalidInstanceID.NotFound":
+            raise
+        known = [
+            instance_id for instance_id, (state, _) in describe_instance_states(instance_ids).items()
+            if state != "terminated"
+        ]
+        if known:
+            ec2.terminate_instances(InstanceIds=known)
+
+
+def instances_for_client_tokens(client_tokens):
+    """IDs of live instances EC2 launched under any of the given ClientTokens."""
+    if not client_tokens:
+        return []
+    response = ec2.describe_instances(Filters=[
+        {"Name": "client-token", "Values": list(client_tokens)},
+        {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]},
+    ])
+    return [
+        instance["InstanceId"]
+        for reservation in response["Reservations"]
+        for instance in reservation["Instances"]
+    ]
+
+
+def dump_credentials(credentials):
+    """A connection's username and password, for a job's or warm instance's encrypted connection_credentials."""
+    return json.dumps({"username": credentials["username"], "password": credentials.get("password", "")})
+
+
+def load_credentials(value):
+    return json.loads(value)
+
+
+def launch_warm_instances(sub_test, count):
+    """
+    Launches `count` instances of the SubTest's AMI in a single run_instances call
+    and records them as booting warm-pool members.
+    """
+    response = ec2.run_instances(
+        ImageId=sub_test.ami_id,
+        InstanceType=INSTANCE_TYPE,
+        KeyName=KEY_NAME,
+        SecurityGroupIds=[SECURITY_GROUP],
+        MinCount=1,
+        MaxCount=count,
+        TagSpecifications=[{
+            "ResourceType": "instance",
+            "Tags": [
+                {"Key": "WarmPool", "Value": str(sub_test.id)},
+                {"Key": "Name", "Value": f"warm-{sub_test.name}"},
+            ],
+        }],
+    )
+    warm_instances = WarmInstance.objects.bulk_create([
+        WarmInstance(sub_test=sub_test, ami_id=sub_test.ami_id, instance_id=instance["InstanceId"])
+        for instance in response["Instances"]
+    ])
+    logger.info(f"Launched {len(warm_instances)} warm instance(s) for SubTest {sub_test.id} ({sub_test.ami_id})")
+    return warm_instances
+
+
+def claim_warm_instance(test_request, sub_test, attempts=3):
+    """
+    Hands a ready warm instance for the SubTest's AMI over to test_request.
+
+    The claim is a single UPDATE guarded on status='ready', so two candidates
+    racing for the same row can never both win it. Returns None when the pool is empty.
+    """
+    if not sub_test or not sub_test.ami_id:
+        return None
+
+    for _ in range(attempts):
+        candidate = (
+            WarmInstance.objects
+            .filter(ami_id=sub_test.ami_id, status="ready")
+            .order_by("created_at")
+            .values("pk")[:1]
+        )
+        claimed = WarmInstance.objects.filter(pk__in=Subquery(candidate), status="ready").update(
+            status="claimed",
+            test_request=test_request,
+            claimed_at=now(),
+        )
+        if claimed:
+            break
+        if not WarmInstance.objects.filter(ami_id=sub_test.ami_id, status="ready").exists():
+            return None
+    else:
+        return None
+
+    warm_instance = WarmInstance.objects.get(test_request=test_request)
+    public_id = str(test_request.public_id)
+    logger.info(f"Claimed warm instance {warm_instance.instance_id} for test_id {public_id}")
+
+    try:
+        # JSON-auth connections get their recording name when the room is rendered
+        if warm_instance.guacamole_connection_id:
+            guac_db.set_recording_name(warm_instance.guacamole_connection_id, f"testid-{public_id}")
+        ec2.create_tags(
+            Resources=[warm_instance.instance_id],
+            Tags=[{"Key": "TestID", "Value": public_id}],
+        )
+    except Exception as e:
+        logger.error(f"Error handing warm instance {warm_instance.instance_id} over to test_id {public_id}: {e}")
+
+    return warm_instance
@@ -0,0 +1,79 @@
+import functools
+from cryptography.fernet import Fernet, MultiFernet
+from django.conf import settings
+from django.db import models, transaction
+
+
+def keys():
+    """Fernet keys from RDP_ENCRYPTION_KEYS, newest first."""
+    if not settings.RDP_ENCRYPTION_KEYS:
+        raise RuntimeError("RDP_ENCRYPTION_KEYS is not configured.")
+    return settings.RDP_ENCRYPTION_KEYS
+
+
+@functools.lru_cache(maxsize=None)
+def cipher():
+    """
+    The process's MultiFernet: encrypts with the first key and decrypts with any of them, so a new
+    key can be put in front while tokens written under the old one stay readable until rotated.
+    """
+    return MultiFernet([Fernet(key) for key in keys()])
+
+
+def encrypt(value):
+    return cipher().encrypt(value.encode()).decode()
+
+
+def decrypt(token):
+    return cipher().decrypt(token.encode()).decode()
+
+
+class EncryptedTextField(models.TextField):
+    """
+    Text stored Fernet-encrypted and handed to Python in the clear. The empty string is stored as
+    is, so "not set" stays queryable; nothing else can be filtered on.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if not value:
+            return value
+        return decrypt(value)
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if not value:
+            return value
+        return encrypt(value)
+
+
+def encrypted_fields():
+    """(model, field name) for every EncryptedTextField in the project."""
+    from django.apps import apps
+
+    return [
+        (model, field.name)
+        for model in apps.get_models()
+        for field in model._meta.concrete_fields
+        if isinstance(field, EncryptedTextField)
+    ]
+
+
+def rotate(model, field_name, batch_size=500):
+    """
+    Re-encrypts one field of every row under the newest key, `batch_size` rows (locked) at a time
+    in primary key order, so the table is never read in one go. Returns how many rows were rewritten.
+    """
+    rotated = 0
+    last_pk = None
+    while True:
+        with transaction.atomic():
+            rows = model.objects.select_for_update().exclude(**{field_name: ""}).order_by("pk")
+            if last_pk is not None:
+                rows = rows.filter(pk__gt=last_pk)
+            batch = list(rows.values_list("pk", field_name)[:batch_size])
+            if not batch:
+                return rotated
+            # Values come back decrypted; saving them encrypts under the first key again
+            model.objects.bulk_update([model(pk=pk, **{field_name: value}) for pk, value in batch], [field_name])
+        rotated += len(batch)
+        last_pk = batch[-1][0]
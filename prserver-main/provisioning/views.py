@@ -0,0 +1,145 @@
+import logging
+import os
+from django.contrib.auth.decorators import user_passes_test
+from django.http import HttpResponse, JsonResponse, HttpResponseForbidden
+from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from dashboard.models import TestRequest
+from . import guac_api, guac_db
+from .callbacks import client_token_from
+from .jobs import start_provisioning, mark_guest_ready, room_session, uses_json_auth
+from .models import ProvisioningJob, LaunchAttempt
+from .queues import queue_metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Where browsers reach Guacamole (the API itself is called over the internal network)
+GUAC_PUBLIC_URL = "https://guac.truetohire.com/guacamole"
+
+
+def preparing_response(request, job):
+    """Renders the page a candidate sees while their test room is being provisioned."""
+    public_id = job.test_request.public_id
+    return render(request, "provisioning/preparing.html", {
+        "job": job,
+        "status_url": reverse("provisioning_status", kwargs={"public_id": public_id}),
+        "room_url": reverse(ProvisioningJob.ROOM_URL_NAMES[job.kind], kwargs={"public_id": public_id}),
+    })
+
+
+def start_room(request, test_request, kind):
+    """
+    Reserves (or finds) the test room's provisioning job. Redirects to the room once it is ready,
+    otherwise shows the preparing page; raises if the room cannot be provisioned.
+    """
+    sub_test = test_request.sub_tests.first()
+    if not sub_test or not sub_test.ami_id:
+        raise Exception("No valid AMI ID found for the selected SubTest.")
+
+    job = start_provisioning(test_request, sub_test, kind)
+    if job.state == "ready":
+        return redirect(ProvisioningJob.ROOM_URL_NAMES[kind], public_id=test_request.public_id)
+    if job.state == "failed":
+        raise Exception("Test room setup failed. Please contact the test administrator.")
+    return preparing_response(request, job)
+
+
+def may_open_room(request, test_request):
+    """The candidate who unlocked the room in this session, or a signed-in user of the company that owns it."""
+    if request.session.get("authenticated_test_id") == str(test_request.public_id):
+        return True
+    user = request.user
+    return user.is_authenticated and user.company_id is not None and user.company_id == test_request.company_id
+
+
+@require_GET
+def guacamole_tunnel(request, public_id):
+    """
+    Opens a Guacamole tunnel to a test room's connection. With the json backend the tunnel is
+    opened with a token that grants only that connection, and that token is returned with it; the
+    database backend opens it as the service account, whose token never goes in the response.
+    """
+    test_request = get_object_or_404(TestRequest, public_id=public_id)
+    if not may_open_room(request, test_request):
+        return HttpResponseForbidden("Not authorized for this test room.")
+    job = get_object_or_404(ProvisioningJob, test_request=test_request, state="ready")
+
+    try:
+        token, identifier = room_session(test_request, job.instance_id)
+        if not uses_json_auth(job):
+            # api_request renews the service-account token if Guacamole has revoked it
+            tunnel = guac_api.api_request("POST", "session/tunnels", data={"connection": identifier})
+            token = None
+        else:
+            response = guac_api.get_session().post(
+                f"{guac_api.GUAC_API_URL}/api/session/tunnels",
+                params={"token": token},
+                data={"connection": identifier},
+                timeout=10,
+            )
+            response.raise_for_status()
+            tunnel = response.json()
+        tunnel_uuid = tunnel["identifier"]
+        logger.info(f"Tunnel created for test_id {public_id} with ID {tunnel_uuid}")
+        data = {"guac_tunnel_id": tunnel_uuid, "guac_api_url": GUAC_PUBLIC_URL}
+        if token:
+            data["guac_token"] = token
+        return JsonResponse(data)
+    except Exception as e:
+        logger.error(f"Failed to create Guacamole tunnel for test_id {public_id}: {e}")
+        return HttpResponse(status=500)
+
+
+@require_GET
+def provisioning_status(request, public_id):
+    """Lightweight JSON view of a test room's provisioning state, polled by the preparing page."""
+    test_request = get_object_or_404(TestRequest, public_id=public_id)
+    unlocked = request.session.get("authenticated_test_id") == str(public_id)
+    owner = request.user.is_authenticated and test_request.created_by_id == request.user.id
+    if not (unlocked or owner):
+        return HttpResponseForbidden("Not authorized for this test room.")
+
+    job = get_object_or_404(ProvisioningJob, test_request=test_request)
+    return JsonResponse({
+        "state": job.state,
+        "ready": job.state == "ready",
+        "failed": job.state == "failed",
+        "phases": job.phase_timings(),
+    })
+
+
+@csrf_exempt
+@require_POST
+def guest_ready(request, token):
+    """
+    Boot callback from a test room instance's user-data once RDP/SSH is up. The signed URL is
+    single-use: it only counts while the job is unfinished and hasn't heard from its guest yet.
+    """
+    client_token = client_token_from(token)
+    if not client_token:
+        return HttpResponseForbidden("Invalid callback signature.")
+    attempt = LaunchAttempt.objects.filter(client_token=client_token).exclude(status="failed").first()
+    if not attempt:
+        return HttpResponse(status=404)
+
+    if not mark_guest_ready(attempt.job_id):
+        return HttpResponse(status=410)
+    logger.info(f"Instance {attempt.instance_id} reported its guest ready for provisioning job {attempt.job_id}")
+    return HttpResponse(status=204)
+
+
+@require_GET
+@user_passes_test(lambda user: user.is_superuser)
+def guac_db_metrics(request):
+    """Guacamole DB connection pool counters for the worker process serving the request."""
+    return JsonResponse({"pid": os.getpid(), **guac_db.pool_stats()})
+
+
+@require_GET
+@user_passes_test(lambda user: user.is_superuser)
+def task_queue_metrics(request):
+    """Depth and oldest wait of each background task queue, across all workers."""
+    return JsonResponse(queue_metrics())
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from background_task.models import Task
+from background_task.tasks import tasks
+from django.db import close_old_connections
+from django.utils.timezone import now
+from .aws import throttle_stats
+from .queues import DEFAULT_QUEUE
+
+
+logger = logging.getLogger(__name__)
+
+# How often each worker logs the queue wait times it has seen
+STATS_LOG_INTERVAL = 60
+
+
+def parse_queue_limits(values):
+    """Turns ["setup=8", "ami=1"] into {"setup": 8, "ami": 1}."""
+    limits = {}
+    for value in values:
+        queue, _, limit = value.partition("=")
+        if not queue or not limit.isdigit():
+            raise ValueError(f"Invalid queue limit '{value}', expected QUEUE=N.")
+        limits[queue] = int(limit)
+    return limits
+
+
+class TaskWorkerPool:
+    """
+    Runs django-background-tasks jobs on a pool of threads instead of one at a time.
+
+    A single dispatcher loop locks due tasks (the same atomic lock process_tasks uses, owned by
+    this process's pid) in priority order and hands them to the pool, holding back tasks whose
+    queue has already reached its limit in `queue_limits`. `queue_reserved` keeps that many
+    threads free for a queue, so other queues can never take the last threads it needs.
+    """
+
+    def __init__(self, threads, queue_limits=None, sleep=1.0, queue_reserved=None):
+        self.threads = threads
+        self.queue_limits = queue_limits or {}
+        self.queue_reserved = queue_reserved or {}
+        self.sleep = sleep
+        self.worker_name = str(os.getpid())
+        self.stop_event = threading.Event()
+
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="task-worker")
+        self._lock = threading.Lock()
+        self._running = {}  # future -> Task
+        self._per_queue = Counter()
+        self._slot_freed = threading.Event()
+        self._waits = {}  # queue -> [tasks started, total wait, max wait] since the last stats log
+
+    def stop(self):
+        self.stop_event.set()
+        self._slot_freed.set()
+
+    def run(self, duration=0, shutdown_timeout=30):
+        """
+        Dispatches tasks until stop() is called (or `duration` seconds pass), then drains the pool.
+        Returns False if some tasks were still running when shutdown_timeout ran out.
+        """
+        started = last_stats = time.monotonic()
+        logger.info(
+            f"Task worker {self.worker_name} started with {self.threads} thread(s), "
+            f"queue limits {self.queue_limits}, reserved {self.queue_reserved}"
+        )
+        while not self.stop_event.is_set():
+            if duration > 0 and time.monotonic() - started > duration:
+                break
+            if time.monotonic() - last_stats > STATS_LOG_INTERVAL:
+                self.log_wait_stats()
+                last_stats = time.monotonic()
+            self._slot_freed.clear()
+            if not self.dispatch():
+                close_old_connections()
+                self._slot_freed.wait(self.sleep)
+        return self.shutdown(shutdown_timeout)
+
+    def dispatch(self):
+        """Locks and submits as many due tasks as there are free threads. Returns how many were submitted."""
+        with self._lock:
+            free = self.threads - len(self._running)
+            per_queue = Counter(self._per_queue)
+        if free <= 0:
+            return 0
+
+        submitted = 0
+        for task in Task.objects.find_available()[:free * 4]:
+            if submitted >= free:
+                break
+            if task.task_name not in tasks._tasks:
+                continue
+            queue = task.queue or DEFAULT_QUEUE
+            limit = self.queue_limits.get(queue)
+            if limit is not None and per_queue[queue] >= limit:
+                continue
+            held_back = sum(
+                max(0, reserved - per_queue[other])
+                for other, reserved in self.queue_reserved.items() if other != queue
+            )
+            if free - submitted <= held_back:
+                continue
+            locked_task = task.lock(self.worker_name)
+            if not locked_task:
+                continue
+
+            self._record_wait(queue, (now() - locked_task.run_at).total_seconds())
+            per_queue[queue] += 1
+            with self._lock:
+                self._per_queue[queue] += 1
+                future = self._executor.submit(self._run_task, locked_task)
+                self._running[future] = locked_task
+            future.add_done_callback(self._task_done)
+            submitted += 1
+        return submitted
+
+    def _record_wait(self, queue, wait):
+        waits = self._waits.setdefault(queue, [0, 0.0, 0.0])
+        waits[0] += 1
+        waits[1] += wait
+        waits[2] = max(waits[2], wait)
+
+    def log_wait_stats(self):
+        """Logs how long tasks waited between being due and starting, per queue, then resets the counters."""
+        waits, self._waits = self._waits, {}
+        for queue, (count, total, longest) in sorted(waits.items()):
+            logger.info(
+                f"Task worker {self.worker_name} queue '{queue}': {count} started, "
+                f"avg wait {total / count:.1f}s, max wait {longest:.1f}s"
+            )
+        throttled = {service: waited for service, waited in throttle_stats().items() if waited}
+        if throttled:
+            logger.info(f"Task worker {self.worker_name} AWS rate limit waits so far (seconds): {throttled}")
+
+    def _run_task(self, task):
+        try:
+            logger.info(f"Running {task}")
+            tasks.run_task(task)
+        finally:
+            close_old_connections()
+
+    def _task_done(self, future):
+        with self._lock:
+            task = self._running.pop(future)
+            self._per_queue[task.queue or DEFAULT_QUEUE] -= 1
+        self._slot_freed.set()
+
+    def shutdown(self, timeout):
+        """
+        Waits up to `timeout` seconds for running tasks to finish. Tasks still running after that
+        are unlocked so another worker can pick them up straight away rather than after MAX_RUN_TIME.
+        """
+        with self._lock:
+            pending = list(self._running)
+        if pending:
+            logger.info(f"Task worker {self.worker_name} waiting up to {timeout}s for {len(pending)} running task(s)")
+        _, not_done = wait(pending, timeout=timeout)
+        if not_done:
+            with self._lock:
+                task_ids = [self._running[future].id for future in not_done if future in self._running]
+            Task.objects.filter(id__in=task_ids, locked_by=self.worker_name).update(locked_by=None, locked_at=None)
+            logger.warning(f"Task worker {self.worker_name} released {len(task_ids)} unfinished task(s) on shutdown")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        return not not_done
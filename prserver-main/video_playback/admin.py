@@ -1,3 +1,9 @@
 from django.contrib import admin
+from .models import RecordedSession
 
-# Register your models here.
+
+@admin.register(RecordedSession)
+class RecordedSessionAdmin(admin.ModelAdmin):
+    list_display = ("test_id", "status", "segments_done", "segments_total", "video_path", "created_at")
+    search_fields = ("test_id",)
+    list_filter = ("status",)
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.8 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_playback', '0004_remove_recordedsession_test_request_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordedsession',
+            name='status',
+            field=models.CharField(choices=[('recorded', 'Recorded'), ('transcoding', 'Transcoding'), ('uploading', 'Uploading'), ('ready', 'Ready'), ('failed', 'Failed')], default='recorded', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='recordedsession',
+            name='segments_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordedsession',
+            name='segments_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_playback', '0005_recordedsession_status_and_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordedsession',
+            name='shipped_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recordedsession',
+            name='chunks',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_playback', '0006_recordedsession_shipped_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordedsession',
+            name='hls_playlists',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.8 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_playback', '0007_recordedsession_hls_playlists'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordedsession',
+            name='thumbnail_sheets',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='recordedsession',
+            name='keyframes',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
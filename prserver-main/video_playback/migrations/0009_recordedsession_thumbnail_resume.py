@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_playback', '0008_recordedsession_thumbnails_and_keyframes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordedsession',
+            name='thumbnail_resume',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
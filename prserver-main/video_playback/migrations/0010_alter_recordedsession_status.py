@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 22:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('video_playback', '0009_recordedsession_thumbnail_resume'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recordedsession',
+            name='status',
+            field=models.CharField(choices=[('recorded', 'Recorded'), ('transcoding', 'Transcoding'), ('uploading', 'Uploading'), ('ready', 'Ready'), ('failed', 'Failed'), ('empty', 'Empty')], default='recorded', max_length=20),
+        ),
+    ]
@@ -1,10 +1,27 @@
 from django.db import models
 
 class RecordedSession(models.Model):
+    STATUS_CHOICES = [
+        ("recorded", "Recorded"),
+        ("transcoding", "Transcoding"),
+        ("uploading", "Uploading"),
+        ("ready", "Ready"),
+        ("failed", "Failed"),
+        ("empty", "Empty"),  # Nothing was drawn in the session, so there is no video
+    ]
+
     test_id = models.CharField(max_length=100, unique=True)
-    video_path = models.CharField(max_length=500)  # Path to the saved video
     video_path = models.CharField(max_length=500)  # Path to the video file on the server
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="recorded")
+    segments_total = models.PositiveIntegerField(default=0)  # Transcoding progress, in segments
+    segments_done = models.PositiveIntegerField(default=0)
+    shipped_bytes = models.BigIntegerField(default=0)  # Raw recording already copied to S3 while the session ran
+    chunks = models.JSONField(default=list, blank=True)  # Size and SHA-256 of each shipped chunk, in order
+    hls_playlists = models.JSONField(default=dict, blank=True)  # HLS playlist file name -> text, once packaged
+    thumbnail_sheets = models.JSONField(default=list, blank=True)  # Indexes of the sprite sheets rendered so far
+    thumbnail_resume = models.JSONField(default=dict, blank=True)  # Where the next thumbnail run picks the recording up: byte offset, first sync timestamp
+    keyframes = models.JSONField(default=dict, blank=True)  # Keyframe time -> MP4 byte offset index, delta-encoded
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"Session {self.test_id}"
\ No newline at end of file
+        return f"Session {self.test_id}"
@@ -0,0 +1,119 @@
+// Plays the session's HLS playlist: natively where the browser supports it (Safari), otherwise through hls.js
+function attachPlaylist(video) {
+    if (video.canPlayType("application/vnd.apple.mpegurl")) {
+        video.src = video.dataset.playlist;
+    } else if (window.Hls && Hls.isSupported()) {
+        // No worker: the page's Content-Security-Policy does not allow blob: workers
+        var hls = new Hls({ enableWorker: false });
+        hls.loadSource(video.dataset.playlist);
+        hls.attachMedia(video);
+    }
+}
+
+// The keyframe index is delta-encoded: turn it into absolute times in seconds
+function keyframeTimes(keyframes) {
+    var times = [];
+    var time = 0;
+    for (var i = 0; i < keyframes.times.length; i++) {
+        time += keyframes.times[i];
+        times.push(time / 1000);
+    }
+    return times;
+}
+
+// The last keyframe at or before `time`, so the player only has to fetch from there
+function snapToKeyframe(times, time) {
+    var low = 0;
+    var high = times.length - 1;
+    if (high < 0 || time < times[0]) {
+        return time;
+    }
+    while (low < high) {
+        var middle = Math.ceil((low + high) / 2);
+        if (times[middle] <= time) {
+            low = middle;
+        } else {
+            high = middle - 1;
+        }
+    }
+    return times[low];
+}
+
+// Positions the preview on the sprite sheet tile of the thumbnail taken closest before `time`
+function showThumbnail(preview, thumbnails, time) {
+    var perSheet = thumbnails.columns * thumbnails.rows;
+    var frame = Math.floor(time / thumbnails.interval);
+    var url = thumbnails.sheets[Math.floor(frame / perSheet)];
+    if (!url) {
+        preview.hidden = true;
+        return;
+    }
+    var tile = frame % perSheet;
+    preview.style.backgroundImage = "url(\"" + url + "\")";
+    preview.style.backgroundPosition =
+        -(tile % thumbnails.columns) * thumbnails.width + "px " + -Math.floor(tile / thumbnails.columns) * thumbnails.height + "px";
+    preview.hidden = false;
+}
+
+function setUpScrubbing(video, scrubbing) {
+    var bar = document.getElementById("scrubber");
+    var preview = document.getElementById("scrubber-preview");
+    var times = scrubbing.keyframes ? keyframeTimes(scrubbing.keyframes) : [];
+
+    function timeAt(event) {
+        var box = bar.getBoundingClientRect();
+        var fraction = Math.min(Math.max((event.clientX - box.left) / box.width, 0), 1);
+        return { time: fraction * video.duration, x: fraction * box.width };
+    }
+
+    function seek(time) {
+        // Only the MP4 is indexed; HLS renditions have keyframes of their own
+        if (times.length && video.currentSrc === scrubbing.keyframes.video) {
+            time = snapToKeyframe(times, time);
+        }
+        video.currentTime = time;
+    }
+
+    if (bar && preview && scrubbing.thumbnails) {
+        preview.style.width = scrubbing.thumbnails.width + "px";
+        preview.style.height = scrubbing.thumbnails.height + "px";
+        bar.addEventListener("mousemove", function (event) {
+            if (!video.duration) {
+                return;
+            }
+            var point = timeAt(event);
+            showThumbnail(preview, scrubbing.thumbnails, point.time);
+            preview.style.left = point.x - scrubbing.thumbnails.width / 2 + "px";
+        });
+        bar.addEventListener("mouseleave", function () {
+            preview.hidden = true;
+        });
+    }
+    if (bar) {
+        var progress = document.getElementById("scrubber-progress");
+        video.addEventListener("timeupdate", function () {
+            if (progress && video.duration) {
+                progress.style.width = (video.currentTime / video.duration) * 100 + "%";
+            }
+        });
+        bar.addEventListener("click", function (event) {
+            if (video.duration) {
+                seek(timeAt(event).time);
+            }
+        });
+    }
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+    var video = document.getElementById("player");
+    if (!video) {
+        return;
+    }
+    if (video.dataset.playlist) {
+        attachPlaylist(video);
+    }
+    var payload = document.getElementById("scrubbing");
+    if (payload) {
+        setUpScrubbing(video, JSON.parse(payload.textContent));
+    }
+});
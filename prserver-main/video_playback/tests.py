@@ -1,3 +1,117 @@
-from django.test import TestCase
+import json
+import uuid
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+import boto3
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from accounts.models import Company, CustomUser
+from dashboard.models import TestRequest, TestType
+from provisioning.aws import client_config
+from .models import RecordedSession
+from .views import rewrite_playlist
 
-# Create your tests here.
+MASTER = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-STREAM-INF:BANDWIDTH=1650000,RESOLUTION=1280x720
+720p.m3u8
+
+#EXT-X-STREAM-INF:BANDWIDTH=440000,RESOLUTION=640x360
+360p.m3u8
+"""
+
+MEDIA = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:6
+#EXT-X-PLAYLIST-TYPE:VOD
+#EXTINF:6.000000,
+720p-00000.ts
+#EXTINF:2.500000,
+720p-00001.ts
+#EXT-X-ENDLIST
+"""
+
+
+class RewritePlaylistTests(TestCase):
+    def test_only_uri_lines_are_rewritten(self):
+        rewritten = rewrite_playlist(MEDIA, lambda uri: f"/x/{uri}").splitlines()
+        self.assertEqual([line for line in rewritten if not line.startswith("#")], ["/x/720p-00000.ts", "/x/720p-00001.ts"])
+        self.assertIn("#EXTINF:2.500000,", rewritten)
+
+
+@override_settings(RECORDINGS_BUCKET="bucket", HLS_SEGMENT_URL_EXPIRES=60)
+class HlsPlaybackTests(TestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Acme")
+        self.test_request = TestRequest.objects.create(
+            title="AD test", test_type=TestType.objects.create(name="Windows admin"), password="x", company=company
+        )
+        RecordedSession.objects.create(
+            test_id=str(self.test_request.public_id), video_path="",
+            hls_playlists={"master.m3u8": MASTER, "720p.m3u8": MEDIA},
+            thumbnail_sheets=[0, 1], keyframes={"times": [0, 1200], "offsets": [48, 3952]},
+        )
+        self.user = CustomUser.objects.create_user(username="reviewer", email="r@acme.test", password="x", company=company)
+        self.client.force_login(self.user)
+        # Signing URLs needs no network, only credentials; fixed ones keep the tests off the real account
+        s3 = boto3.client(
+            "s3", region_name="us-east-1", config=client_config("s3"),
+            aws_access_key_id="testing", aws_secret_access_key="testing",
+        )
+        patcher = mock.patch("video_playback.views.client", return_value=s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def url(self, view, *args):
+        return reverse(f"video_playback:{view}", args=[self.test_request.public_id, *args])
+
+    def test_player_loads_master_playlist(self):
+        response = self.client.get(self.url("play_video"))
+        self.assertContains(response, f'data-playlist="{self.url("hls_playlist", "master.m3u8")}"')
+        self.assertIn("blob:", response["Content-Security-Policy"])
+
+    def test_player_gets_thumbnails_and_keyframe_index(self):
+        self.test_request.recorded_session = f"recordings/testid-{self.test_request.public_id}.mp4"
+        self.test_request.save()
+        response = self.client.get(self.url("play_video"))
+        data = json.loads(response.content.decode().split('<script id="scrubbing" type="application/json">')[1].split("</script>")[0])
+        self.assertEqual(sorted(data["thumbnails"]["sheets"]), ["0", "1"])
+        self.assertIn(f"recordings/thumbnails/testid-{self.test_request.public_id}/sheet-0001.jpg", data["thumbnails"]["sheets"]["1"])
+        self.assertEqual(data["keyframes"]["offsets"], [48, 3952])
+        self.assertIn(f"recordings/testid-{self.test_request.public_id}.mp4", data["keyframes"]["video"])
+
+    def test_mp4_player_gets_the_scrubber(self):
+        RecordedSession.objects.filter(test_id=str(self.test_request.public_id)).update(hls_playlists={})
+        self.test_request.recorded_session = f"recordings/testid-{self.test_request.public_id}.mp4"
+        self.test_request.save()
+        response = self.client.get(self.url("play_video"))
+        self.assertContains(response, 'id="scrubber"')
+        self.assertContains(response, "video_playback/player.js")
+        self.assertNotContains(response, "data-playlist")
+
+    def test_playlists_point_back_at_playback_views(self):
+        master = self.client.get(self.url("hls_playlist", "master.m3u8")).content.decode()
+        self.assertIn(self.url("hls_playlist", "720p.m3u8"), master)
+        media = self.client.get(self.url("hls_playlist", "720p.m3u8")).content.decode()
+        self.assertIn(self.url("hls_segment", "720p-00001.ts"), media)
+        self.assertEqual(self.client.get(self.url("hls_playlist", "1080p.m3u8")).status_code, 404)
+
+    def test_segment_redirects_to_short_lived_signed_url(self):
+        response = self.client.get(self.url("hls_segment", "720p-00001.ts"))
+        self.assertEqual(response.status_code, 302)
+        location = urlsplit(response["Location"])
+        self.assertTrue(location.path.endswith(f"recordings/hls/testid-{self.test_request.public_id}/720p-00001.ts"))
+        self.assertEqual(parse_qs(location.query)["X-Amz-Expires"], ["60"])
+
+    def test_other_companies_cannot_watch(self):
+        self.user.company = Company.objects.create(name="Other")
+        self.user.save()
+        for url in (self.url("play_video"), self.url("hls_playlist", "master.m3u8"), self.url("hls_segment", "720p-00001.ts")):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_segment_names_are_checked(self):
+        self.assertEqual(self.client.get(self.url("hls_segment", "..%2Fsecret.ts")).status_code, 404)
+
+    def test_unknown_session_has_no_playlist(self):
+        url = reverse("video_playback:hls_playlist", args=[uuid.uuid4(), "master.m3u8"])
+        self.assertEqual(self.client.get(url).status_code, 404)
@@ -6,4 +6,6 @@ app_name = 'video_playback'
 
 urlpatterns = [
     path('play/<uuid:public_id>/', views.play_video, name='play_video'),
-]
\ No newline at end of file
+    path('play/<uuid:public_id>/hls/<str:name>', views.hls_playlist, name='hls_playlist'),
+    path('play/<uuid:public_id>/hls/segments/<str:name>', views.hls_segment, name='hls_segment'),
+]
@@ -1,54 +1,136 @@
-from django.shortcuts import render, get_object_or_404
-from .models import RecordedSession
-from django.contrib.auth.decorators import login_required
-from django.http import Http404
-import boto3
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+import functools
 import logging
+import re
+from urllib.parse import urlsplit
 from django.conf import settings
-import os
-from django.http import JsonResponse
-from botocore.exceptions import ClientError
-from utils.secrets import get_secret
-from django.core.exceptions import PermissionDenied
-
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.shortcuts import render, get_object_or_404
+from django.urls import reverse
+from django.utils.translation import gettext as _
+from dashboard.models import TestRequest
+from provisioning.aws import client
+from provisioning import scrubbing
+from provisioning.packaging import MASTER_PLAYLIST, hls_prefix
+from .models import RecordedSession
 
 
 logger = logging.getLogger(__name__)
 
+HLS_JS = "https://cdn.jsdelivr.net/npm/hls.js@1.5.20/dist/hls.min.js"
+SEGMENT_NAME = re.compile(r"^[0-9a-z]+-\d{5}\.ts$")
+
+
+def presigned_url(key, expires):
+    return client("s3").generate_presigned_url(
+        "get_object", Params={"Bucket": settings.RECORDINGS_BUCKET, "Key": key}, ExpiresIn=expires
+    )
+
+
+@functools.lru_cache
+def recordings_origin():
+    """Scheme and host signed recording URLs point at, for the page's Content-Security-Policy."""
+    url = urlsplit(presigned_url("recordings/", 1))
+    return f"{url.scheme}://{url.netloc}"
+
+
+def rewrite_playlist(text, url_for):
+    """Replaces each URI line of an HLS playlist with url_for(uri), leaving tags and comments alone."""
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        lines.append(url_for(line) if line and not line.startswith("#") else line)
+    return "\n".join(lines) + "\n"
+
+
+def scrubbing_data(public_id, session, video_url):
+    """
+    What the player needs for timeline scrubbing: the sprite sheet layout with a signed URL per
+    sheet for hover previews, and the MP4's keyframe index to fetch byte ranges from.
+    """
+    data = {}
+    if session and session.thumbnail_sheets:
+        data["thumbnails"] = {
+            "interval": settings.THUMBNAIL_INTERVAL,
+            "width": scrubbing.THUMBNAIL_WIDTH,
+            "height": scrubbing.THUMBNAIL_HEIGHT,
+            "columns": scrubbing.SHEET_COLUMNS,
+            "rows": scrubbing.SHEET_ROWS,
+            "sheets": {
+                index: presigned_url(scrubbing.sheet_key(public_id, index), settings.RECORDING_VIDEO_URL_EXPIRES)
+                for index in session.thumbnail_sheets
+            },
+        }
+    if session and session.keyframes and video_url:
+        data["keyframes"] = {"video": video_url, **session.keyframes}
+    return data
+
+
+def company_test_request(request, public_id):
+    return get_object_or_404(TestRequest, public_id=public_id, company=request.user.company)
+
+
 @login_required
 def play_video(request, public_id):
     """
-    Render the video playback page with the S3 pre-signed video URL for a given session.
+    Render the video playback page for a session: its HLS playlist once the recording has been
+    packaged, otherwise the MP4 through a pre-signed S3 URL, along with its scrubbing data.
+    """
+    test_request = company_test_request(request, public_id)
+    session = (
+        RecordedSession.objects.filter(test_id=str(public_id))
+        .only("status", "hls_playlists", "thumbnail_sheets", "keyframes").first()
+    )
+    video_url = None
+    if test_request.recorded_session:
+        video_url = presigned_url(test_request.recorded_session, settings.RECORDING_VIDEO_URL_EXPIRES)
+    context = {"test_id": public_id, "scrubbing": scrubbing_data(public_id, session, video_url)}
+    if session and MASTER_PLAYLIST in session.hls_playlists:
+        context["playlist_url"] = reverse("video_playback:hls_playlist", args=[public_id, MASTER_PLAYLIST])
+        context["hls_js"] = HLS_JS
+    elif video_url:
+        context["video_url"] = video_url
+    elif session and session.status == "empty":
+        context["error"] = _("Nothing was recorded in this session.")
+    else:
+        context["error"] = _("The recording of this session is not available yet.")
+
+    response = render(request, 'video_playback/play_video.html', context)
+    # Media and thumbnails come straight from S3; hls.js feeds media to the player through a blob: URL
+    response._csp_update = {
+        "connect-src": [recordings_origin()],
+        "img-src": [recordings_origin()],
+        "media-src": [recordings_origin(), "blob:"],
+        "script-src": [HLS_JS],
+    }
+    return response
+
+
+@login_required
+def hls_playlist(request, public_id, name):
+    """Serves one of the session's HLS playlists with every URI pointing back at these views."""
+    company_test_request(request, public_id)
+    session = get_object_or_404(RecordedSession.objects.only("hls_playlists"), test_id=str(public_id))
+    text = session.hls_playlists.get(name)
+    if text is None:
+        raise Http404
+
+    def url_for(uri):
+        view = "video_playback:hls_playlist" if uri.endswith(".m3u8") else "video_playback:hls_segment"
+        return reverse(view, args=[public_id, uri])
+
+    response = HttpResponse(rewrite_playlist(text, url_for), content_type="application/vnd.apple.mpegurl")
+    response["Cache-Control"] = "private, no-store"
+    return response
+
+
+@login_required
+def hls_segment(request, public_id, name):
+    """
+    Redirects to a freshly signed S3 URL for one segment. Signing per request keeps each URL's
+    lifetime at HLS_SEGMENT_URL_EXPIRES however long the recording, without a call to S3.
     """
-    # Generate S3 presigned URL
-    #s3_client = boto3.client('s3', region_name=AWS_REGION)
-    video_location = f"recordings/{public_id}.mp4"
-
-    # Check if file exists in S3
-    try:
-
-     '''   s3_client.head_object(Bucket=AWS_S3_BUCKET_NAME, Key=s3_key)
-    except ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            error_message = f"Video file {test_id}.mp4 not found in S3."
-        else:
-            error_message = f"Error checking video file: {e}"
-        return render(request, 'video_playback/play_video.html', {
-            "test_id": public_id,
-            "error": error_message
-        })'''
-
-    # Generate 
-'''   try:
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': AWS_S3_BUCKET_NAME, 'Key': s3_key},
-            ExpiresIn=3600  # URL valid for 1 hour
-        )
-    except ClientError as e:
-        error_message = f"Could not generate a video URL for test ID {public_id}: {e}"
-        return render(request, 'video_playback/play_video.html', {
-            "test_id": public_id,
-            "error": error_message,
-        })'''
+    if not SEGMENT_NAME.match(name):
+        raise Http404
+    company_test_request(request, public_id)
+    return HttpResponseRedirect(presigned_url(f"{hls_prefix(public_id)}{name}", settings.HLS_SEGMENT_URL_EXPIRES))
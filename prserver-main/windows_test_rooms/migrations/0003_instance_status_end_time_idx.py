@@ -0,0 +1,17 @@
+# Generated by Django 5.1.8 on 2026-10-18 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('windows_test_rooms', '0002_windowstestinstance_sub_tests'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='windowstestinstance',
+            index=models.Index(fields=['status', 'end_time'], name='windowsinst_status_end_idx'),
+        ),
+    ]
@@ -8,4 +8,10 @@ class WindowsTestInstance(models.Model):
     start_time = models.DateTimeField(auto_now_add=True)
     end_time = models.DateTimeField()
     status = models.CharField(max_length=50, default='pending')
-    sub_tests = models.ManyToManyField(SubTest, blank=True)  
\ No newline at end of file
+    sub_tests = models.ManyToManyField(SubTest, blank=True)  
+
+    class Meta:
+        indexes = [
+            # The expiry sweeper looks up live instances past their end_time
+            models.Index(fields=['status', 'end_time'], name='windowsinst_status_end_idx'),
+        ]